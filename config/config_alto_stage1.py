@@ -15,19 +15,23 @@ total_batch_size = batch_size_per_gpu * num_gpus
 print_freq = 50  # don't print too often
 test_freq = print_freq * 50  # also the model-saving frequency
 seed = 3613
-compile = False
+compile = False  # torch.compile the model forward
 num_max_save_models = 5
+async_save = True  # write checkpoints on a background thread from pinned host copies
+save_safetensors = False  # also write the model weights as .safetensors next to each checkpoint
 test_distributed = True
 test_before_train = False
+writer_max_pending = 8  # test visualization batches queued for the background writer
 
 # set to true if model is differ than original
-use_gradient_ckpt = True  # unet_requires_grad
+use_gradient_ckpt = False  # opt-in activation checkpointing of the TiTok transformer and pixel decoder blocks
 find_unused_parameters = False
 
 ###############Model EMA#####################
 use_ema = False
 ema_beta = 0.97  # ema_update_every=20
 ema_update_every = 2 * print_freq  # every update cost about 7sec
+ema_offload = False  # keep the ema weights in host memory instead of on the gpu
 
 ###############Optimizer#####################
 gradient_accumulation_steps = 1
@@ -77,6 +81,9 @@ dataset = {
     'params': {
         'train_sam1b_path': "./example/sa1b.json",
         'eval_sam1b_path': "./example/sa1b.json",
+        # prefix written by trainers/sa1b_index.py, None reads the annotation json files
+        'train_sam1b_index': None,
+        'eval_sam1b_index': None,
         'num_workers_per_gpu': 12
     },
     'preprocessing': {
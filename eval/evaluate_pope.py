@@ -12,7 +12,9 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 import torch
 from internvl.model import load_model_and_tokenizer
-from internvl.train.dataset import build_transform, dynamic_preprocess
+from internvl.train.dataset import (build_transform, dynamic_preprocess,
+                                    get_dynamic_num_patches)
+from eval.utils import LengthSortedInferenceSampler
 from PIL import Image
 from tqdm import tqdm
 
@@ -47,11 +49,12 @@ def extract_answer(text):
 
 def collate_fn(batches, tokenizer):
     pixel_values = torch.cat([_['pixel_values'] for _ in batches], dim=0)
+    num_patches_list = [_['pixel_values'].size(0) for _ in batches]
     questions = [_['question'] for _ in batches]
     question_ids = [_['question_id'] for _ in batches]
     annotations = [_['annotation'] for _ in batches]
 
-    return pixel_values, questions, question_ids, annotations
+    return pixel_values, num_patches_list, questions, question_ids, annotations
 
 
 class VQADataset(torch.utils.data.Dataset):
@@ -70,6 +73,17 @@ class VQADataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.data)
 
+    def get_length(self, idx):
+        # (number of tiles, question length) without decoding the image, used to sort batches
+        data = json.loads(self.data[idx].strip())
+        num_patches = 1
+        if self.dynamic_image_size:
+            with Image.open(os.path.join(self.root, data['image'])) as image:
+                num_patches = get_dynamic_num_patches(image.size, image_size=self.input_size,
+                                                      use_thumbnail=self.use_thumbnail,
+                                                      max_num=self.max_num)
+        return num_patches, len(data['text'])
+
     def __getitem__(self, idx):
         data = json.loads(self.data[idx].strip())
         image, question, question_id, annotation = data['image'], data[
@@ -98,32 +112,6 @@ class VQADataset(torch.utils.data.Dataset):
         }
 
 
-class InferenceSampler(torch.utils.data.sampler.Sampler):
-
-    def __init__(self, size):
-        self._size = int(size)
-        assert size > 0
-        self._rank = torch.distributed.get_rank()
-        self._world_size = torch.distributed.get_world_size()
-        self._local_indices = self._get_local_indices(size, self._world_size, self._rank)
-
-    @staticmethod
-    def _get_local_indices(total_size, world_size, rank):
-        shard_size = total_size // world_size
-        left = total_size % world_size
-        shard_sizes = [shard_size + int(r < left) for r in range(world_size)]
-
-        begin = sum(shard_sizes[:rank])
-        end = min(sum(shard_sizes[:rank + 1]), total_size)
-        return range(begin, end)
-
-    def __iter__(self):
-        yield from self._local_indices
-
-    def __len__(self):
-        return len(self._local_indices)
-
-
 def evaluate_chat_model():
     prompt = '' if args.cot else 'Answer the question using a single word or phrase.'
     random.seed(args.seed)
@@ -140,7 +128,7 @@ def evaluate_chat_model():
         )
         dataloader = torch.utils.data.DataLoader(
             dataset=dataset,
-            sampler=InferenceSampler(len(dataset)),
+            sampler=LengthSortedInferenceSampler(len(dataset), dataset.get_length),
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=True,
@@ -149,7 +137,7 @@ def evaluate_chat_model():
         )
 
         outputs = []
-        for _, (pixel_values, questions, question_ids, annotations) in tqdm(enumerate(dataloader)):
+        for _, (pixel_values, num_patches_list, questions, question_ids, annotations) in tqdm(enumerate(dataloader)):
             if args.cot:
                 questions = [COT_INSTRUCTION.format(question=q) for q in questions]
 
@@ -160,20 +148,21 @@ def evaluate_chat_model():
                 min_new_tokens=ds_collections[ds_name]['min_new_tokens'],
                 do_sample=True if args.temperature > 0 else False,
                 temperature=args.temperature,
+                skip_special_tokens=True,
             )
-            pred = model.chat(
+            preds = model.batch_chat(
                 tokenizer=tokenizer,
                 pixel_values=pixel_values,
-                question=questions[0],
+                num_patches_list=num_patches_list,
+                questions=questions,
                 generation_config=generation_config,
                 verbose=True
             )
-            pred_orig = pred
-            if args.cot:
-                pred = extract_answer(pred).strip()
-            answers = [pred]
 
-            for question_id, answer, annotation in zip(question_ids, answers, annotations):
+            for question_id, pred, annotation in zip(question_ids, preds, annotations):
+                pred_orig = pred
+                if args.cot:
+                    pred = extract_answer(pred).strip()
                 outputs.append({
                     'question_id': question_id,
                     'text': pred,
@@ -233,7 +222,6 @@ if __name__ == '__main__':
 
     args.datasets = args.datasets.split(',')
     print('datasets:', args.datasets)
-    assert args.batch_size == 1, 'Only batch size 1 is supported'
 
     torch.distributed.init_process_group(
         backend='nccl',
@@ -3,8 +3,13 @@ from typing import List, Dict
 from tqdm import tqdm
 import re
 import argparse
+import torch
+import torch.distributed as dist
 from eval.seg_dataset import ReferSegDataset
-from eval.utils import AverageMeter, Summary
+from eval.utils import (AverageMeter, Summary, InferenceSampler, compute_iou,
+                        init_eval_distributed, seg_collate_fn)
+from eval.prediction_store import (PredictionStore, prompt_hash,
+                                   encode_rle, decode_rle, compute_iou_rle)
 from eval.predict import Predictor
 
 def init_trackers() -> Dict:
@@ -22,46 +27,134 @@ def print_dataset_results(dataset_name, trackers):
     print(f"cIoU: {miou:.4f}")
     print(f"gIoU: {trackers['gIoU'].avg:.4f}")
 
-def evaluate_worker(predictor, dataset, batch_size):
+def update_trackers(trackers, intersection, union, iou):
+    trackers['intersection'].update(intersection, n=1)
+    trackers['union'].update(union, n=1)
+    trackers['gIoU'].update(iou, n=1)
+
+def evaluate_worker(predictor, dataset, batch_size, num_workers=4, store=None):
     trackers = init_trackers()
-    
-    total_samples = len(dataset)
-    total_samples = 100
-    
-    for batch_idx, idx in enumerate(tqdm(range(0, total_samples, batch_size), 
-                    desc=f"Evaluating ...")):
+    rank = dist.get_rank() if dist.is_initialized() else 0
+
+    indices = list(range(len(dataset)))
+    if store is not None:
+        # skip samples that already have a prediction for the same prompt
+        hashes = [prompt_hash(dataset.get_prompt(i)) for i in indices]
+        done = store.load(hashes)
+        if dist.is_initialized():
+            dist.barrier()
+        if rank == 0:
+            print(f"Resuming from {len(done)}/{len(dataset)} stored predictions")
+            for record in done.values():
+                update_trackers(trackers, record["intersection"], record["union"], record["iou"])
+        indices = [i for i in indices if i not in done]
+
+    if len(indices) > 0:
+        dataloader = torch.utils.data.DataLoader(
+            dataset=torch.utils.data.Subset(dataset, indices),
+            sampler=InferenceSampler(len(indices)),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            drop_last=False,
+            collate_fn=seg_collate_fn,
+            prefetch_factor=4 if num_workers > 0 else None,
+        )
 
-        batch_end = min(idx + batch_size, total_samples)
-        batch_samples = [dataset[i] for i in range(idx, batch_end)]
+        for batch_samples in tqdm(dataloader, desc="Evaluating ...", disable=rank != 0):
+            if store is None:
+                mask_images = predictor.predict(batch_samples)
+            else:
+                mask_images, tokens, valid = predictor.predict(batch_samples, return_tokens=True)
 
-        mask_images = predictor.predict(batch_samples)
+            # metrics are computed on the device of the predicted masks
+            mask_images = mask_images.float()
+            ious, pred_masks, counts = predictor.update_metrics(mask_images, batch_samples, trackers,
+                                                                return_masks=True)
 
-        mask_images = mask_images.float().cpu().numpy()
-        predictor.update_metrics(mask_images, batch_samples, trackers)
+            if store is not None:
+                for j, data in enumerate(batch_samples):
+                    intersection, union = counts[j]
+                    store.append({
+                        "id": data["index"],
+                        "prompt_hash": prompt_hash(data["prompt"]),
+                        "tokens": tokens[j],
+                        "length": len(tokens[j]),
+                        "valid": bool(valid[j]),
+                        "mask": encode_rle(pred_masks[j]),
+                        "intersection": int(intersection),
+                        "union": int(union),
+                        "iou": float(ious[j]),
+                    })
+                store.flush()
+
+    if store is not None:
+        store.close()
+    if dist.is_initialized():
+        for tracker in trackers.values():
+            tracker.all_reduce()
     return trackers
 
+def evaluate_from_store(dataset, store):
+    """Recompute the metrics from stored prediction masks, without running the model."""
+    trackers = init_trackers()
+    hashes = [prompt_hash(dataset.get_prompt(i)) for i in range(len(dataset))]
+    records = store.load(hashes)
+    if len(records) < len(dataset):
+        print(f"Warning: only {len(records)}/{len(dataset)} samples have stored predictions")
+    use_rle = getattr(dataset, "mask_cache", None) is not None
+    for idx in tqdm(sorted(records.keys()), desc="Scoring ..."):
+        if use_rle:
+            # both masks are already run-length encoded, no need to decode them
+            update_trackers(trackers, *compute_iou_rle(dataset.get_mask_rle(idx), records[idx]["mask"]))
+            continue
+        gt_mask = dataset.get_mask(idx)
+        pred_mask = decode_rle(records[idx]["mask"])
+        update_trackers(trackers, *compute_iou(gt_mask, pred_mask))
+    return trackers
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--checkpoint', type=str, default=None)
     parser.add_argument('--data-dir', type=str, default='./data/res')
     parser.add_argument('--image-dir', type=str, default='./data/coco/train2014')
     parser.add_argument('--datasets', type=str, default='refcoco_val,refcoco_testA,refcoco_testB')
     parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--num-workers', type=int, default=4)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--max-num', type=int, default=1)
     parser.add_argument('--text-mode', type=str, default='all')
+    parser.add_argument('--store-dir', type=str, default=None,
+                        help='directory of the per-sample prediction store, enables resuming')
+    parser.add_argument('--metrics-only', action='store_true',
+                        help='recompute metrics from --store-dir without loading the model')
+    parser.add_argument('--mask-cache-dir', type=str, default=None,
+                        help='directory of the merged ground-truth mask cache, built on first use')
     args = parser.parse_args()
+    assert not args.metrics_only or args.store_dir is not None, '--metrics-only requires --store-dir'
+    assert args.metrics_only or args.checkpoint is not None, '--checkpoint is required'
 
-    predictor = Predictor(args.checkpoint, max_num=args.max_num)
+    rank, _ = init_eval_distributed()
+    predictor = None if args.metrics_only else Predictor(args.checkpoint, max_num=args.max_num)
     dataset_names = args.datasets.split(',')
     for dataset_name in dataset_names:
         dataset = dataset_name.split('_')[0]
         split = '_'.join(dataset_name.split('_')[1:])
 
-        ds = ReferSegDataset(dataset_dir=args.data_dir,image_dir=args.image_dir,refer_seg_data=dataset, split=split, text_mode=args.text_mode)
-        trackers = evaluate_worker(predictor, ds, args.batch_size)
-        print_dataset_results(f"{dataset}_{split}", trackers)
+        # let rank 0 build the mask cache before the other ranks read it
+        if rank != 0 and dist.is_initialized():
+            dist.barrier()
+        ds = ReferSegDataset(dataset_dir=args.data_dir,image_dir=args.image_dir,refer_seg_data=dataset, split=split,
+                             text_mode=args.text_mode, mask_cache_dir=args.mask_cache_dir)
+        if rank == 0 and dist.is_initialized():
+            dist.barrier()
+        store = PredictionStore(args.store_dir, f"{dataset}_{split}", rank) if args.store_dir else None
+        if args.metrics_only:
+            if rank == 0:
+                print_dataset_results(f"{dataset}_{split}", evaluate_from_store(ds, store))
+            continue
+        trackers = evaluate_worker(predictor, ds, args.batch_size, args.num_workers, store=store)
+        if rank == 0:
+            print_dataset_results(f"{dataset}_{split}", trackers)
 
 
 if __name__ == "__main__":
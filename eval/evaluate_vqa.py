@@ -13,9 +13,11 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 import torch
 from internvl.model import load_model_and_tokenizer
-from internvl.train.dataset import build_transform, dynamic_preprocess
+from internvl.train.dataset import (build_transform, dynamic_preprocess,
+                                    get_dynamic_num_patches)
 from PIL import Image
 from eval.textvqa_eval import TextVQAAccuracyEvaluator
+from eval.utils import LengthSortedInferenceSampler
 from tqdm import tqdm
 
 ds_collections = {
@@ -101,11 +103,12 @@ def evaluate_exact_match_accuracy(entries):
 
 def collate_fn(batches, tokenizer):
     pixel_values = torch.cat([_['pixel_values'] for _ in batches], dim=0)
+    num_patches_list = [_['pixel_values'].size(0) for _ in batches]
     questions = [_['question'] for _ in batches]
     question_ids = [_['question_id'] for _ in batches]
     annotations = [_['annotation'] for _ in batches]
 
-    return pixel_values, questions, question_ids, annotations
+    return pixel_values, num_patches_list, questions, question_ids, annotations
 
 
 class VQADataset(torch.utils.data.Dataset):
@@ -129,6 +132,22 @@ class VQADataset(torch.utils.data.Dataset):
         #     return 4000
         return len(self.test)
 
+    def get_image_path(self, image):
+        if os.path.exists(self.coco_dir):
+            image  = os.path.join(self.coco_dir, os.path.basename(image))
+        return image
+
+    def get_length(self, idx):
+        # (number of tiles, question length) without decoding the image, used to sort batches
+        data = json.loads(self.test[idx].strip())
+        num_patches = 1
+        if self.dynamic_image_size:
+            with Image.open(self.get_image_path(data['image'])) as image:
+                num_patches = get_dynamic_num_patches(image.size, image_size=self.input_size,
+                                                      use_thumbnail=self.use_thumbnail,
+                                                      max_num=self.max_num)
+        return num_patches, len(data['question'])
+
     def __getitem__(self, idx):
         data = json.loads(self.test[idx].strip())
         image, question, question_id, annotation = data['image'], data[
@@ -143,9 +162,7 @@ class VQADataset(torch.utils.data.Dataset):
                     sample['image'],
                     sample['question']) + f" {sample['answer']}"
 
-        if os.path.exists(self.coco_dir):
-            image  = os.path.join(self.coco_dir, os.path.basename(image))
-        image = Image.open(image).convert('RGB')
+        image = Image.open(self.get_image_path(image)).convert('RGB')
         if self.dynamic_image_size:
             print(f"dynamic_preprocess;{self.max_num}")
             images = dynamic_preprocess(image, image_size=self.input_size,
@@ -165,32 +182,6 @@ class VQADataset(torch.utils.data.Dataset):
         }
 
 
-class InferenceSampler(torch.utils.data.sampler.Sampler):
-
-    def __init__(self, size):
-        self._size = int(size)
-        assert size > 0
-        self._rank = torch.distributed.get_rank()
-        self._world_size = torch.distributed.get_world_size()
-        self._local_indices = self._get_local_indices(size, self._world_size, self._rank)
-
-    @staticmethod
-    def _get_local_indices(total_size, world_size, rank):
-        shard_size = total_size // world_size
-        left = total_size % world_size
-        shard_sizes = [shard_size + int(r < left) for r in range(world_size)]
-
-        begin = sum(shard_sizes[:rank])
-        end = min(sum(shard_sizes[:rank + 1]), total_size)
-        return range(begin, end)
-
-    def __iter__(self):
-        yield from self._local_indices
-
-    def __len__(self):
-        return len(self._local_indices)
-
-
 def post_process(response):
     response = response.strip().split('.')[0].split(
         ',')[0].split('!')[0].lower()
@@ -241,7 +232,7 @@ def evaluate_chat_model():
         )
         dataloader = torch.utils.data.DataLoader(
             dataset=dataset,
-            sampler=InferenceSampler(len(dataset)),
+            sampler=LengthSortedInferenceSampler(len(dataset), dataset.get_length),
             batch_size=args.batch_size,
             num_workers=args.num_workers,
             pin_memory=True,
@@ -250,7 +241,7 @@ def evaluate_chat_model():
         )
 
         outputs = []
-        for _, (pixel_values, questions, question_ids, annotations) in tqdm(enumerate(dataloader)):
+        for _, (pixel_values, num_patches_list, questions, question_ids, annotations) in tqdm(enumerate(dataloader)):
             pixel_values = pixel_values.to(torch.bfloat16).cuda()
             generation_config = dict(
                 num_beams=args.num_beams,
@@ -258,15 +249,15 @@ def evaluate_chat_model():
                 min_new_tokens=1,
                 do_sample=True if args.temperature > 0 else False,
                 temperature=args.temperature,
+                skip_special_tokens=True,
             )
-            pred = model.chat(
+            answers = model.batch_chat(
                 tokenizer=tokenizer,
                 pixel_values=pixel_values,
-                question=questions[0],
+                num_patches_list=num_patches_list,
+                questions=questions,
                 generation_config=generation_config,
-                # verbose=True
             )
-            answers = [pred]
 
             for question, question_id, answer, annotation in zip(questions, question_ids, answers, annotations):
                 if ds_name in ['vqav2_val', 'vqav2_testdev', 'okvqa_val', 'textvqa_val',
@@ -408,7 +399,6 @@ if __name__ == '__main__':
 
     args.datasets = args.datasets.split(',')
     print('datasets:', args.datasets)
-    assert args.batch_size == 1, 'Only batch size 1 is supported'
 
     torch.distributed.init_process_group(
         backend='nccl',
@@ -6,7 +6,8 @@ import re
 
 import torch
 from internvl.model import load_model_and_tokenizer
-from internvl.train.dataset import build_transform, dynamic_preprocess
+from internvl.train.dataset import (build_transform, dynamic_preprocess,
+                                    get_dynamic_num_patches)
 from PIL import Image
 from tqdm import tqdm
 
@@ -25,6 +26,15 @@ def load_image(image_file, input_size=224):
     return pixel_values
 
 
+def get_num_patches(image_file, input_size=224):
+    if not args.dynamic:
+        return 1
+    with Image.open(image_file) as image:
+        return get_dynamic_num_patches(image.size, image_size=input_size,
+                                       use_thumbnail=use_thumbnail,
+                                       max_num=args.max_num)
+
+
 def post_processing(response):
     response = response.replace('\n', '').replace('不是', 'No').replace('是', 'Yes').replace('否', 'No')
     response = response.lower().replace('true', 'yes').replace('false', 'no')
@@ -43,6 +53,7 @@ if __name__ == '__main__':
     parser.add_argument('--sample', type=bool, default=False)
     parser.add_argument('--dynamic', action='store_true')
     parser.add_argument('--max-num', type=int, default=6)
+    parser.add_argument('--batch-size', type=int, default=1)
     parser.add_argument('--load-in-8bit', action='store_true')
     parser.add_argument('--load-in-4bit', action='store_true')
     parser.add_argument('--auto', action='store_true')
@@ -73,12 +84,23 @@ if __name__ == '__main__':
         fout = open(os.path.join(output, filename), 'w', encoding='utf-8')
         lines = fin.readlines()
         filename = filename.replace('.txt', '')
-        for line in tqdm(lines):
+        samples = []
+        for line in lines:
             img, question, gt = line.strip().split('\t')
             question = question + ' ' + prompt
             img_path = os.path.join('../../data/mme/MME_Benchmark_release_version', filename, img)
             assert os.path.exists(img_path), img_path
-            pixel_values = load_image(img_path, image_size).cuda().to(torch.bfloat16)
+            samples.append((img, question, gt, img_path))
+
+        # batch samples of similar length to keep left padding small
+        order = sorted(range(len(samples)), reverse=True,
+                       key=lambda i: (get_num_patches(samples[i][3], image_size), len(samples[i][1])))
+        responses = [None] * len(samples)
+        for start in tqdm(range(0, len(order), args.batch_size)):
+            batch = order[start:start + args.batch_size]
+            pixel_values = [load_image(samples[i][3], image_size) for i in batch]
+            num_patches_list = [_.size(0) for _ in pixel_values]
+            pixel_values = torch.cat(pixel_values, dim=0).cuda().to(torch.bfloat16)
             generation_config = dict(
                 do_sample=args.sample,
                 top_k=args.top_k,
@@ -86,15 +108,20 @@ if __name__ == '__main__':
                 num_beams=args.num_beams,
                 max_new_tokens=20,
                 eos_token_id=tokenizer.eos_token_id,
+                skip_special_tokens=True,
             )
-            response = model.chat(
+            batch_responses = model.batch_chat(
                 tokenizer=tokenizer,
                 pixel_values=pixel_values,
-                question=question,
+                num_patches_list=num_patches_list,
+                questions=[samples[i][1] for i in batch],
                 generation_config=generation_config,
                 verbose=True
             )
-            response = post_processing(response)
+            for i, response in zip(batch, batch_responses):
+                responses[i] = post_processing(response)
+
+        for (img, question, gt, _), response in zip(samples, responses):
             print(img, question, gt, response, sep='\t', file=fout)
         fin.close()
         fout.close()
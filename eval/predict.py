@@ -6,6 +6,9 @@ import torchvision.transforms as T
 from torchvision.transforms.functional import InterpolationMode
 from transformers import AutoTokenizer
 from internvl.model.internvl_chat import ALToLLM
+from internvl.model.internvl_chat.modeling_altollm import convert_image_to_sam_input
+from eval.utils import compute_iou
+from trainers.viz_utils import compute_iou_torch
 
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
@@ -64,6 +67,62 @@ def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnai
     return processed_images
 
 
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def build_transform(input_size):
+    MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
+    transform = T.Compose([
+        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
+        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
+        T.ToTensor(),
+        T.Normalize(mean=MEAN, std=STD)
+    ])
+    return transform
+
+
+def load_image(image, max_num=1, input_size=448):
+    transform = build_transform(input_size=input_size)
+    images = dynamic_preprocess(image, min_num=1, max_num=max_num, image_size=input_size, use_thumbnail=True)
+    pixel_values = [transform(image) for image in images]
+    pixel_values = torch.stack(pixel_values)
+    return pixel_values
+
+
+def encode_sam_image(mask_decoder, pixel_values):
+    image_src = convert_image_to_sam_input(pixel_values)*255   #b,3,1024,1024
+    image_src = mask_decoder.sam.preprocess(image_src)
+    return mask_decoder.sam.image_encoder(image_src)
+
+
+def tokens_to_onehot(tokens, num_tokens=32, codebook_size=1024, device=None):
+    onehot = torch.zeros(len(tokens), num_tokens, codebook_size, dtype=torch.float, device=device)
+    for i, token_ids in enumerate(tokens):
+        if len(token_ids) > 0:
+            # Only fill the first len(token_ids) rows, the rest remain zero
+            token_ids = torch.tensor(token_ids, dtype=torch.long, device=device)
+            onehot[i, :token_ids.size(0)].scatter_(-1, token_ids.unsqueeze(-1), 1.0)
+    return onehot
+
+
+def postprocess_mask(mask_image, gt_mask):
+    #mask_image is numpy array, resize to gt's long side, then clip the padding
+    mask_image = Image.fromarray(mask_image).resize((gt_mask.shape[1], gt_mask.shape[0]), Image.NEAREST)
+    mask_image = np.array(mask_image)
+    # mask_image = mask_image[:gt_mask.shape[0], :gt_mask.shape[1]]
+    mask_image[gt_mask == 255] = 1
+    return mask_image
+
+
+def postprocess_mask_torch(mask_image, gt_mask):
+    """Torch version of postprocess_mask, on the device of the masks"""
+    mask_image = torch.nn.functional.interpolate(mask_image[None, None], size=gt_mask.shape[-2:],
+                                                 mode='nearest-exact')[0, 0]
+    mask_image[gt_mask == 255] = 1
+    return mask_image
+
+
 class Predictor:
     def __init__(self, model_path, max_num=1):
         self.max_num = max_num
@@ -76,66 +135,45 @@ class Predictor:
         self.model.mask_decoder.init_tt_ids(self.tokenizer)
         self.model.eval().cuda()
 
-    def update_metrics(self, mask_images, batch_samples, trackers=None):
+    def postprocess_mask(self, mask_image, gt_mask):
+        return postprocess_mask(mask_image, gt_mask)
+
+    def update_metrics(self, mask_images, batch_samples, trackers=None, return_masks=False):
+        """IoU of every predicted mask with its ground truth, computed on the device of ``mask_images``
+        (a tensor, or a numpy array which is evaluated on the CPU). With ``return_masks`` the binary
+        predicted masks and the per-sample ``(intersection, union)`` pairs are returned as well."""
+        if isinstance(mask_images, np.ndarray):
+            mask_images = torch.from_numpy(mask_images)
         ious = []
-        box_iou_scores = []
+        pred_masks = []
+        counts = []
         for data, mask_image in zip(batch_samples, mask_images):
-            gt_mask = data["mask"]
-            #mask_image is numpy array, resize to gt's long side, then clip the padding
-            mask_image = Image.fromarray(mask_image).resize((gt_mask.shape[1], gt_mask.shape[0]), Image.NEAREST)
-            mask_image = np.array(mask_image)
-            # mask_image = mask_image[:gt_mask.shape[0], :gt_mask.shape[1]]
-            mask_image[gt_mask == 255] = 1
-            intersection, union, iou = self.compute_iou(gt_mask, mask_image)
+            gt_mask = torch.from_numpy(np.asarray(data["mask"])).to(mask_image.device)
+            mask_image = postprocess_mask_torch(mask_image.float(), gt_mask)
+            intersection, union, iou = compute_iou_torch(gt_mask[None], mask_image[None], empty_iou=1.0)
+            intersection, union, iou = intersection.item(), union.item(), iou.item()
             ious.append(iou)
+            counts.append((intersection, union))
+            pred_masks.append((mask_image > 0.5).cpu().numpy())
             if trackers is not None:
                 trackers['intersection'].update(intersection, n=1)
                 trackers['union'].update(union, n=1)
                 trackers['gIoU'].update(iou, n=1)
+        if return_masks:
+            return ious, pred_masks, counts
         return ious
 
     def compute_iou(self, gt_mask, mask_image):
-        gt_mask = gt_mask > 0.5
-        mask_image = mask_image > 0.5
-        intersection = np.logical_and(gt_mask, mask_image)
-        union = np.logical_or(gt_mask, mask_image)
-        intersection = np.sum(intersection)
-        union = np.sum(union)
-        iou = intersection / (union + 1e-10)
-        if union == 0:
-            iou = 1.0
-        return intersection, union, iou
-
-    def predict(self, batch_samples: List[Dict[str, Any]],return_response: bool = False):
-
-        IMAGENET_MEAN = (0.485, 0.456, 0.406)
-        IMAGENET_STD = (0.229, 0.224, 0.225)
-
-        def build_transform(input_size):
-            MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
-            transform = T.Compose([
-                T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-                T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-                T.ToTensor(),
-                T.Normalize(mean=MEAN, std=STD)
-            ])
-            return transform
-
-        transform = build_transform(input_size=448)
+        return compute_iou(gt_mask, mask_image)
 
+    def predict(self, batch_samples: List[Dict[str, Any]],return_response: bool = False, return_tokens: bool = False):
         generation_config = dict(
             max_new_tokens=128, 
             do_sample=False,
             return_ids=True
         )
 
-        def load_image(image):
-            images = dynamic_preprocess(image, min_num=1, max_num=self.max_num, image_size=448, use_thumbnail=True)
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            return pixel_values
-
-        pixel_values = [load_image(data["image"]) for data in batch_samples]
+        pixel_values = [load_image(data["image"], max_num=self.max_num) for data in batch_samples]
         num_patches_list = [pixel_values[i].size(0) for i in range(len(pixel_values))]
         pixel_values = torch.cat(pixel_values, dim=0)
         pixel_values = pixel_values.to(self.model.dtype).to(self.model.device)
@@ -157,6 +195,7 @@ class Predictor:
                                     generation_config=generation_config)
         # print(responses)
         onehot = torch.zeros(completion_ids_rets.size(0),32, 1024, dtype=torch.float, device=completion_ids_rets.device)
+        tokens = [[] for _ in range(completion_ids_rets.size(0))]
         for i,comp_id in enumerate(completion_ids_rets):
             try:
                 start_idx = (comp_id == 92553).nonzero(as_tuple=True)[0][0]
@@ -168,14 +207,15 @@ class Predictor:
                 if valid_len > 0:
                     # Only fill the first valid_len rows, the rest remain zero
                     onehot[i,:valid_len].scatter_(-1, comp_id.unsqueeze(-1), 1.0)
+                tokens[i] = comp_id.tolist()
             except:
                 valid_len = 0
-        image_src = self.model.convert_image_to_sam_input(pixel_values)*255   #b,3,1024,1024
-        image_src = self.model.mask_decoder.sam.preprocess(image_src)  
-        image_embedding = self.model.mask_decoder.sam.image_encoder(image_src)
+        image_embedding = encode_sam_image(self.model.mask_decoder, pixel_values)
         mask_images = self.model.mask_decoder.decode_prob(onehot,image_embedding=image_embedding).mean(dim=1, keepdim=False).detach()
-        for i, valid in enumerate(valid):
-            if not valid:
+        for i, is_valid in enumerate(valid):
+            if not is_valid:
                 mask_images[i] = torch.zeros_like(mask_images[i])
 
+        if return_tokens:
+            return mask_images, tokens, valid
         return mask_images
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+from glob import glob
+
+import numpy as np
+from pycocotools import mask as mask_utils
+
+
+def prompt_hash(prompt):
+    return hashlib.md5(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def encode_rle(binary_mask):
+    rle = mask_utils.encode(np.asfortranarray(binary_mask.astype(np.uint8)))
+    return {"size": [int(s) for s in rle["size"]], "counts": rle["counts"].decode("ascii")}
+
+
+def decode_rle(rle):
+    return mask_utils.decode(_as_coco_rle(rle))
+
+
+def _as_coco_rle(rle):
+    counts = rle["counts"]
+    if not isinstance(counts, bytes):
+        counts = counts.encode("ascii")
+    return {"size": list(rle["size"]), "counts": counts}
+
+
+def compute_iou_rle(gt_rle, pred_rle):
+    """Same result as eval.utils.compute_iou, computed on the run-length encodings."""
+    gt_rle, pred_rle = _as_coco_rle(gt_rle), _as_coco_rle(pred_rle)
+    intersection = int(mask_utils.area(mask_utils.merge([gt_rle, pred_rle], intersect=True)))
+    union = int(mask_utils.area(mask_utils.merge([gt_rle, pred_rle], intersect=False)))
+    iou = intersection / (union + 1e-10)
+    if union == 0:
+        iou = 1.0
+    return intersection, union, iou
+
+
+class PredictionStore:
+    """Append-only jsonl store of per-sample segmentation predictions.
+
+    Every rank appends to its own file ``{store_dir}/{dataset_name}.rank{rank}.jsonl``;
+    loading merges all rank files, so a run can be resumed with a different world size.
+    A record looks like::
+
+        {"id": 12, "prompt_hash": "...", "tokens": [...], "length": 9, "valid": true,
+         "mask": {"size": [h, w], "counts": "..."}, "intersection": 1034, "union": 1210}
+    """
+
+    def __init__(self, store_dir, dataset_name, rank=0):
+        self.store_dir = store_dir
+        self.dataset_name = dataset_name
+        self.rank = rank
+        os.makedirs(store_dir, exist_ok=True)
+        self.path = os.path.join(store_dir, f"{dataset_name}.rank{rank}.jsonl")
+        self._file = None
+
+    def load(self, prompt_hashes=None):
+        """Return {id: record}, dropping records whose prompt no longer matches ``prompt_hashes``."""
+        records = {}
+        pattern = os.path.join(self.store_dir, f"{self.dataset_name}.rank*.jsonl")
+        for path in sorted(glob(pattern)):
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a killed run may leave a truncated last line
+                        continue
+                    idx = record["id"]
+                    if prompt_hashes is not None and (
+                            idx >= len(prompt_hashes) or prompt_hashes[idx] != record["prompt_hash"]):
+                        continue
+                    records[idx] = record
+        return records
+
+    def _truncate_partial_line(self, block_size=1 << 16):
+        """Cut a truncated last line left by a killed run, so appended records start on a new line."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            f.seek(end - 1)
+            if f.read(1) == b"\n":
+                return
+            pos = end
+            while pos > 0:
+                start = max(0, pos - block_size)
+                f.seek(start)
+                newline = f.read(pos - start).rfind(b"\n")
+                if newline >= 0:
+                    pos = start + newline + 1
+                    break
+                pos = start
+            f.truncate(pos)
+
+    def append(self, record):
+        if self._file is None:
+            self._truncate_partial_line()
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,168 @@
+import os
+import hashlib
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from PIL import Image
+from eval.seg_dataset import ReferSegDataset, MOVSegDataset
+from eval.utils import compute_iou, seg_collate_fn
+from eval.prediction_store import PredictionStore, prompt_hash
+from eval.predict import load_image, encode_sam_image, tokens_to_onehot, postprocess_mask
+from eval.evaluate_referseg import init_trackers, update_trackers, print_dataset_results
+from internvl.model.internvl_chat import MaskDecoder
+
+
+class SamEmbeddingCache:
+    """SAM image embeddings stored on disk as fp16 .npy files, one per image and tiling."""
+
+    def __init__(self, cache_dir, max_num=1):
+        self.cache_dir = cache_dir
+        self.max_num = max_num
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, image_path):
+        key = hashlib.md5(f"{os.path.abspath(image_path)}|{self.max_num}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, image_path):
+        path = self.path(image_path)
+        if not os.path.exists(path):
+            return None
+        return torch.from_numpy(np.load(path))
+
+    def put(self, image_path, embedding):
+        path = self.path(image_path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, embedding.to(torch.float16).cpu().numpy())
+        os.replace(tmp_path, path)
+
+
+class ReplayDataset(Dataset):
+    """Pairs stored predictions with their ground truth, and with the image only when no embedding is cached."""
+
+    def __init__(self, dataset, records, cache, max_num=1):
+        self.dataset = dataset
+        self.records = records
+        self.ids = sorted(records.keys())
+        self.cache = cache
+        self.max_num = max_num
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, j):
+        idx = self.ids[j]
+        record = self.records[idx]
+        image_path = self.dataset.get_image_path(idx)
+        embedding = self.cache.get(image_path) if self.cache is not None else None
+        pixel_values = None
+        if embedding is None:
+            pixel_values = load_image(Image.open(image_path).convert("RGB"), max_num=self.max_num)
+        return {
+            "index": idx,
+            "image_path": image_path,
+            "mask": self.dataset.get_mask(idx),
+            "tokens": record["tokens"],
+            "valid": record.get("valid", True),
+            "embedding": embedding,
+            "pixel_values": pixel_values,
+        }
+
+
+@torch.no_grad()
+def replay_worker(mask_decoder, dataset, records, args):
+    trackers = init_trackers()
+    cache = SamEmbeddingCache(args.embedding_cache, args.max_num) if args.embedding_cache else None
+    dataloader = torch.utils.data.DataLoader(
+        dataset=ReplayDataset(dataset, records, cache, max_num=args.max_num),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        drop_last=False,
+        collate_fn=seg_collate_fn,
+    )
+    device = torch.device("cuda")
+    for batch_samples in tqdm(dataloader, desc="Replaying ..."):
+        image_embedding = None
+        if not args.no_sam:
+            missing = [data for data in batch_samples if data["embedding"] is None]
+            if len(missing) > 0:
+                pixel_values = torch.cat([data["pixel_values"] for data in missing], dim=0)
+                pixel_values = pixel_values.to(device, dtype=torch.bfloat16)
+                embeddings = encode_sam_image(mask_decoder, pixel_values)
+                offset = 0
+                for data in missing:
+                    num_patches = data["pixel_values"].size(0)
+                    data["embedding"] = embeddings[offset:offset + num_patches].to(torch.float16).cpu()
+                    offset += num_patches
+                    if cache is not None:
+                        cache.put(data["image_path"], data["embedding"])
+            image_embedding = torch.cat([data["embedding"] for data in batch_samples], dim=0)
+            image_embedding = image_embedding.to(device, dtype=torch.bfloat16)
+
+        onehot = tokens_to_onehot([data["tokens"] for data in batch_samples], device=device)
+        mask_images = mask_decoder.decode_prob(onehot, image_embedding=image_embedding).mean(dim=1, keepdim=False)
+        mask_images = mask_images.float().cpu().numpy()
+
+        for data, mask_image in zip(batch_samples, mask_images):
+            gt_mask = data["mask"]
+            if not data["valid"]:
+                mask_image = np.zeros_like(mask_image)
+            mask_image = postprocess_mask(mask_image, gt_mask) > args.threshold
+            update_trackers(trackers, *compute_iou(gt_mask, mask_image))
+    return trackers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-decode stored ALTo tokens with a (possibly modified) mask decoder.')
+    parser.add_argument('--store-dir', type=str, required=True,
+                        help='prediction store written by evaluate_referseg.py / evaluate_mov.py')
+    parser.add_argument('--decoder-weights', type=str, required=True)
+    parser.add_argument('--config', type=str, default='./config/alto.yaml')
+    parser.add_argument('--benchmark', type=str, default='referseg', choices=['referseg', 'mov'])
+    parser.add_argument('--data-dir', type=str, default='./data/res')
+    parser.add_argument('--image-dir', type=str, default='./data/coco/train2014')
+    parser.add_argument('--datasets', type=str, default='refcoco_val,refcoco_testA,refcoco_testB')
+    parser.add_argument('--text-mode', type=str, default='all')
+    parser.add_argument('--max-num', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--embedding-cache', type=str, default=None,
+                        help='directory for cached SAM image embeddings, reused across sweeps')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--no-sam', action='store_true', help='decode without SAM image conditioning')
+    parser.add_argument('--mask-cache-dir', type=str, default=None,
+                        help='directory of the merged ground-truth mask cache, built on first use')
+    args = parser.parse_args()
+
+    mask_decoder = MaskDecoder.init_model_from_config(
+        model_path=args.decoder_weights,
+        config_path=args.config,
+        need_encoder=False,
+        need_decoder=True,
+        device='cuda',
+        dtype=torch.bfloat16,
+    ).eval()
+
+    for dataset_name in args.datasets.split(','):
+        if args.benchmark == 'referseg':
+            dataset = dataset_name.split('_')[0]
+            split = '_'.join(dataset_name.split('_')[1:])
+            ds = ReferSegDataset(dataset_dir=args.data_dir, image_dir=args.image_dir, refer_seg_data=dataset,
+                                 split=split, text_mode=args.text_mode, mask_cache_dir=args.mask_cache_dir)
+        else:
+            ds = MOVSegDataset(data_path=os.path.join(args.data_dir, f"{dataset_name}.jsonl"),
+                               image_dir=args.image_dir, text_mode=args.text_mode)
+
+        store = PredictionStore(args.store_dir, dataset_name)
+        records = store.load([prompt_hash(ds.get_prompt(i)) for i in range(len(ds))])
+        if len(records) < len(ds):
+            print(f"Warning: only {len(records)}/{len(ds)} samples have stored predictions")
+        trackers = replay_worker(mask_decoder, ds, records, args)
+        print_dataset_results(dataset_name, trackers)
+
+
+if __name__ == "__main__":
+    main()
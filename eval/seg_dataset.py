@@ -6,8 +6,69 @@ from torch.utils.data import Dataset
 from pycocotools import mask
 from PIL import Image, ImageOps
 from glob import glob
+from tqdm import tqdm
 import cv2
 
+
+class MaskRLECache:
+    """Merged ground-truth masks of a dataset stored as COCO RLE in one indexed file.
+
+    ``{prefix}.rle`` holds the concatenated RLE ``counts`` strings and ``{prefix}.idx.npz``
+    their byte offsets and mask sizes, together with the size/mtime of the annotation file
+    the cache was built from, so a stale cache is rebuilt instead of silently reused.
+    Masks are stored binarized (``decode_fn(i) > 0``).
+    """
+
+    # bumped when the stored encoding changes, so caches from older versions are rebuilt
+    version = 2
+
+    def __init__(self, prefix, source_path):
+        self.blob_path = f"{prefix}.rle"
+        self.index_path = f"{prefix}.idx.npz"
+        stat = os.stat(source_path)
+        self.source_key = np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+        self.offsets = None
+        self.sizes = None
+        self.blob = None
+
+    def is_valid(self, num_items):
+        if not (os.path.exists(self.blob_path) and os.path.exists(self.index_path)):
+            return False
+        with np.load(self.index_path) as index:
+            return ("version" in index and int(index["version"]) == self.version
+                    and np.array_equal(index["source_key"], self.source_key)
+                    and len(index["sizes"]) == num_items)
+
+    def build(self, num_items, decode_fn):
+        offsets = np.zeros(num_items + 1, dtype=np.int64)
+        sizes = np.zeros((num_items, 2), dtype=np.int64)
+        tmp_blob_path = f"{self.blob_path}.{os.getpid()}.tmp"
+        with open(tmp_blob_path, "wb") as f:
+            for i in tqdm(range(num_items), desc="Building mask cache"):
+                # overlapping polygons are summed into values > 1, which RLE would split into extra runs
+                m = np.asfortranarray((decode_fn(i) > 0).astype(np.uint8))
+                rle = mask.encode(m)
+                assert np.array_equal(mask.decode(rle), m), f"RLE round trip mismatch for mask {i}"
+                f.write(rle["counts"])
+                offsets[i + 1] = offsets[i] + len(rle["counts"])
+                sizes[i] = rle["size"]
+        tmp_index_path = f"{self.index_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_index_path, offsets=offsets, sizes=sizes, source_key=self.source_key,
+                 version=np.int64(self.version))
+        os.replace(tmp_blob_path, self.blob_path)
+        os.replace(tmp_index_path, self.index_path)
+
+    def load(self):
+        with np.load(self.index_path) as index:
+            self.offsets = index["offsets"]
+            self.sizes = index["sizes"]
+        self.blob = np.memmap(self.blob_path, dtype=np.uint8, mode="r") if self.offsets[-1] > 0 else b""
+
+    def get_rle(self, i):
+        counts = bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+        return {"size": [int(self.sizes[i][0]), int(self.sizes[i][1])], "counts": counts}
+
+
 class ReferSegDataset(Dataset):
     def __init__(
         self,
@@ -15,80 +76,120 @@ class ReferSegDataset(Dataset):
         image_dir,
         refer_seg_data="refcoco||refcoco+||refcocog||grefcoco",
         split="val",
-        text_mode='all'
+        text_mode='all',
+        mask_cache_dir=None,
     ):
         self.image_dir = image_dir
         self.text_mode = text_mode
         if refer_seg_data == "refcocom":
-            self.data = json.load(open(os.path.join(dataset_dir, f"annotations/{split}.json"), "r"))
+            ann_path = os.path.join(dataset_dir, f"annotations/{split}.json")
             self.mask_path_template=os.path.join(dataset_dir,'masks/{}.png')
         else:
-            self.data = json.load(open(os.path.join(dataset_dir, f"{refer_seg_data}/{refer_seg_data}_{split}.json"), "r"))
+            ann_path = os.path.join(dataset_dir, f"{refer_seg_data}/{refer_seg_data}_{split}.json")
+        self.data = json.load(open(ann_path, "r"))
         if refer_seg_data == "grefcoco":
             self.data = [item for item in self.data if len(item['instruction'])>0]
         self.refer_seg_data = refer_seg_data
 
+        # optional cache of the merged ground-truth masks, built once on first use
+        self.mask_cache = None
+        if mask_cache_dir is not None:
+            os.makedirs(mask_cache_dir, exist_ok=True)
+            mask_cache = MaskRLECache(os.path.join(mask_cache_dir, f"{refer_seg_data}_{split}"), ann_path)
+            if not mask_cache.is_valid(len(self.data)):
+                mask_cache.build(len(self.data), self.decode_mask)
+            mask_cache.load()
+            self.mask_cache = mask_cache
+
     def __len__(self):
         return len(self.data)
 
-    def __getitem__(self, i):
-        item = self.data[i]    
+    def get_sentences(self, i):
+        item = self.data[i]
         if self.refer_seg_data == "refcocom":
-            image_path=os.path.join(self.image_dir,item['img_name'])
-            mask_path=self.mask_path_template.format(item['segment_id'])
-            sentences=item['sentences']
-            m_final=(np.array(Image.open(mask_path).convert("L"))/255.0).astype(np.uint8)
-        else:
-            image_info = item['image_info']
-            m_final = np.zeros(
-                            (image_info["height"], image_info["width"])
-                        ).astype(np.uint8)
-            instruction = item['instruction']
-            sentences = [instruction[j]['sent'] for j in range(len(instruction))]
-            if len(sentences) != 0:
-                for ann in item['anns']:
-                    if len(ann["segmentation"]) == 0:
-                        m = np.zeros(
-                            (image_info["height"], image_info["width"])
-                        ).astype(np.uint8)
-                    else:
-                        if type(ann["segmentation"]) == list:  # polygon
-                            rle = mask.frPyObjects(
-                                ann["segmentation"], image_info["height"], image_info["width"], )
-                        else:
-                            rle = ann["segmentation"]
-                            # 处理counts为列表的情况
-                            if isinstance(rle["counts"], list):
-                                # 将counts列表转换为bytes格式
-                                rle = mask.frPyObjects(
-                                    [rle], image_info["height"], image_info["width"]
-                                )
-                            elif not isinstance(rle["counts"], bytes):
-                                rle["counts"] = rle["counts"].encode()
-                        m = mask.decode(rle)
-                        m = np.sum(
-                            m, axis=2
-                        )  # sometimes there are multiple binary map (corresponding to multiple segs)
-                        m = m.astype(np.uint8)  # convert to np.uint8
-                    m_final = m_final | m
-
-            image_path = os.path.join(self.image_dir, image_info['file_name'])
-        image = Image.open(image_path).convert("RGB")
+            return item['sentences']
+        instruction = item['instruction']
+        return [instruction[j]['sent'] for j in range(len(instruction))]
+
+    def get_sentence(self, i):
         sentence = "Meet all the descriptions: "
-        for i, sent in enumerate(sentences):
-            sentence += f"{i+1}. {sent}. "
+        for j, sent in enumerate(self.get_sentences(i)):
+            sentence += f"{j+1}. {sent}. "
+        return sentence
+
+    def get_prompt(self, i):
+        sentence = self.get_sentence(i)
         if self.text_mode == 'adaptive':
             prompt = "Segment <ref>{}</ref> by adaptive length.".format(sentence)
         else:
             prompt = "Segment <ref>{}</ref>.".format(sentence)
+        return prompt
+
+    def get_mask_rle(self, i):
+        if self.mask_cache is None:
+            return None
+        return self.mask_cache.get_rle(i)
+
+    def get_mask(self, i):
+        if self.mask_cache is not None:
+            return mask.decode(self.mask_cache.get_rle(i))
+        return self.decode_mask(i)
+
+    def decode_mask(self, i):
+        item = self.data[i]
+        if self.refer_seg_data == "refcocom":
+            mask_path=self.mask_path_template.format(item['segment_id'])
+            return (np.array(Image.open(mask_path).convert("L"))/255.0).astype(np.uint8)
+
+        image_info = item['image_info']
+        m_final = np.zeros(
+                        (image_info["height"], image_info["width"])
+                    ).astype(np.uint8)
+        if len(self.get_sentences(i)) != 0:
+            for ann in item['anns']:
+                if len(ann["segmentation"]) == 0:
+                    m = np.zeros(
+                        (image_info["height"], image_info["width"])
+                    ).astype(np.uint8)
+                else:
+                    if type(ann["segmentation"]) == list:  # polygon
+                        rle = mask.frPyObjects(
+                            ann["segmentation"], image_info["height"], image_info["width"], )
+                    else:
+                        rle = ann["segmentation"]
+                        # 处理counts为列表的情况
+                        if isinstance(rle["counts"], list):
+                            # 将counts列表转换为bytes格式
+                            rle = mask.frPyObjects(
+                                [rle], image_info["height"], image_info["width"]
+                            )
+                        elif not isinstance(rle["counts"], bytes):
+                            rle["counts"] = rle["counts"].encode()
+                    m = mask.decode(rle)
+                    m = np.sum(
+                        m, axis=2
+                    )  # sometimes there are multiple binary map (corresponding to multiple segs)
+                    m = m.astype(np.uint8)  # convert to np.uint8
+                m_final = m_final | m
+        return m_final
+
+    def get_image_path(self, i):
+        item = self.data[i]
+        if self.refer_seg_data == "refcocom":
+            return os.path.join(self.image_dir,item['img_name'])
+        return os.path.join(self.image_dir, item['image_info']['file_name'])
+
+    def __getitem__(self, i):
+        image = Image.open(self.get_image_path(i)).convert("RGB")
 
         data_dict = {
+            "index":i,
             "image":image,
-            "mask":m_final,
-            "prompt":prompt
+            "mask":self.get_mask(i),
+            "prompt":self.get_prompt(i)
         }
         if self.refer_seg_data == "grefcoco":
-            pre_prompt = "Does the image contain <ref>{}</ref>?\nAnswer \"yes\" or \"no\" directly.".format(sentence)
+            pre_prompt = "Does the image contain <ref>{}</ref>?\nAnswer \"yes\" or \"no\" directly.".format(self.get_sentence(i))
             data_dict["pre_prompt"] = pre_prompt
         return data_dict
 
@@ -110,17 +211,26 @@ class MOVSegDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
-    def __getitem__(self, i):
-        item = self.data[i]
-        image_path = os.path.join(self.image_dir, item["image"])
-        text = ", ".join(item["description"])
+    def get_prompt(self, i):
+        text = ", ".join(self.data[i]["description"])
         if self.text_mode == 'adaptive':
             prompt = "Segment <ref>{}</ref> by adaptive length.".format(text)
         else:
             prompt = "Segment <ref>{}</ref>.".format(text)
+        return prompt
+
+    def get_mask(self, i):
+        mask_path = os.path.join(self.image_dir, self.data[i]["mask"])
+        return (np.array(Image.open(mask_path).convert("L"))/255.0).astype(np.uint8)
+
+    def get_image_path(self, i):
+        return os.path.join(self.image_dir, self.data[i]["image"])
+
+    def __getitem__(self, i):
         data_dict = {
-            "image":Image.open(image_path).convert("RGB"),
-            "prompt":prompt,
-            "mask":(np.array(Image.open(os.path.join(self.image_dir, item["mask"])).convert("L"))/255.0).astype(np.uint8),
+            "index":i,
+            "image":Image.open(self.get_image_path(i)).convert("RGB"),
+            "prompt":self.get_prompt(i),
+            "mask":self.get_mask(i),
         }
         return data_dict
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 
 import numpy as np
@@ -90,6 +91,19 @@ def intersectionAndUnionGPU(output, target, K, ignore_index=255):
     return area_intersection, area_union, area_target
 
 
+def compute_iou(gt_mask, mask_image):
+    gt_mask = gt_mask > 0.5
+    mask_image = mask_image > 0.5
+    intersection = np.logical_and(gt_mask, mask_image)
+    union = np.logical_or(gt_mask, mask_image)
+    intersection = np.sum(intersection)
+    union = np.sum(union)
+    iou = intersection / (union + 1e-10)
+    if union == 0:
+        iou = 1.0
+    return intersection, union, iou
+
+
 class ProgressMeter(object):
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
@@ -119,3 +133,65 @@ def dict_to_cuda(input_dict):
         elif isinstance(v, list) and len(v) > 0:
             input_dict[k] = [ele.cuda(non_blocking=True) if isinstance(ele, torch.Tensor) else ele for ele in v]
     return input_dict
+
+
+def init_eval_distributed():
+    """Initialize torch.distributed when launched by torchrun, return (rank, world_size)."""
+    world_size = int(os.getenv('WORLD_SIZE', '1'))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(
+            backend='nccl',
+            world_size=world_size,
+            rank=int(os.getenv('RANK', '0')),
+        )
+        torch.cuda.set_device(int(os.getenv('LOCAL_RANK', 0)))
+    if dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class InferenceSampler(torch.utils.data.sampler.Sampler):
+    """Split [0, size) into contiguous shards, one per rank, without padding or duplication."""
+
+    def __init__(self, size):
+        self._size = int(size)
+        assert size > 0
+        if dist.is_initialized():
+            self._rank = dist.get_rank()
+            self._world_size = dist.get_world_size()
+        else:
+            self._rank, self._world_size = 0, 1
+        self._local_indices = self._get_local_indices(size, self._world_size, self._rank)
+
+    @staticmethod
+    def _get_local_indices(total_size, world_size, rank):
+        shard_size = total_size // world_size
+        left = total_size % world_size
+        shard_sizes = [shard_size + int(r < left) for r in range(world_size)]
+
+        begin = sum(shard_sizes[:rank])
+        end = min(sum(shard_sizes[:rank + 1]), total_size)
+        return range(begin, end)
+
+    def __iter__(self):
+        yield from self._local_indices
+
+    def __len__(self):
+        return len(self._local_indices)
+
+
+class LengthSortedInferenceSampler(InferenceSampler):
+    """InferenceSampler whose local shard is ordered by `length_fn`, longest first.
+
+    Batches then hold prompts of similar length, which keeps left padding small. Results
+    are keyed by sample id, so the iteration order does not change any output.
+    """
+
+    def __init__(self, size, length_fn):
+        super().__init__(size)
+        self._local_indices = sorted(self._local_indices, key=length_fn, reverse=True)
+
+
+def seg_collate_fn(batches):
+    # keep samples as a list of dicts so PIL images and numpy masks reach the predictor untouched
+    return batches
@@ -238,7 +238,8 @@ class MaskDecoder(ALTo):
     def forward(self, x, image_src=None):
         return self.decode_prob(x, image_src)
 
-    def compute_mask_loss(self, logits, labels, target_masks, image_src=None, dice_loss_weight=0.25, cos2fine=0,lengths=None):
+    def compute_mask_loss(self, logits, labels, target_masks, image_src=None, dice_loss_weight=0.25, cos2fine=0,lengths=None,
+                          image_embedding=None):
         batch_size = logits.shape[0]
         all_probs, valid_mask = self.get_train_tt_probs(logits, labels)
         # Create a mask based on token lengths
@@ -252,7 +253,12 @@ class MaskDecoder(ALTo):
             mask_loss_weight = 0
             valid_mask[0] = True
 
-        valid_pred_masks = self.decode_prob(all_probs[valid_mask], image_src[valid_mask]).mean(dim=1, keepdim=False)
+        if image_embedding is not None:
+            # precomputed SAM embeddings skip the image encoder
+            valid_pred_masks = self.decode_prob(all_probs[valid_mask], image_embedding=image_embedding[valid_mask])
+        else:
+            valid_pred_masks = self.decode_prob(all_probs[valid_mask], image_src[valid_mask])
+        valid_pred_masks = valid_pred_masks.mean(dim=1, keepdim=False)
 
         valid_target_masks = target_masks[valid_mask]
 
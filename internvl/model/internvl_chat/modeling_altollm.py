@@ -33,6 +33,8 @@ class ALToLLM(InternVLChatModel):
             loss_weight: Optional[List] = None,
             loss_reduction_all_gather: Optional[bool] = False,
             target_masks: Optional[torch.Tensor] = None,
+            vit_features: Optional[torch.FloatTensor] = None,
+            sam_embedding: Optional[torch.FloatTensor] = None,
         ):
         if target_masks is not None:
             input_ids, labels, lengths = self.mask_decoder.replace_titok_tokens_adaptive(input_ids, labels, target_masks)
@@ -50,20 +52,27 @@ class ALToLLM(InternVLChatModel):
             return_dict=return_dict,
             statistics=statistics,
             loss_weight=loss_weight,
-            loss_reduction_all_gather=loss_reduction_all_gather
+            loss_reduction_all_gather=loss_reduction_all_gather,
+            vit_features=vit_features,
         )
         logits = outputs.logits
         if target_masks is not None and self.mask_loss_weight > 0:
-            image_src = self.convert_image_to_sam_input(pixel_values)
-            mask_loss = self.mask_decoder.compute_mask_loss(logits[..., :-1, :].contiguous(), labels[..., 1:].contiguous(), target_masks, image_src=image_src,lengths=lengths)
+            if sam_embedding is not None:
+                image_src = None
+                sam_embedding = sam_embedding.to(pixel_values.dtype)
+            else:
+                image_src = self.convert_image_to_sam_input(pixel_values)
+            mask_loss = self.mask_decoder.compute_mask_loss(logits[..., :-1, :].contiguous(), labels[..., 1:].contiguous(), target_masks, image_src=image_src,lengths=lengths,
+                                                            image_embedding=sam_embedding)
             outputs.loss += self.mask_loss_weight * mask_loss
         return outputs
 
 
     def batch_chat(self, tokenizer, pixel_values, questions, generation_config, num_patches_list=None,
                    history=None, return_history=False, IMG_START_TOKEN='<img>', IMG_END_TOKEN='</img>',
-                   IMG_CONTEXT_TOKEN='<IMG_CONTEXT>', verbose=False, image_counts=None):
+                   IMG_CONTEXT_TOKEN='<IMG_CONTEXT>', verbose=False, image_counts=None, vit_features=None):
         return_ids = generation_config.pop('return_ids', False)
+        skip_special_tokens = generation_config.pop('skip_special_tokens', False)
         if history is not None or return_history:
             print('Now multi-turn chat is not supported in batch_chat.')
             raise NotImplementedError
@@ -106,10 +115,11 @@ class ALToLLM(InternVLChatModel):
             pixel_values=pixel_values,
             input_ids=input_ids,
             attention_mask=attention_mask,
+            vit_features=vit_features,
             **generation_config
         )
 
-        responses = tokenizer.batch_decode(sequences)
+        responses = tokenizer.batch_decode(sequences, skip_special_tokens=skip_special_tokens)
         responses = [response.split(template.sep.strip())[0].strip() for response in responses]
 
         if return_ids:
@@ -118,9 +128,13 @@ class ALToLLM(InternVLChatModel):
             return responses
 
     def convert_image_to_sam_input(self, src_image, target_size=(1024,1024)):
-        img_mean = torch.tensor(IMAGENET_MEAN).view(1,3,1,1).to(src_image.device).to(src_image.dtype)
-        img_std = torch.tensor(IMAGENET_STD).view(1,3,1,1).to(src_image.device).to(src_image.dtype)
-        src_image = src_image * img_std + img_mean
-        src_image = torch.nn.functional.interpolate(src_image, size=target_size, mode='bicubic', align_corners=False)
-        return src_image
+        return convert_image_to_sam_input(src_image, target_size)
+
+
+def convert_image_to_sam_input(src_image, target_size=(1024,1024)):
+    img_mean = torch.tensor(IMAGENET_MEAN).view(1,3,1,1).to(src_image.device).to(src_image.dtype)
+    img_std = torch.tensor(IMAGENET_STD).view(1,3,1,1).to(src_image.device).to(src_image.dtype)
+    src_image = src_image * img_std + img_mean
+    src_image = torch.nn.functional.interpolate(src_image, size=target_size, mode='bicubic', align_corners=False)
+    return src_image
         
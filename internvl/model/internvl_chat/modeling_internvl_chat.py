@@ -150,13 +150,14 @@ class InternVLChatModel(PreTrainedModel):
             statistics: Optional[torch.LongTensor] = None,
             loss_weight: Optional[List] = None,
             loss_reduction_all_gather: Optional[bool] = False,
+            vit_features: Optional[torch.FloatTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         image_flags = image_flags.squeeze(-1)
         input_embeds = self.language_model.get_input_embeddings()(input_ids).clone()
 
-        vit_embeds = self.extract_feature(pixel_values)
+        vit_embeds = self.embed_vit_features(pixel_values, vit_features)
         vit_embeds = vit_embeds[image_flags == 1]
         vit_batch_size = pixel_values.shape[0]
 
@@ -265,6 +266,12 @@ class InternVLChatModel(PreTrainedModel):
         return x
 
     def extract_feature(self, pixel_values):
+        vit_embeds = self.extract_vit_features(pixel_values)
+        vit_embeds = self.mlp1(vit_embeds)
+        return vit_embeds
+
+    def extract_vit_features(self, pixel_values):
+        # pixel-shuffled ViT features, i.e. the input of mlp1; this is what the offline feature store holds
         if self.select_layer == -1:
             vit_embeds = self.vision_model(
                 pixel_values=pixel_values,
@@ -281,9 +288,14 @@ class InternVLChatModel(PreTrainedModel):
         vit_embeds = vit_embeds.reshape(vit_embeds.shape[0], h, w, -1)
         vit_embeds = self.pixel_shuffle(vit_embeds, scale_factor=self.downsample_ratio)
         vit_embeds = vit_embeds.reshape(vit_embeds.shape[0], -1, vit_embeds.shape[-1])
-        vit_embeds = self.mlp1(vit_embeds)
         return vit_embeds
 
+    def embed_vit_features(self, pixel_values, vit_features=None):
+        # precomputed features are only valid while the vision model is not being trained
+        if vit_features is not None and not any(p.requires_grad for p in self.vision_model.parameters()):
+            return self.mlp1(vit_features.to(self.mlp1[0].weight.dtype))
+        return self.extract_feature(pixel_values)
+
     def batch_chat(self, tokenizer, pixel_values, questions, generation_config, num_patches_list=None,
                    history=None, return_history=False, IMG_START_TOKEN='<img>', IMG_END_TOKEN='</img>',
                    IMG_CONTEXT_TOKEN='<IMG_CONTEXT>', verbose=False, image_counts=None):
@@ -398,6 +410,7 @@ class InternVLChatModel(PreTrainedModel):
             input_ids: Optional[torch.FloatTensor] = None,
             attention_mask: Optional[torch.LongTensor] = None,
             visual_features: Optional[torch.FloatTensor] = None,
+            vit_features: Optional[torch.FloatTensor] = None,
             generation_config: Optional[GenerationConfig] = None,
             output_hidden_states: Optional[bool] = None,
             **generate_kwargs,
@@ -408,7 +421,7 @@ class InternVLChatModel(PreTrainedModel):
             if visual_features is not None:
                 vit_embeds = visual_features
             else:
-                vit_embeds = self.extract_feature(pixel_values)
+                vit_embeds = self.embed_vit_features(pixel_values, vit_features)
             input_embeds = self.language_model.get_input_embeddings()(input_ids)
             B, N, C = input_embeds.shape
             input_embeds = input_embeds.reshape(B * N, C)
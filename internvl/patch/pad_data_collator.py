@@ -2,26 +2,47 @@
 
 import numpy as np
 import torch
+from torch.utils.data import get_worker_info
 
 IGNORE_INDEX = -100
 
 
-def pad_data_collator(features, pad_id=0):
+def _get_max_item_length(features, max_item_length=None, pad_to_multiple_of=None):
+    if max_item_length:
+        # fixed by the caller, e.g. packed_collate_fn whose cu_seqlens already assume this length
+        return max_item_length
+    max_item_length = max(feat['input_ids'].shape[0] for feat in features)
+    if pad_to_multiple_of:
+        max_item_length = (max_item_length + pad_to_multiple_of - 1) // pad_to_multiple_of * pad_to_multiple_of
+    return max_item_length
+
+
+def _pad_into(features, key, max_item_length, pad_value, dtype):
+    # allocate the batch once and copy each row into its slice
+    out = torch.full((len(features), max_item_length), pad_value, dtype=dtype)
+    for idx, feat in enumerate(features):
+        value = feat[key]
+        out[idx, :value.shape[0]] = value
+    return out
+
+
+def _concat_into(values, pin_memory=False):
+    # pinned host memory needs a CUDA context, which DataLoader workers must not create
+    pin_memory = pin_memory and torch.cuda.is_available() and get_worker_info() is None
+    values = [torch.as_tensor(v) for v in values]
+    shape = (sum(v.shape[0] for v in values),) + tuple(values[0].shape[1:])
+    out = torch.empty(shape, dtype=values[0].dtype, pin_memory=pin_memory)
+    return torch.cat(values, out=out)
+
+
+def pad_data_collator(features, pad_id=0, pad_to_multiple_of=None):
 
     first = features[0]
     batch = {}
 
-    batch_lens = [feat['input_ids'].shape for feat in features]
-    max_item_length = max(batch_lens)[0]
-    for idx in range(len(features)):
-        feat = features[idx]
-        temp_input_ids = torch.LongTensor([pad_id] * max_item_length)
-        temp_input_ids[:feat['input_ids'].shape[0]] = feat['input_ids']
-        feat['input_ids'] = temp_input_ids
-        temp_labels = torch.LongTensor([IGNORE_INDEX] * max_item_length)
-        temp_labels[:feat['labels'].shape[0]] = feat['labels']
-        feat['labels'] = temp_labels
-        feat['attention_mask'] = feat['input_ids'].ne(pad_id)
+    max_item_length = _get_max_item_length(features, pad_to_multiple_of=pad_to_multiple_of)
+    input_ids = _pad_into(features, 'input_ids', max_item_length, pad_id, torch.long)
+    labels = _pad_into(features, 'labels', max_item_length, IGNORE_INDEX, torch.long)
 
     # Special handling for labels.
     # Ensure that tensor is created with the correct type
@@ -40,42 +61,35 @@ def pad_data_collator(features, pad_id=0):
     # Handling of all other possible keys.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in first.items():
-        if k not in ('label', 'label_ids') and v is not None and not isinstance(v, str):
+        if k not in ('label', 'label_ids', 'input_ids', 'labels', 'attention_mask') and \
+                v is not None and not isinstance(v, str):
             if isinstance(v, torch.Tensor):
                 batch[k] = torch.stack([f[k] for f in features])
             elif isinstance(v, np.ndarray):
                 batch[k] = torch.tensor(np.stack([f[k] for f in features]))
             else:
                 batch[k] = torch.tensor([f[k] for f in features])
+    batch['input_ids'] = input_ids
+    batch['labels'] = labels
+    batch['attention_mask'] = input_ids.ne(pad_id)
     return batch
 
 
-def concat_pad_data_collator(features, max_item_length=None, pad_id=0):
+def concat_pad_data_collator(features, max_item_length=None, pad_id=0, pad_to_multiple_of=None, pin_memory=False):
 
     first = features[0]
     batch = {}
 
-    batch_lens = [feat['input_ids'].shape for feat in features]
-    max_item_length = max_item_length or max(batch_lens)[0]
-    for idx in range(len(features)):
-        feat = features[idx]
-        temp_input_ids = torch.LongTensor([pad_id] * max_item_length)
-        temp_input_ids[:feat['input_ids'].shape[0]] = feat['input_ids']
-        feat['input_ids'] = temp_input_ids
-        temp_labels = torch.LongTensor([IGNORE_INDEX] * max_item_length)
-        temp_labels[:feat['labels'].shape[0]] = feat['labels']
-        feat['labels'] = temp_labels
-        feat['attention_mask'] = feat['input_ids'].ne(pad_id)
-
-        if 'position_ids' in feat:
-            temp_position_ids = torch.LongTensor([pad_id] * max_item_length)
-            temp_position_ids[:feat['position_ids'].shape[0]] = feat['position_ids']
-            feat['position_ids'] = temp_position_ids
-
-        if 'loss_weight' in feat:
-            temp_loss_weight = torch.FloatTensor([pad_id] * max_item_length)
-            temp_loss_weight[:feat['loss_weight'].shape[0]] = feat['loss_weight']
-            feat['loss_weight'] = temp_loss_weight
+    max_item_length = _get_max_item_length(features, max_item_length, pad_to_multiple_of)
+    padded = {
+        'input_ids': _pad_into(features, 'input_ids', max_item_length, pad_id, torch.long),
+        'labels': _pad_into(features, 'labels', max_item_length, IGNORE_INDEX, torch.long),
+    }
+    if 'position_ids' in first:
+        padded['position_ids'] = _pad_into(features, 'position_ids', max_item_length, pad_id, torch.long)
+    if 'loss_weight' in first:
+        padded['loss_weight'] = _pad_into(features, 'loss_weight', max_item_length, pad_id, torch.float)
+    padded['attention_mask'] = padded['input_ids'].ne(pad_id)
 
     # Special handling for labels.
     # Ensure that tensor is created with the correct type
@@ -94,6 +108,13 @@ def concat_pad_data_collator(features, max_item_length=None, pad_id=0):
     # Handling of all other possible keys.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in first.items():
+        if k in padded:
+            continue
+        if k in ('vit_features', 'sam_embedding'):
+            # cached features are only usable when every sample of the batch has them
+            if all(k in f for f in features):
+                batch[k] = _concat_into([f[k] for f in features])
+            continue
         if k not in ('label', 'label_ids', 'pixel_values', 'image_flags') and \
                 v is not None and not isinstance(v, str):
             if isinstance(v, torch.Tensor):
@@ -103,14 +124,11 @@ def concat_pad_data_collator(features, max_item_length=None, pad_id=0):
             else:
                 batch[k] = torch.tensor([f[k] for f in features])
         if k in ('pixel_values', 'image_flags'):
-            if isinstance(v, torch.Tensor):
-                batch[k] = torch.concat([f[k] for f in features])
-            elif isinstance(v, np.ndarray):
-                batch[k] = torch.concat(np.stack([f[k] for f in features]))
-            else:
-                batch[k] = torch.concat([f[k] for f in features])
+            # tiles of all samples are written into one (optionally pinned) buffer
+            batch[k] = _concat_into([f[k] for f in features], pin_memory=pin_memory and k == 'pixel_values')
         if isinstance(v, str):
             batch[k] = [f[k] for f in features]
+    batch.update(padded)
     return batch
 
 
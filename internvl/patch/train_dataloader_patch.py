@@ -6,6 +6,15 @@ import transformers
 from torch.utils.data import DataLoader
 from transformers.trainer import is_datasets_available, seed_worker
 
+from .train_sampler_patch import get_train_batch_sampler
+
+
+class EpochDataLoader(DataLoader):
+    """Forwards the trainer's ``set_epoch`` calls to a self-sharding iterable dataset."""
+
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
+
 
 def get_train_dataloader(self) -> DataLoader:
     """
@@ -34,12 +43,24 @@ def get_train_dataloader(self) -> DataLoader:
         'persistent_workers': self.args.dataloader_persistent_workers,
     }
 
+    batch_sampler = None
     if not isinstance(train_dataset, torch.utils.data.IterableDataset):
-        dataloader_params['sampler'] = self._get_train_sampler()
-        dataloader_params['drop_last'] = self.args.dataloader_drop_last
+        batch_sampler = get_train_batch_sampler(self)
+        if batch_sampler is not None:
+            # token budget batching: batches are already sharded and balanced across ranks
+            del dataloader_params['batch_size']
+            dataloader_params['batch_sampler'] = batch_sampler
+        else:
+            dataloader_params['sampler'] = self._get_train_sampler()
+            dataloader_params['drop_last'] = self.args.dataloader_drop_last
         dataloader_params['worker_init_fn'] = seed_worker
 
-    if self.args.use_packed_ds:
+    if getattr(self.args, 'use_tar_shards', False):
+        # tar shards are split across ranks and workers by the dataset itself, and set_epoch only
+        # reaches the workers when they are recreated for every epoch
+        dataloader_params['persistent_workers'] = False
+        return EpochDataLoader(train_dataset, **dataloader_params)
+    if self.args.use_packed_ds or batch_sampler is not None:
         return DataLoader(train_dataset, **dataloader_params)
     return self.accelerator.prepare(DataLoader(train_dataset, **dataloader_params))
 
@@ -94,6 +94,129 @@ class LengthGroupedSampler(Sampler):
         return iter(indices)
 
 
+def batch_padding_stats(batches, lengths):
+    """Fraction of padded tokens and mean number of samples over ``batches``."""
+    real_tokens, padded_tokens = 0, 0
+    for batch in batches:
+        batch_lengths = [lengths[i] for i in batch]
+        real_tokens += sum(batch_lengths)
+        padded_tokens += max(batch_lengths) * len(batch_lengths)
+    padding_fraction = 1 - real_tokens / max(padded_tokens, 1)
+    return padding_fraction, sum(len(batch) for batch in batches) / max(len(batches), 1)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    r"""
+    Batch sampler that fills each per-device batch up to a token budget and an image tile budget instead of a fixed
+    number of samples. The cost of a batch is ``max(length) * batch_size`` tokens, as it is padded to its longest
+    sample, and ``sum(num_tiles)`` tiles.
+
+    Samples are shuffled, sorted by length inside megabatches and packed greedily. Consecutive batches, which have
+    similar lengths, are dealt to the ranks together and the number of batches is truncated to a multiple of
+    ``world_size``, so every rank runs the same number of steps.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        num_tiles: List[int],
+        max_tokens: int,
+        max_tiles: int = 0,
+        max_batch_size: int = 0,
+        world_size: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        megabatch_size: int = 4096,
+    ):
+        self.lengths = lengths
+        self.num_tiles = num_tiles
+        self.max_tokens = max_tokens
+        self.max_tiles = max_tiles
+        self.max_batch_size = max_batch_size
+        self.world_size = world_size
+        self.rank = rank
+        self.seed = seed
+        self.megabatch_size = megabatch_size
+        self.epoch = 0
+        self._batches = None
+
+    def _build_batches(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        batches = []
+        for start in range(0, len(indices), self.megabatch_size):
+            megabatch = sorted(indices[start:start + self.megabatch_size], key=lambda i: self.lengths[i], reverse=True)
+            batch, batch_tiles = [], 0
+            for i in megabatch:
+                # sorted descending, so the first sample of a batch is its longest
+                num_tokens = (len(batch) + 1) * (self.lengths[batch[0]] if batch else self.lengths[i])
+                if batch and (num_tokens > self.max_tokens
+                              or (self.max_tiles > 0 and batch_tiles + self.num_tiles[i] > self.max_tiles)
+                              or (self.max_batch_size > 0 and len(batch) >= self.max_batch_size)):
+                    batches.append(batch)
+                    batch, batch_tiles = [], 0
+                batch.append(i)
+                batch_tiles += self.num_tiles[i]
+            if batch:
+                batches.append(batch)
+
+        # deal groups of world_size neighbouring batches so that ranks step on similar lengths
+        num_groups = len(batches) // self.world_size
+        order = torch.randperm(num_groups, generator=generator).tolist()
+        return [batches[g * self.world_size + self.rank] for g in order]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._build_batches(self.epoch)
+        return len(self._batches)
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._build_batches(self.epoch)
+        batches, self._batches = self._batches, None
+        self.epoch += 1
+        return iter(batches)
+
+    def log_stats(self, fixed_batch_size):
+        """Log the padding of this sampler against LengthGroupedSampler with ``fixed_batch_size``."""
+        batches = self._build_batches(self.epoch)
+        padding, mean_batch_size = batch_padding_stats(batches, self.lengths)
+        indices = get_length_grouped_indices(self.lengths, fixed_batch_size, self.world_size)
+        fixed_batches = [indices[i:i + fixed_batch_size] for i in range(0, len(indices), fixed_batch_size)]
+        fixed_padding, _ = batch_padding_stats(fixed_batches, self.lengths)
+        logger.info(
+            f'[TokenBudgetBatchSampler] {len(batches)} batches per rank, mean batch size {mean_batch_size:.2f}, '
+            f'padding {padding:.2%} (LengthGroupedSampler with batch size {fixed_batch_size}: {fixed_padding:.2%})'
+        )
+
+
+def get_train_batch_sampler(trainer) -> Optional[TokenBudgetBatchSampler]:
+    args = trainer.args
+    if trainer.train_dataset is None or getattr(args, 'max_tokens_per_device', 0) <= 0:
+        return None
+    lengths, num_tiles = [], []
+    for dataset in trainer.train_dataset.datasets:
+        lengths = lengths + dataset.length
+        num_tiles = num_tiles + dataset.num_tiles
+    batch_sampler = TokenBudgetBatchSampler(
+        lengths,
+        num_tiles,
+        max_tokens=args.max_tokens_per_device,
+        max_tiles=args.max_tiles_per_device,
+        world_size=args.world_size,
+        rank=args.process_index,
+        seed=args.seed,
+    )
+    if args.process_index == 0:
+        batch_sampler.log_stats(args.train_batch_size)
+    return batch_sampler
+
+
 # patch trainer
 def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
     if self.train_dataset is None or not has_length(self.train_dataset):
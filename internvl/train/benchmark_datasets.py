@@ -0,0 +1,350 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from functools import partial
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from pycocotools import mask as maskUtils
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+
+def list_collate(batch):
+    return batch
+
+
+def random_image(rng, width, height):
+    # smooth gradients plus noise, so that JPEG sizes are close to natural images
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    phase = rng.uniform(0, 1, size=3).astype(np.float32)
+    image = (x * phase + y * (1 - phase)) % 256 + rng.normal(0, 12, size=(height, width, 3))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def random_polygon(rng, width, height, num_vertices=16):
+    cx, cy = rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height
+    rx, ry = rng.uniform(0.05, 0.3) * width, rng.uniform(0.05, 0.3) * height
+    angles = np.sort(rng.uniform(0, 2 * np.pi, size=num_vertices))
+    radii = rng.uniform(0.6, 1.0, size=num_vertices)
+    xs = np.clip(cx + rx * radii * np.cos(angles), 0, width - 1)
+    ys = np.clip(cy + ry * radii * np.sin(angles), 0, height - 1)
+    return np.stack([xs, ys], axis=1)
+
+
+def random_mask(rng, width, height):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillPoly(mask, [random_polygon(rng, width, height).astype(np.int32)], 1)
+    return mask
+
+
+def make_sa1b_fixture(root, num_images, width, height, anns_per_image, rng):
+    """SA-1B style per-image annotation json files, JPEGs and the data list of SupervisedDataset"""
+    image_dir = os.path.join(root, 'sa1b')
+    os.makedirs(image_dir, exist_ok=True)
+    json_paths = []
+    for i in range(num_images):
+        file_name = f'sa_{i}.jpg'
+        Image.fromarray(random_image(rng, width, height)).save(os.path.join(image_dir, file_name), quality=90)
+        annotations = []
+        for j in range(anns_per_image):
+            rle = maskUtils.encode(np.asfortranarray(random_mask(rng, width, height)))
+            annotations.append({
+                'id': i * anns_per_image + j,
+                'bbox': maskUtils.toBbox(rle).tolist(),
+                'area': int(maskUtils.area(rle)),
+                'segmentation': {'size': rle['size'], 'counts': rle['counts'].decode('ascii')},
+            })
+        json_path = os.path.join(image_dir, f'sa_{i}.json')
+        with open(json_path, 'w') as f:
+            json.dump({'image': {'image_id': i, 'file_name': file_name, 'width': width, 'height': height},
+                       'annotations': annotations}, f)
+        json_paths.append(json_path)
+    data_path = os.path.join(root, 'sa1b.json')
+    with open(data_path, 'w') as f:
+        json.dump(json_paths, f)
+    return data_path
+
+
+def make_sft_fixture(root, num_samples, width, height, num_mask_tokens, rng):
+    """Images, masks and a jsonl in the format of example/anns/seg_data_with_mask.jsonl, plus its meta file"""
+    os.makedirs(os.path.join(root, 'sft', 'images'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'sft', 'masks'), exist_ok=True)
+    annotation = os.path.join(root, 'sft', 'seg_data_with_mask.jsonl')
+    with open(annotation, 'w') as f:
+        for i in range(num_samples):
+            Image.fromarray(random_image(rng, width, height)).save(
+                os.path.join(root, 'sft', 'images', f'{i}.jpg'), quality=90)
+            Image.fromarray(random_mask(rng, width, height) * 255).save(
+                os.path.join(root, 'sft', 'masks', f'{i}.png'))
+            mask_tokens = '<TOK_0>' * num_mask_tokens
+            f.write(json.dumps({
+                'image': f'images/{i}.jpg',
+                'mask': f'masks/{i}.png',
+                'conversations': [
+                    {'from': 'human', 'value': f'<image>\nSegment <ref>object {i}</ref>.'},
+                    {'from': 'gpt', 'value': f'The mask appears at <ALTo_Start>{mask_tokens}<ALTo_End>.'},
+                ],
+            }) + '\n')
+    meta_path = os.path.join(root, 'sft', 'meta.json')
+    with open(meta_path, 'w') as f:
+        json.dump({'bench_sft': {'root': os.path.join(root, 'sft'), 'annotation': annotation,
+                                 'data_augment': False, 'repeat_time': 1, 'length': num_samples}}, f, indent=2)
+    return meta_path
+
+
+def make_refseg_fixture(root, num_samples, width, height, rng):
+    """A refcoco style annotation file over the SFT fixture images, with polygon segmentations"""
+    os.makedirs(os.path.join(root, 'refseg', 'refcoco'), exist_ok=True)
+    data = []
+    for i in range(num_samples):
+        polygon = random_polygon(rng, width, height)
+        data.append({
+            'instruction': [{'sent': f'object {i}'}, {'sent': f'the thing number {i}'}],
+            'image_info': {'file_name': f'{i}.jpg', 'width': width, 'height': height},
+            'anns': [{'segmentation': [polygon.flatten().tolist()]}],
+        })
+    with open(os.path.join(root, 'refseg', 'refcoco', 'refcoco_val.json'), 'w') as f:
+        json.dump(data, f)
+    return os.path.join(root, 'refseg')
+
+
+def count_samples(batch):
+    if isinstance(batch, list):
+        return len(batch)
+    if 'data_index' in batch:  # a pack of PackedDataset
+        return int(batch['data_index'].max().item()) + 1
+    for value in batch.values():
+        if isinstance(value, torch.Tensor):
+            return value.size(0)
+    return 1
+
+
+def run_loader(dataset, num_workers, batch_size, num_samples, warmup, collate_fn=None):
+    """Samples/s and per-sample latency of iterating a DataLoader.
+
+    The latency of a sample is the wait for its batch divided by the batch size, so with
+    ``num_workers=0`` it is the processing time of one sample and with workers the
+    interval at which the training loop would receive samples.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn,
+                        shuffle=False, persistent_workers=False)
+    latencies, total, elapsed = [], 0, 0.0
+    start = time.perf_counter()
+    startup = None
+    last = start
+    for i, batch in enumerate(loader):
+        now = time.perf_counter()
+        n = count_samples(batch)
+        if i < warmup:
+            startup = now - start
+        else:
+            latencies.extend([(now - last) / n] * n)
+            total += n
+            elapsed += now - last
+        last = now
+        if total >= num_samples:
+            break
+    del loader
+    if total == 0:
+        return {'num_samples': 0}
+    latencies = np.array(latencies) * 1000
+    return {
+        'num_samples': total,
+        'samples_per_s': total / elapsed,
+        'startup_s': startup,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        },
+    }
+
+
+def build_sft_datasets(args, meta_path, tokenizer, use_packed_ds):
+    from internvl.train.internvl_chat_finetune import LazySupervisedDataset
+
+    ds_collections = json.loads(open(meta_path).read())
+    return [LazySupervisedDataset(
+        args.conv_style, meta, tokenizer, None,
+        ds_name=ds_name,
+        num_image_token=args.num_image_token,
+        image_size=args.force_image_size,
+        is_train=meta['data_augment'],
+        dynamic_image_size=args.dynamic_image_size,
+        use_thumbnail=args.use_thumbnail,
+        max_dynamic_patch=args.max_dynamic_patch,
+        use_packed_ds=use_packed_ds,
+        distributed_mode=use_packed_ds,
+        force_shuffle=use_packed_ds,
+        train_mask=args.train_mask,
+    ) for ds_name, meta in ds_collections.items()]
+
+
+def load_tokenizer(args):
+    from internvl.train.constants import (BOX_END_TOKEN, BOX_START_TOKEN,
+                                          COODBOOK_SIZE, IMG_CONTEXT_TOKEN,
+                                          IMG_END_TOKEN, IMG_START_TOKEN,
+                                          QUAD_END_TOKEN, QUAD_START_TOKEN,
+                                          REF_END_TOKEN, REF_START_TOKEN,
+                                          SEG_END_TOKEN, SEG_START_TOKEN,
+                                          SEG_TOKEN_TEMPLATE)
+    from transformers import AutoTokenizer
+
+    # same tokenizer setup as internvl_chat_finetune.py
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, add_eos_token=False, trust_remote_code=True,
+                                              use_fast=False)
+    tokenizer.model_max_length = args.max_seq_length
+    token_list = [IMG_START_TOKEN, IMG_END_TOKEN, IMG_CONTEXT_TOKEN,
+                  QUAD_START_TOKEN, QUAD_END_TOKEN, REF_START_TOKEN,
+                  REF_END_TOKEN, BOX_START_TOKEN, BOX_END_TOKEN,
+                  SEG_START_TOKEN, SEG_END_TOKEN]
+    token_list += [SEG_TOKEN_TEMPLATE.format(i) for i in range(COODBOOK_SIZE)]
+    tokenizer.add_tokens(token_list, special_tokens=True)
+    return tokenizer
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data pipelines on synthetic fixtures.')
+    parser.add_argument('--output', type=str, required=True, help='json file with the results')
+    parser.add_argument('--fixture-dir', type=str, default='./bench_fixtures',
+                        help='synthetic data is generated here once and reused, delete it after changing the fixture sizes')
+    parser.add_argument('--benchmarks', type=str, nargs='+',
+                        default=['SupervisedDataset', 'LazySupervisedDataset', 'PackedDataset', 'ReferSegDataset'],
+                        choices=['SupervisedDataset', 'LazySupervisedDataset', 'PackedDataset', 'ReferSegDataset'])
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--num-samples', type=int, default=256, help='samples timed per run, after warmup')
+    parser.add_argument('--warmup', type=int, default=2, help='batches excluded from the timing')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    # SA-1B fixture
+    parser.add_argument('--sa1b-images', type=int, default=64)
+    parser.add_argument('--sa1b-width', type=int, default=2250)
+    parser.add_argument('--sa1b-height', type=int, default=1500)
+    parser.add_argument('--sa1b-anns', type=int, default=60, help='annotations per SA-1B image')
+    # SFT / ReferSeg fixture
+    parser.add_argument('--sft-samples', type=int, default=256)
+    parser.add_argument('--sft-width', type=int, default=640)
+    parser.add_argument('--sft-height', type=int, default=480)
+    parser.add_argument('--num-mask-tokens', type=int, default=32)
+    # LazySupervisedDataset / PackedDataset
+    parser.add_argument('--model-name-or-path', type=str, default=None, help='tokenizer for the SFT datasets')
+    parser.add_argument('--conv-style', type=str, default='internvl2_5')
+    parser.add_argument('--max-seq-length', type=int, default=8192)
+    parser.add_argument('--num-image-token', type=int, default=256)
+    parser.add_argument('--force-image-size', type=int, default=448)
+    parser.add_argument('--dynamic-image-size', action='store_true')
+    parser.add_argument('--use-thumbnail', action='store_true')
+    parser.add_argument('--max-dynamic-patch', type=int, default=12)
+    parser.add_argument('--train-mask', action='store_true')
+    parser.add_argument('--max-packed-tokens', type=int, default=16384)
+    parser.add_argument('--num-images-expected', type=int, default=16)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    fixture_dir = os.path.abspath(args.fixture_dir)
+    if not os.path.exists(os.path.join(fixture_dir, 'done')):
+        print(f'Generating fixtures in {fixture_dir}')
+        make_sa1b_fixture(fixture_dir, args.sa1b_images, args.sa1b_width, args.sa1b_height, args.sa1b_anns, rng)
+        make_sft_fixture(fixture_dir, args.sft_samples, args.sft_width, args.sft_height, args.num_mask_tokens, rng)
+        make_refseg_fixture(fixture_dir, args.sft_samples, args.sft_width, args.sft_height, rng)
+        open(os.path.join(fixture_dir, 'done'), 'w').close()
+
+    benchmarks = {}
+    if 'SupervisedDataset' in args.benchmarks:
+        from omegaconf import OmegaConf
+        from trainers.dataset import SupervisedDataset
+        from trainers.sa1b_index import build_sa1b_index
+
+        data_path = os.path.join(fixture_dir, 'sa1b.json')
+        index_prefix = os.path.join(fixture_dir, 'sa1b_index', 'train')
+        if not os.path.exists(f'{index_prefix}.json'):
+            build_sa1b_index(data_path, index_prefix, num_workers=4)
+        for name, index in [('SupervisedDataset', None), ('SupervisedDataset+index', index_prefix)]:
+            config = OmegaConf.create({'dataset': {'params': {
+                'train_sam1b_path': data_path, 'eval_sam1b_path': data_path,
+                'train_sam1b_index': index, 'eval_sam1b_index': index}}})
+            benchmarks[name] = (partial(SupervisedDataset, config, is_train=True), args.batch_size, None)
+    if 'LazySupervisedDataset' in args.benchmarks or 'PackedDataset' in args.benchmarks:
+        if args.model_name_or_path is None:
+            print('--model-name-or-path is required for LazySupervisedDataset and PackedDataset, skipped')
+        else:
+            from internvl.patch import concat_pad_data_collator
+            from internvl.train.dataset_packed import PackedDataset
+
+            tokenizer = load_tokenizer(args)
+            meta_path = os.path.join(fixture_dir, 'sft', 'meta.json')
+            if 'LazySupervisedDataset' in args.benchmarks:
+                benchmarks['LazySupervisedDataset'] = (
+                    lambda: build_sft_datasets(args, meta_path, tokenizer, False)[0], args.batch_size,
+                    concat_pad_data_collator)
+            if 'PackedDataset' in args.benchmarks:
+                benchmarks['PackedDataset'] = (
+                    lambda: PackedDataset(tokenizer=tokenizer, data_rank=0, data_world_size=1,
+                                          datasets=build_sft_datasets(args, meta_path, tokenizer, True),
+                                          num_images_expected=args.num_images_expected,
+                                          max_packed_tokens=args.max_packed_tokens),
+                    None, None)
+    if 'ReferSegDataset' in args.benchmarks:
+        from eval.seg_dataset import ReferSegDataset
+
+        image_dir = os.path.join(fixture_dir, 'sft', 'images')
+        dataset_dir = os.path.join(fixture_dir, 'refseg')
+        benchmarks['ReferSegDataset'] = (
+            partial(ReferSegDataset, dataset_dir, image_dir, refer_seg_data='refcoco', split='val'),
+            args.batch_size, list_collate)
+        benchmarks['ReferSegDataset+mask_cache'] = (
+            partial(ReferSegDataset, dataset_dir, image_dir, refer_seg_data='refcoco', split='val',
+                    mask_cache_dir=os.path.join(fixture_dir, 'refseg_cache')),
+            args.batch_size, list_collate)
+
+    results = {}
+    for name, (build_fn, batch_size, collate_fn) in benchmarks.items():
+        results[name] = {}
+        for num_workers in args.num_workers:
+            # same seeds for every run, so that runs of different commits read the same samples
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            result = run_loader(build_fn(), num_workers, batch_size, args.num_samples, args.warmup, collate_fn)
+            results[name][str(num_workers)] = result
+            if result['num_samples'] > 0:
+                print(f'{name:<28} workers={num_workers:<3} {result["samples_per_s"]:8.2f} samples/s  '
+                      f'p50={result["latency_ms"]["p50"]:.1f}ms p90={result["latency_ms"]["p90"]:.1f}ms '
+                      f'p99={result["latency_ms"]["p99"]:.1f}ms')
+
+    report = {
+        'git_commit': get_git_commit(),
+        'env': {'python': platform.python_version(), 'torch': torch.__version__, 'cpu_count': os.cpu_count(),
+                'platform': platform.platform()},
+        'args': vars(args),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    tmp_path = f'{args.output}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, args.output)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
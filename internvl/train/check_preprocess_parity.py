@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+
+from transformers import AutoTokenizer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from internvl.train.constants import (BOX_END_TOKEN, BOX_START_TOKEN,
+                                      COODBOOK_SIZE, IMG_CONTEXT_TOKEN,
+                                      IMG_END_TOKEN, IMG_START_TOKEN,
+                                      QUAD_END_TOKEN, QUAD_START_TOKEN,
+                                      REF_END_TOKEN, REF_START_TOKEN,
+                                      SEG_END_TOKEN, SEG_START_TOKEN,
+                                      SEG_TOKEN_TEMPLATE)
+from internvl.train.dataset import (JsonlLines, check_preprocess_parity,
+                                    preprocess_internlm,
+                                    preprocess_internvl2_5)
+
+PREPROCESS_FUNCTIONS = {
+    'internvl2_5': preprocess_internvl2_5,
+    'internlm2-chat': preprocess_internlm,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that fragment splicing reproduces full-text tokenization.')
+    parser.add_argument('--model-name-or-path', type=str, required=True)
+    parser.add_argument('--meta-path', type=str, required=True)
+    parser.add_argument('--conv-style', type=str, default='internvl2_5', choices=list(PREPROCESS_FUNCTIONS.keys()))
+    parser.add_argument('--max-seq-length', type=int, default=8192)
+    parser.add_argument('--num-image-token', type=int, default=256)
+    parser.add_argument('--num-samples', type=int, default=1000, help='samples checked per dataset')
+    parser.add_argument('--use-fast-tokenizer', action='store_true')
+    args = parser.parse_args()
+
+    # same tokenizer setup as internvl_chat_finetune.py
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, add_eos_token=False, trust_remote_code=True,
+                                              use_fast=args.use_fast_tokenizer)
+    tokenizer.model_max_length = args.max_seq_length
+    token_list = [IMG_START_TOKEN, IMG_END_TOKEN, IMG_CONTEXT_TOKEN,
+                  QUAD_START_TOKEN, QUAD_END_TOKEN, REF_START_TOKEN,
+                  REF_END_TOKEN, BOX_START_TOKEN, BOX_END_TOKEN,
+                  SEG_START_TOKEN, SEG_END_TOKEN]
+    token_list += [SEG_TOKEN_TEMPLATE.format(i) for i in range(COODBOOK_SIZE)]
+    tokenizer.add_tokens(token_list, special_tokens=True)
+    preprocess_function = PREPROCESS_FUNCTIONS[args.conv_style]
+
+    def num_image_token_list_fn(conversations):
+        num_image = sum(c['value'].count('<image>') for c in conversations if c['from'] == 'human')
+        return [args.num_image_token] * max(num_image, 1), num_image
+
+    ds_collections = json.loads(open(args.meta_path).read())
+    total_mismatches = 0
+    for ds_name, meta in ds_collections.items():
+        lines = JsonlLines(meta['annotation'])
+        sources_list = []
+        for i in range(min(args.num_samples, len(lines))):
+            data_item = json.loads(lines[i])
+            conversations = data_item['conversations']
+            # the dataset adds a missing placeholder to single-image samples
+            if isinstance(data_item.get('image'), str) and '<image>' not in conversations[0]['value']:
+                conversations[0]['value'] = '<image>\n' + conversations[0]['value']
+            sources_list.append(conversations)
+
+        mismatches = check_preprocess_parity(preprocess_function, args.conv_style, sources_list, tokenizer,
+                                             num_image_token_list_fn, group_by_length=True)
+        total_mismatches += len(mismatches)
+
+        elapsed = []
+        for use_fragments in (False, True):
+            start = time.time()
+            for conversations in sources_list:
+                num_image_token_list, num_image = num_image_token_list_fn(conversations)
+                preprocess_function(args.conv_style, [deepcopy(conversations)], tokenizer, num_image_token_list,
+                                    text_only=num_image == 0, num_image=max(num_image, 1), group_by_length=True,
+                                    use_fragments=use_fragments)
+            elapsed.append(time.time() - start)
+        print(f'{ds_name}: {len(mismatches)}/{len(sources_list)} mismatches {mismatches[:10]}, '
+              f'full text {len(sources_list) / elapsed[0]:.1f} samples/s, '
+              f'fragments {len(sources_list) / elapsed[1]:.1f} samples/s')
+    sys.exit(1 if total_mismatches > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 # copied and modified from https://github.com/OpenGVLab/InternVL
 
+import hashlib
 import io
+import mmap
+import multiprocessing
 
 from transformers.trainer_pt_utils import LabelSmoother
 
@@ -9,12 +12,14 @@ import os
 import random
 import re
 from collections import Counter
+from copy import deepcopy
 from typing import Dict
 
 import cv2
 import imageio
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 import torchvision.transforms as T
 import transformers
@@ -26,6 +31,7 @@ from torchvision.transforms.functional import InterpolationMode
 
 from .constants import (CLIP_MEAN, CLIP_STD, IMAGENET_MEAN, IMAGENET_STD,
                         IMG_CONTEXT_TOKEN, IMG_END_TOKEN, IMG_START_TOKEN,
+                        SEG_END_TOKEN, SEG_START_TOKEN, SEG_TOKEN_TEMPLATE,
                         SIGLIP_MEAN, SIGLIP_STD)
 
 try:
@@ -35,6 +41,11 @@ except ImportError as E:
     print('petrel_client is not installed. If you read data locally instead of from ceph, ignore it.')
 import sys
 
+try:
+    import orjson as json
+except:
+    import json
+
 
 def calculate_ngram_repetition(text, n):
     words = text.split()
@@ -240,6 +251,237 @@ class TCSLoader(object):
             return frames
 
 
+class JsonlLines(object):
+    """Random access to the lines of a jsonl file without holding them in memory.
+
+    Line offsets are cached as an int64 array in ``{path}.offsets.npz`` and rebuilt when
+    the size or mtime of the file changes. Lines are read from a per-process mmap, and
+    slicing, repeating and shuffling only touch ``indices``.
+    """
+
+    def __init__(self, path, indices=None, offsets=None):
+        self.path = path
+        self.offsets = self.load_offsets(path) if offsets is None else offsets
+        num_lines = len(self.offsets) - 1
+        self.indices = np.arange(num_lines, dtype=np.int64) if indices is None else indices
+        self._mmap = None
+        self._pid = None
+
+    @staticmethod
+    def source_key(path):
+        stat = os.stat(path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @classmethod
+    def load_offsets(cls, path):
+        cache_path = f'{path}.offsets.npz'
+        source_key = cls.source_key(path)
+        if os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as cache:
+                    if np.array_equal(cache['source_key'], source_key):
+                        return cache['offsets']
+            except (OSError, ValueError, KeyError):
+                pass
+        offsets = cls.build_offsets(path)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, offsets=offsets, source_key=source_key)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f'[JsonlLines] failed to write offset cache {cache_path}: {e}')
+        return offsets
+
+    @staticmethod
+    def build_offsets(path, chunk_size=64 * 2 ** 20):
+        # offsets[i] is the start of line i, offsets[-1] the end of the file; same lines as readlines()
+        starts = [np.zeros(1, dtype=np.int64)]
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            position = 0
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+                starts.append(newlines.astype(np.int64) + position + 1)
+                position += len(chunk)
+        offsets = np.concatenate(starts)
+        if size == 0:
+            return offsets
+        if offsets[-1] != size:
+            offsets = np.append(offsets, size)
+        return offsets
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_mmap(self):
+        # DataLoader workers must not share the parent's file position, so map once per process
+        if self._mmap is None or self._pid != os.getpid():
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pid = os.getpid()
+        return self._mmap
+
+    def _subset(self, indices):
+        return JsonlLines(self.path, indices=indices, offsets=self.offsets)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._subset(self.indices[i])
+        line = int(self.indices[i])
+        begin, end = self.offsets[line], self.offsets[line + 1]
+        return self._get_mmap()[begin:end].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def repeat(self, repeat_time):
+        if repeat_time < 1:
+            # If repeat_time is less than 1, select a portion of the data
+            return self[:int(len(self) * repeat_time)]
+        assert isinstance(repeat_time, int)
+        return self._subset(np.tile(self.indices, repeat_time))
+
+    def shuffle(self, rng):
+        indices = self.indices.copy()
+        rng.shuffle(indices)
+        return self._subset(indices)
+
+
+_length_worker_state = {}
+
+
+def _init_length_worker(tokenizer, lines, tile_config):
+    _length_worker_state.update(tokenizer=tokenizer, lines=lines, tile_config=tile_config)
+
+
+def estimate_num_tiles(data_item, dynamic_image_size, min_dynamic_patch, max_dynamic_patch,
+                       use_thumbnail, image_size=448, max_num_frame=32):
+    """Number of image tiles ``data_item`` will produce, from the annotation alone.
+
+    Uses ``width``/``height`` when the annotation has them and otherwise assumes the
+    largest tiling, so the estimate never undercounts.
+    """
+    if 'image' in data_item and len(data_item['image']) != 0:
+        images = data_item['image'] if isinstance(data_item['image'], list) else [data_item['image']]
+        if not dynamic_image_size:
+            return len(images)
+        max_num = max_dynamic_patch if len(images) == 1 else max(1, max_dynamic_patch // len(images))
+        if len(images) == 1 and 'width' in data_item and 'height' in data_item:
+            return get_dynamic_num_patches((data_item['width'], data_item['height']), min_num=min_dynamic_patch,
+                                           max_num=max_num, image_size=image_size, use_thumbnail=use_thumbnail)
+        return len(images) * (max_num + int(use_thumbnail and max_num != 1))
+    elif 'video' in data_item and data_item['video'] is not None and data_item['video'] != '':
+        return max_num_frame
+    return 1  # pure text samples carry one blank image
+
+
+def _count_token_lengths(span):
+    tokenizer = _length_worker_state['tokenizer']
+    lines = _length_worker_state['lines']
+    tile_config = _length_worker_state['tile_config']
+    num_image_token = tile_config['num_image_token']
+    lengths = []
+    for i in range(*span):
+        data_item = json.loads(lines[i])
+        num_tiles = estimate_num_tiles(
+            data_item, tile_config['dynamic_image_size'], tile_config['min_dynamic_patch'],
+            tile_config['max_dynamic_patch'], tile_config['use_thumbnail'],
+            image_size=tile_config['image_size'], max_num_frame=tile_config['max_num_frame'])
+        if 'length' in data_item:
+            lengths.append((data_item['length'], num_tiles))  # Use precomputed length if available
+            continue
+        conversations = '\n'.join([temp['value'] for temp in data_item['conversations']])
+        token_length = tokenizer(
+            conversations, return_tensors='pt', padding=False, truncation=False,
+        ).input_ids.size(1)
+        lengths.append((token_length + num_image_token * num_tiles, num_tiles))
+    return lengths
+
+
+def get_token_lengths(raw_data, tokenizer, num_image_token, dynamic_image_size, min_dynamic_patch,
+                      max_dynamic_patch, use_thumbnail, image_size=448, max_num_frame=32,
+                      num_workers=None, chunk_size=4096):
+    """Token length and estimated tile count of every line of ``raw_data.path``.
+
+    Returns two int64 arrays aligned with the lines of the file. They are computed
+    once with a process pool and saved to ``{annotation}.lengths.{key}.npy``, where
+    the key covers the annotation file, the tokenizer and the image settings. A cached
+    file is loaded by rank 0 and broadcast; on a miss every rank tokenizes a strided
+    share of the chunks and the shares are combined with ``all_gather_object``.
+    """
+    tile_config = dict(num_image_token=num_image_token, dynamic_image_size=dynamic_image_size,
+                       min_dynamic_patch=min_dynamic_patch, max_dynamic_patch=max_dynamic_patch,
+                       use_thumbnail=use_thumbnail, image_size=image_size, max_num_frame=max_num_frame)
+    path = raw_data.path
+    key = '|'.join(str(k) for k in [
+        os.path.realpath(path), *JsonlLines.source_key(path).tolist(),
+        type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer), sorted(tile_config.items()),
+    ])
+    key = hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+    cache_path = f'{path}.lengths.{key}.npy'
+
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+    # rank 0 decides, so every rank takes the same branch even without a shared filesystem
+    cached = [os.path.exists(cache_path)]
+    if distributed:
+        dist.broadcast_object_list(cached, src=0)
+
+    if cached[0]:
+        lengths = np.load(cache_path) if rank == 0 else None
+        if distributed:
+            objects = [lengths]
+            dist.broadcast_object_list(objects, src=0)
+            lengths = objects[0]
+        return lengths[:, 0], lengths[:, 1]
+
+    # every rank tokenizes its share of the chunks, so no rank waits in a collective for the whole file
+    lines = JsonlLines(path, offsets=raw_data.offsets)
+    spans = [(start, min(start + chunk_size, len(lines)))
+             for start in range(0, len(lines), chunk_size)]
+    rank_spans = spans[rank::world_size]
+    chunks = []
+    if len(rank_spans) > 0:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        num_workers = num_workers or max(1, min(32, (os.cpu_count() or 1) // local_world_size, len(rank_spans)))
+        print(f'[get_token_lengths] rank {rank} tokenizing {len(rank_spans)}/{len(spans)} chunks of {path} '
+              f'with {num_workers} workers')
+        with multiprocessing.Pool(num_workers, initializer=_init_length_worker,
+                                  initargs=(tokenizer, lines, tile_config)) as pool:
+            chunks = pool.map(_count_token_lengths, rank_spans)
+    chunks = [np.array(chunk, dtype=np.int64).reshape(-1, 2) for chunk in chunks]
+    if distributed:
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, chunks)
+    else:
+        gathered = [chunks]
+    ordered = [None] * len(spans)
+    for r, rank_chunks in enumerate(gathered):
+        ordered[r::world_size] = rank_chunks
+    lengths = np.concatenate(ordered) if len(ordered) > 0 else np.zeros((0, 2), dtype=np.int64)
+
+    if rank == 0:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, lengths)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f'[get_token_lengths] failed to write length cache {cache_path}: {e}')
+    return lengths[:, 0], lengths[:, 1]
+
+
 def expand2square(pil_img, background_color):
     width, height = pil_img.size
     if width == height:
@@ -306,6 +548,143 @@ def build_transform(is_train, input_size, pad2square=False, normalize_type='imag
     return transform
 
 
+# Runs of image context tokens, `<|...|>` markers and `<...>` tags such as <img>, <ALTo_Start> or <TOK_12>.
+_FRAGMENT_PATTERN = re.compile(r'(?:%s)+|<\|[^<>|\s]+\|>|<[^<>\s]+>' % re.escape(IMG_CONTEXT_TOKEN))
+_fragment_tokenizers = {}
+
+
+class FragmentTokenizer(object):
+    """Tokenizes rendered conversations by splicing cached ids for the fixed fragments.
+
+    Image context runs, role markers and ALTo ``<ALTo_Start><TOK_k>...<ALTo_End>`` spans are
+    added tokens, which the tokenizer never merges with their neighbours. Their ids are
+    looked up directly, and only the text between them goes through the tokenizer (one
+    batched call per sample). Text chunks seen more than once, such as system prompts and
+    separators, are memoized; unique questions and answers are not. The result equals ``tokenizer(text, add_special_tokens=False)``; this is
+    verified on probe strings at construction, and ``enabled`` is False when it does not
+    hold for a tokenizer.
+    """
+
+    def __init__(self, tokenizer, max_memo_size=8192):
+        self.tokenizer = tokenizer
+        self.max_memo_size = max_memo_size
+        self.memo = {}
+        # hashes of the chunks tokenized once, a chunk is memoized when it comes back
+        self.seen = set()
+        # tokens that strip surrounding whitespace are left to the tokenizer
+        self.fragment_ids = {}
+        for token_id, token in tokenizer.added_tokens_decoder.items():
+            if not (getattr(token, 'lstrip', False) or getattr(token, 'rstrip', False)
+                    or getattr(token, 'single_word', False)):
+                self.fragment_ids[str(token)] = token_id
+        self.context_id = self.fragment_ids.get(IMG_CONTEXT_TOKEN)
+
+        full_ids = tokenizer('a').input_ids
+        text_ids = tokenizer('a', add_special_tokens=False).input_ids
+        self.prefix_ids, self.suffix_ids = None, None
+        for start in range(len(full_ids) - len(text_ids) + 1):
+            if full_ids[start:start + len(text_ids)] == text_ids:
+                self.prefix_ids, self.suffix_ids = full_ids[:start], full_ids[start + len(text_ids):]
+                break
+        self.enabled = self.context_id is not None and self.prefix_ids is not None and self._check()
+        if not self.enabled:
+            print(f'[FragmentTokenizer] {type(tokenizer).__name__} does not tokenize added tokens independently '
+                  f'of their context, conversations are tokenized as a whole')
+
+    def _check(self):
+        image = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * 3}{IMG_END_TOKEN}'
+        alto = f'{SEG_START_TOKEN}{SEG_TOKEN_TEMPLATE.format(7)}{SEG_TOKEN_TEMPLATE.format(0)}{SEG_END_TOKEN}'
+        probes = [
+            '<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n',
+            f'<|im_start|>user\n{image}\nSegment the <ref>dog</ref> on the left.<|im_end|>\n',
+            f'<|im_start|>user\nImage-1: {image}\n Image-2:{image}  what differs?<|im_end|>\n',
+            f'<|im_start|>assistant\n Sure, it is {alto}.<|im_end|>\n',
+            f'<|im_start|>assistant\n{alto}<|im_end|>\n<|im_start|>user\n<image>\n12 apples<|im_end|>',
+        ]
+        if self.tokenizer.bos_token is not None:
+            probes.append(self.tokenizer.bos_token + probes[0])
+        for probe in probes:
+            expected = self.tokenizer(probe, add_special_tokens=False).input_ids
+            if list(self.encode([probe])[0]) != list(expected):
+                return False
+        return True
+
+    def _split(self, text):
+        pieces, pos = [], 0
+        for match in _FRAGMENT_PATTERN.finditer(text):
+            fragment = match.group(0)
+            if fragment.startswith(IMG_CONTEXT_TOKEN):
+                ids = np.full(len(fragment) // len(IMG_CONTEXT_TOKEN), self.context_id, dtype=np.int64)
+            elif fragment in self.fragment_ids:
+                ids = np.array([self.fragment_ids[fragment]], dtype=np.int64)
+            else:
+                continue  # not an added token, stays part of the text
+            if match.start() > pos:
+                pieces.append(text[pos:match.start()])
+            pieces.append(ids)
+            pos = match.end()
+        if pos < len(text):
+            pieces.append(text[pos:])
+        return pieces
+
+    def encode(self, texts):
+        """Ids of every text in ``texts`` without special tokens, as int64 arrays."""
+        pieces = [self._split(text) for text in texts]
+        chunks = list({piece for text_pieces in pieces for piece in text_pieces
+                       if isinstance(piece, str) and piece not in self.memo})
+        new_ids = {}
+        if len(chunks) > 0:
+            chunk_ids = self.tokenizer(chunks, add_special_tokens=False).input_ids
+            new_ids = {chunk: np.array(ids, dtype=np.int64) for chunk, ids in zip(chunks, chunk_ids)}
+        results = []
+        for text_pieces in pieces:
+            ids = [(new_ids[piece] if piece in new_ids else self.memo[piece]) if isinstance(piece, str) else piece
+                   for piece in text_pieces]
+            results.append(np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.int64))
+        # evict only once the results are assembled, they may use pieces memoized by earlier calls
+        repeated = {}
+        for chunk, ids in new_ids.items():
+            if hash(chunk) in self.seen:
+                repeated[chunk] = ids
+            else:
+                self.seen.add(hash(chunk))
+        if len(self.seen) > 16 * self.max_memo_size:
+            self.seen = set()
+        if len(self.memo) + len(repeated) > self.max_memo_size:
+            self.memo = {}
+        self.memo.update(repeated)
+        return results
+
+    def num_tokens(self, text):
+        """Same as ``len(tokenizer(text).input_ids)``."""
+        return len(self.prefix_ids) + len(self.encode([text])[0]) + len(self.suffix_ids)
+
+    def __call__(self, texts, max_length=None, padding=False):
+        """Same ids as ``tokenizer(texts, truncation=True, max_length=..., padding=...)`` for right padding."""
+        results = []
+        for ids in self.encode(texts):
+            if max_length is not None:
+                ids = ids[:max(max_length - len(self.prefix_ids) - len(self.suffix_ids), 0)]
+            results.append(np.concatenate([self.prefix_ids, ids, self.suffix_ids]).astype(np.int64))
+        if padding == 'max_length':
+            results = [np.pad(ids, (0, max(max_length - len(ids), 0)), constant_values=self.tokenizer.pad_token_id)
+                       for ids in results]
+        elif padding:
+            longest = max(len(ids) for ids in results)
+            results = [np.pad(ids, (0, longest - len(ids)), constant_values=self.tokenizer.pad_token_id)
+                       for ids in results]
+        return results
+
+
+def get_fragment_tokenizer(tokenizer):
+    """Cached ``FragmentTokenizer`` of ``tokenizer``, or None when fragments cannot be spliced for it."""
+    key = (id(tokenizer), len(tokenizer))
+    if key not in _fragment_tokenizers:
+        _fragment_tokenizers[key] = FragmentTokenizer(tokenizer)
+    fragment_tokenizer = _fragment_tokenizers[key]
+    return fragment_tokenizer if fragment_tokenizer.enabled else None
+
+
 def preprocess(
         template_name,
         sources,
@@ -623,7 +1002,8 @@ def preprocess_internlm(
         group_by_length: bool = False,
         use_packed_ds: bool = False,
         ds_name: str = None,
-        num_image: int = 1
+        num_image: int = 1,
+        use_fragments: bool = True
 ) -> Dict:
     conv = get_conv_template(template_name)
     roles = {'human': conv.roles[0], 'gpt': conv.roles[1]}
@@ -653,13 +1033,27 @@ def preprocess_internlm(
         conversations = new_conversations
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
-        padding=False if group_by_length or use_packed_ds else 'max_length',
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    fragment_tokenizer = get_fragment_tokenizer(tokenizer) if use_fragments else None
+    if fragment_tokenizer is not None and tokenizer.padding_side == 'right':
+        # only the text between image runs, role markers and ALTo spans is tokenized
+        input_ids = fragment_tokenizer(
+            conversations,
+            max_length=tokenizer.model_max_length,
+            padding=False if group_by_length or use_packed_ds else 'max_length',
+        )
+        input_ids = torch.from_numpy(np.stack(input_ids))
+        num_tokens = fragment_tokenizer.num_tokens
+    else:
+        input_ids = tokenizer(
+            conversations,
+            return_tensors='pt',
+            padding=False if group_by_length or use_packed_ds else 'max_length',
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+        ).input_ids
+
+        def num_tokens(text):
+            return len(tokenizer(text).input_ids)
     targets = input_ids.clone()
 
     for conversation, target in zip(conversations, targets):
@@ -668,21 +1062,21 @@ def preprocess_internlm(
         target[:cur_len] = IGNORE_TOKEN_ID  # <s>
         parts = conversation.split(conv.roles[1])  # [UNUSED_TOKEN_146]assistant\n
         info = parts[0] + conv.roles[1]
-        temp_len = len(tokenizer(info).input_ids) - 1  # 去除tokenizer的<s>
+        temp_len = num_tokens(info) - 1  # 去除tokenizer的<s>
         target[cur_len: cur_len + temp_len] = IGNORE_TOKEN_ID
         cur_len = cur_len + temp_len
 
         for index in range(1, len(parts) - 1):
             info = parts[index]
             part1, part2 = info.split(conv.roles[0])
-            temp_len = len(tokenizer(part1).input_ids) - 1
+            temp_len = num_tokens(part1) - 1
             cur_len = cur_len + temp_len
             part = conv.roles[0] + part2 + conv.roles[1]
-            temp_len = len(tokenizer(part).input_ids) - 1
+            temp_len = num_tokens(part) - 1
             target[cur_len: cur_len + temp_len] = IGNORE_TOKEN_ID
             cur_len = cur_len + temp_len
         last_info = parts[-1]
-        temp_len = len(tokenizer(last_info).input_ids) - 1
+        temp_len = num_tokens(last_info) - 1
         cur_len = cur_len + temp_len
 
         target[cur_len:] = IGNORE_TOKEN_ID
@@ -713,7 +1107,8 @@ def preprocess_internvl2_5(
         group_by_length: bool = False,
         use_packed_ds: bool = False,
         ds_name: str = None,
-        num_image: int = 1
+        num_image: int = 1,
+        use_fragments: bool = True
 ) -> Dict:
     assert len(sources) == 1, 'process only the first conversations'
     conversations = sources[0]
@@ -761,20 +1156,31 @@ def preprocess_internvl2_5(
         batches[0] = tokenizer.bos_token + batches[0]
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        batches,
-        return_tensors='np',
-        padding=False,
-        max_length=tokenizer.model_max_length,
-        truncation=False,
-    ).input_ids
+    fragment_tokenizer = get_fragment_tokenizer(tokenizer) if use_fragments else None
+    if fragment_tokenizer is not None:
+        # only the text between image runs, role markers and ALTo spans is tokenized
+        input_ids = [np.concatenate([fragment_tokenizer.prefix_ids, item, fragment_tokenizer.suffix_ids])
+                     for item in fragment_tokenizer.encode(batches)]
+        if add_bos_token:  # for InternLM series
+            input_ids = [item[1:] for item in input_ids]
+        ignore_len = fragment_tokenizer.num_tokens('<|im_start|>assistant\n')
+        ignore_len = ignore_len - 1 if add_bos_token else ignore_len
+    else:
+        input_ids = tokenizer(
+            batches,
+            return_tensors='np',
+            padding=False,
+            max_length=tokenizer.model_max_length,
+            truncation=False,
+        ).input_ids
 
-    if add_bos_token:  # for InternLM series
-        input_ids = [item[1:] for item in input_ids]
+        if add_bos_token:  # for InternLM series
+            input_ids = [item[1:] for item in input_ids]
+
+        ignore_ids = tokenizer('<|im_start|>assistant\n', return_tensors='np').input_ids[0]
+        ignore_len = ignore_ids.shape[0] - 1 if add_bos_token else ignore_ids.shape[0]
 
     final_input_ids, final_targets = [], []
-    ignore_ids = tokenizer('<|im_start|>assistant\n', return_tensors='np').input_ids[0]
-    ignore_len = ignore_ids.shape[0] - 1 if add_bos_token else ignore_ids.shape[0]
     for role, input_id in zip(roles, input_ids):
         final_input_ids.append(input_id)
         if role == 'system' or role == 'human':
@@ -806,6 +1212,27 @@ def preprocess_internvl2_5(
     )
 
 
+def check_preprocess_parity(preprocess_function, template_name, sources_list, tokenizer, num_image_token_list_fn,
+                            **kwargs):
+    """Indices of the conversations whose input_ids or labels differ with and without fragment splicing.
+
+    ``num_image_token_list_fn(conversations)`` returns the ``(num_image_token_list, num_image)``
+    of one sample; conversations without images are run with ``text_only=True``.
+    """
+    mismatches = []
+    for idx, conversations in enumerate(sources_list):
+        num_image_token_list, num_image = num_image_token_list_fn(conversations)
+        outputs = []
+        for use_fragments in (False, True):
+            outputs.append(preprocess_function(
+                template_name, [deepcopy(conversations)], tokenizer, num_image_token_list,
+                text_only=num_image == 0, num_image=max(num_image, 1), use_fragments=use_fragments, **kwargs))
+        if not (torch.equal(outputs[0]['input_ids'], outputs[1]['input_ids'])
+                and torch.equal(outputs[0]['labels'], outputs[1]['labels'])):
+            mismatches.append(idx)
+    return mismatches
+
+
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
     best_ratio = (1, 1)
@@ -823,6 +1250,22 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
+def get_dynamic_num_patches(image_wh, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
+    """Number of tiles `dynamic_preprocess` produces for an image of size `image_wh`, without resizing it."""
+    orig_width, orig_height = image_wh
+    aspect_ratio = orig_width / orig_height
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_aspect_ratio = find_closest_aspect_ratio(
+        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
+    if use_thumbnail and blocks != 1:
+        blocks += 1
+    return blocks
+
+
 def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
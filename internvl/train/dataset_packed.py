@@ -3,6 +3,7 @@
 import bisect
 import copy
 import logging
+import time
 from collections import defaultdict
 from typing import List, Union
 
@@ -39,6 +40,101 @@ def get_rank():
     return dist.get_rank()
 
 
+class PackBuffer:
+    """A pack under construction, kept as a list of samples and concatenated once when it is yielded."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.num_tokens = sum(seg['input_ids'].size(0) for seg in segments)
+        self.num_images = sum(seg['pixel_values'].size(0) for seg in segments)
+
+    @classmethod
+    def from_sample(cls, sample):
+        if 'data_index' not in sample:
+            sample['data_index'] = torch.zeros_like(sample['input_ids'])
+        return cls([sample])
+
+    @property
+    def last_index(self):
+        return self.segments[-1]['data_index'][-1].item()
+
+    def append(self, sample):
+        assert self.segments[0].keys() == sample.keys()
+        self.segments.append(sample)
+        self.num_tokens += sample['input_ids'].size(0)
+        self.num_images += sample['pixel_values'].size(0)
+
+    def materialize(self):
+        if len(self.segments) == 1:
+            return self.segments[0]
+        return {k: torch.cat([seg[k] for seg in self.segments]) for k in self.segments[0]}
+
+
+class BufferPool:
+    """Packs under construction, bucketed by number of images and sorted by number of tokens.
+
+    ``pop_best_fit`` returns the pack with the most images, then the most tokens, that still
+    fits a new sample, with one bisect per image count instead of a scan over all packs.
+    Within a bucket packs are also kept in insertion order, so ``pop_first`` matches the
+    order of the former buffer list (most images first, oldest first).
+    """
+
+    def __init__(self, num_images_expected):
+        self.num_images_expected = num_images_expected
+        self.keys = [[] for _ in range(num_images_expected + 1)]  # sorted (num_tokens, seq)
+        self.buffers = [{} for _ in range(num_images_expected + 1)]  # seq -> PackBuffer, in insertion order
+        self.seq = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, buffer):
+        bisect.insort(self.keys[buffer.num_images], (buffer.num_tokens, self.seq))
+        self.buffers[buffer.num_images][self.seq] = buffer
+        self.seq += 1
+        self.size += 1
+
+    def _pop(self, num_images, key):
+        keys = self.keys[num_images]
+        del keys[bisect.bisect_left(keys, key)]
+        self.size -= 1
+        return self.buffers[num_images].pop(key[1])
+
+    def _pop_oldest(self, num_images):
+        seq = next(iter(self.buffers[num_images]))
+        return self._pop(num_images, (self.buffers[num_images][seq].num_tokens, seq))
+
+    def pop_best_fit(self, num_tokens, num_images, max_tokens, allow_overflow=False):
+        max_images = self.num_images_expected - num_images
+        for k in range(max_images, -1, -1):
+            keys = self.keys[k]
+            idx = bisect.bisect_right(keys, (max_tokens - num_tokens, float('inf')))
+            if idx > 0:
+                return self._pop(k, keys[idx - 1])
+        if allow_overflow:
+            # the merged pack will be split by `split_buffer`
+            for k in range(0, max_images + 1):
+                if len(self.keys[k]) > 0:
+                    return self._pop(k, self.keys[k][0])
+        return None
+
+    def num_full(self):
+        return len(self.buffers[self.num_images_expected])
+
+    def pop_full(self):
+        return self._pop_oldest(self.num_images_expected)
+
+    def pop_first(self):
+        for k in range(self.num_images_expected, -1, -1):
+            if len(self.buffers[k]) > 0:
+                return self._pop_oldest(k)
+        raise IndexError('pop from an empty BufferPool')
+
+    def to_list(self):
+        return [buffer for k in range(self.num_images_expected, -1, -1) for buffer in self.buffers[k].values()]
+
+
 class PackedDataset(IterableDataset):
     def __init__(
         self,
@@ -203,40 +299,21 @@ class PackedDataset(IterableDataset):
         self._state_dict['sample_info'][self.datasets[current_dataset_idx].ds_name] += 1
         return current_sample
 
-    def find_buffer(self, buffer_list, new_sample):
-        # NOTE: use `bisect` to search might be faster
-
-        find = False
-        find_idx = -1
-        num_images_current = new_sample['pixel_values'].size(0)
-        for buffer_idx, buffer in enumerate(buffer_list):
-            num_images_buffer = buffer['pixel_values'].size(0)
-            if num_images_buffer + num_images_current <= self.num_images_expected:
-                num_merged_tokens = new_sample['input_ids'].size(0) + buffer['input_ids'].size(0)
-
-                if num_merged_tokens <= self.max_packed_tokens:
-                    find = True
-                    find_idx = buffer_idx
-                    break
-
-                if self.allow_overflow and len(buffer_list) >= self.max_buffer_size // 2:
-                    find = True
-                    find_idx = buffer_idx
-
-        if find:
-            return buffer_list.pop(find_idx)
-        return None
+    def find_buffer(self, buffer_pool, new_sample):
+        return buffer_pool.pop_best_fit(
+            num_tokens=new_sample['input_ids'].size(0),
+            num_images=new_sample['pixel_values'].size(0),
+            max_tokens=self.max_packed_tokens,
+            allow_overflow=self.allow_overflow and len(buffer_pool) >= self.max_buffer_size // 2,
+        )
 
     def update_buffer(self, buffer, new_sample):
         if buffer is None:
             new_sample['data_index'] = torch.zeros_like(new_sample['input_ids'])
-            return new_sample
+            return PackBuffer([new_sample])
 
-        new_sample['data_index'] = torch.ones_like(new_sample['input_ids']) + buffer['data_index'][-1].item()
-
-        assert buffer.keys() == new_sample.keys()
-        for k in buffer:
-            buffer[k] = torch.cat([buffer[k], new_sample[k]])
+        new_sample['data_index'] = torch.ones_like(new_sample['input_ids']) + buffer.last_index
+        buffer.append(new_sample)
         return buffer
 
     @staticmethod
@@ -332,42 +409,37 @@ class PackedDataset(IterableDataset):
         )
         return splitted_buffer
 
-    def update_buffer_list(self, buffer_list, buffer_max_len_list, buffer):
+    def update_buffer_list(self, buffer_pool, buffer_max_len_list, buffer):
         # NOTE: in-place operation
 
-        splitted_buffer = PackedDataset.split_buffer(
-            buffer=buffer,
-            max_tokens=self.max_packed_tokens,
-            img_start_token_id=self.img_start_token_id,
-            img_token_id=self.img_token_id,
-            img_end_token_id=self.img_end_token_id,
-        )
+        if buffer.num_tokens > self.max_packed_tokens:
+            splitted_buffer = PackedDataset.split_buffer(
+                buffer=buffer.materialize(),
+                max_tokens=self.max_packed_tokens,
+                img_start_token_id=self.img_start_token_id,
+                img_token_id=self.img_token_id,
+                img_end_token_id=self.img_end_token_id,
+            )
+            splitted_buffer = [PackBuffer.from_sample(each_buffer) for each_buffer in splitted_buffer]
+        else:
+            splitted_buffer = [buffer]
 
         for each_buffer in splitted_buffer:
-            if each_buffer['pixel_values'].size(0) > self.num_images_expected:
+            if each_buffer.num_images > self.num_images_expected:
                 logger.error(
-                    f"Find a sample with {each_buffer['pixel_values'].size(0)} images, "
+                    f'Find a sample with {each_buffer.num_images} images, '
                     f'which exceeds {self.num_images_expected}'
                 )
                 continue
 
-            if each_buffer['input_ids'].size(0) >= self.max_packed_tokens:
-                assert each_buffer['input_ids'].size(0) == self.max_packed_tokens
+            if each_buffer.num_tokens >= self.max_packed_tokens:
+                assert each_buffer.num_tokens == self.max_packed_tokens
                 buffer_max_len_list.append(each_buffer)
                 continue
 
-            find_idx = len(buffer_list)
-            num_images_new_sample = each_buffer['pixel_values'].size(0)
-            for buffer_idx in range(len(buffer_list)):
-                if buffer_list[buffer_idx]['pixel_values'].size(0) < num_images_new_sample:
-                    find_idx = buffer_idx
-                    break
-            buffer_list.insert(find_idx, each_buffer)
+            buffer_pool.add(each_buffer)
 
-        for i in range(1, len(buffer_list)):
-            assert buffer_list[i-1]['pixel_values'].size(0) >= buffer_list[i]['pixel_values'].size(0)
-
-        return buffer_list, buffer_max_len_list
+        return buffer_pool, buffer_max_len_list
 
     def pad_buffer(self, buffer):
         if buffer['pixel_values'].size(0) == self.num_images_expected:
@@ -392,22 +464,40 @@ class PackedDataset(IterableDataset):
             buffer['custom_infos'] = {self.worker_state_key: copy.deepcopy(custom_infos)}
         return buffer
 
-    def print_log(self, iter_idx, buffer_list):
+    def yield_buffer(self, buffer, buffer_pool=None, pad=False):
+        self._pack_stats['num_packs'] += 1
+        self._pack_stats['num_tokens'] += buffer.num_tokens
+        self._pack_stats['num_images'] += buffer.num_images
+        buffer = buffer.materialize()
+        if pad:
+            buffer = self.pad_buffer(buffer)
+        custom_infos = {'buffer_list': buffer_pool.to_list()} if buffer_pool is not None else None
+        return self.postprocess_buffer(buffer, custom_infos)
+
+    def print_log(self, iter_idx, buffer_pool):
         if iter_idx % self.log_freq != 0:
             return
 
         if self._should_log():
+            stats = self._pack_stats
+            num_packs = max(stats['num_packs'], 1)
+            token_fill = stats['num_tokens'] / (num_packs * self.max_packed_tokens)
+            image_fill = stats['num_images'] / (num_packs * self.num_images_expected)
+            samples_per_sec = iter_idx / max(time.time() - stats['start_time'], 1e-6)
             logger.info(
-                f"{iter_idx=}, {len(buffer_list)=}, {self._state_dict['sample_info']}"
+                f"{iter_idx=}, {len(buffer_pool)=}, {self._state_dict['sample_info']}, "
+                f"packs={stats['num_packs']}, token_fill={token_fill:.3f}, image_fill={image_fill:.3f}, "
+                f'samples/s={samples_per_sec:.1f}'
             )
 
     def __iter__(self):
         iter_idx = 0
-        buffer_list = []
+        buffer_pool = BufferPool(self.num_images_expected)
         buffer_max_len_list = []
+        self._pack_stats = {'num_packs': 0, 'num_tokens': 0, 'num_images': 0, 'start_time': time.time()}
 
         if self._should_log():
-            logger.info(f'Begin to iter, {len(buffer_list)=}')
+            logger.info(f'Begin to iter, {len(buffer_pool)=}')
 
         worker_id = 0 if get_worker_info() is None else get_worker_info().id
         num_workers = 1 if get_worker_info() is None else get_worker_info().num_workers
@@ -436,9 +526,11 @@ class PackedDataset(IterableDataset):
             custom_infos = self.worker_custom_infos[self.worker_state_key]
             # buffer list
             if 'buffer_list' in custom_infos and isinstance(custom_infos['buffer_list'], list):
-                buffer_list = custom_infos['buffer_list']
+                for buffer in custom_infos['buffer_list']:
+                    # checkpoints written before the buffer pool stored concatenated samples
+                    buffer_pool.add(buffer if isinstance(buffer, PackBuffer) else PackBuffer.from_sample(buffer))
                 if self._should_log() and worker_id == 0:
-                    logger.info(f'[{self.worker_state_key}] load buffer list --> {len(buffer_list)=}')
+                    logger.info(f'[{self.worker_state_key}] load buffer list --> {len(buffer_pool)=}')
             # other infos
 
             # reset
@@ -456,57 +548,41 @@ class PackedDataset(IterableDataset):
             try:
                 current_sample = self.next_data(current_dataset_idx)
             except:
-                logger.info(f'All datasets are exhausted, begin to empty the buffer_list ({len(buffer_list)=})')
-                while len(buffer_list) > 0:
-                    if self.strict_mode:
-                        yield self.postprocess_buffer(self.pad_buffer(buffer_list.pop(0)))
-                    else:
-                        yield self.postprocess_buffer(buffer_list.pop(0))
-                logger.info(f'buffer_list is empty! ({len(buffer_list)=})')
+                logger.info(f'All datasets are exhausted, begin to empty the buffer_list ({len(buffer_pool)=})')
+                while len(buffer_pool) > 0:
+                    yield self.yield_buffer(buffer_pool.pop_first(), pad=self.strict_mode)
+                logger.info(f'buffer_list is empty! ({len(buffer_pool)=})')
                 return
 
-            buffer = self.find_buffer(buffer_list, current_sample)
+            buffer = self.find_buffer(buffer_pool, current_sample)
             buffer = self.update_buffer(buffer, current_sample)
-            buffer_list, buffer_max_len_list = self.update_buffer_list(buffer_list, buffer_max_len_list, buffer)
+            buffer_pool, buffer_max_len_list = self.update_buffer_list(buffer_pool, buffer_max_len_list, buffer)
 
             while len(buffer_max_len_list) > 0:
-                if buffer_max_len_list[0]['pixel_values'].size(0) != self.max_packed_tokens:
+                if buffer_max_len_list[0].num_images != self.num_images_expected:
                     logger.debug(
                         f'num tokens of a buffer exceed {self.max_packed_tokens=}, '
-                        f"yield a sample with {buffer_max_len_list[0]['pixel_values'].size(0)} images"
+                        f'yield a sample with {buffer_max_len_list[0].num_images} images'
                     )
-                if self.strict_mode and buffer_max_len_list[0]['pixel_values'].size(0) != self.num_images_expected:
-                    # buffer_max_len_list.pop(0)
-                    yield self.postprocess_buffer(self.pad_buffer(buffer_max_len_list.pop(0)), {'buffer_list': buffer_list})
-                else:
-                    yield self.postprocess_buffer(buffer_max_len_list.pop(0), {'buffer_list': buffer_list})
-
-            while len(buffer_list) > 0 and buffer_list[0]['pixel_values'].size(0) > self.num_images_expected:
-                logger.error(
-                    f"num images of a buffer ({buffer_list[0]['pixel_values'].size(0)}) "
-                    f'is larger than num_images_expected({self.num_images_expected})'
-                )
-                buffer_list.pop(0)
+                yield self.yield_buffer(buffer_max_len_list.pop(0), buffer_pool, pad=self.strict_mode)
 
-            while len(buffer_list) > 0 and buffer_list[0]['pixel_values'].size(0) == self.num_images_expected:
+            while buffer_pool.num_full() > 0:
                 if self.debug_mode:
-                    debug_data = self.postprocess_buffer(buffer_list.pop(0), {'buffer_list': buffer_list})
+                    debug_data = self.yield_buffer(buffer_pool.pop_full(), buffer_pool)
                     while True:
                         yield debug_data.copy()
 
-                yield self.postprocess_buffer(buffer_list.pop(0), {'buffer_list': buffer_list})
+                yield self.yield_buffer(buffer_pool.pop_full(), buffer_pool)
 
-            while len(buffer_list) > self.max_buffer_size:
+            while len(buffer_pool) > self.max_buffer_size:
+                buffer = buffer_pool.pop_first()
                 logger.debug(
                     f'Failed to pack data to exactly {self.num_images_expected} images, '
-                    f"yield a data sample with {buffer_list[0]['pixel_values'].size(0)} images."
+                    f'yield a data sample with {buffer.num_images} images.'
                 )
-                if self.strict_mode:
-                    yield self.postprocess_buffer(self.pad_buffer(buffer_list.pop(0)), {'buffer_list': buffer_list})
-                else:
-                    yield self.postprocess_buffer(buffer_list.pop(0), {'buffer_list': buffer_list})
+                yield self.yield_buffer(buffer, buffer_pool, pad=self.strict_mode)
 
-            self.print_log(iter_idx=iter_idx, buffer_list=buffer_list)
+            self.print_log(iter_idx=iter_idx, buffer_pool=buffer_pool)
             iter_idx += 1
 
     @staticmethod
@@ -516,28 +592,17 @@ class PackedDataset(IterableDataset):
         labels: torch.LongTensor,   # (seq_len,)
         len2weight: callable,
     ):
-        indexes = []
-        cu_seqlens = [0]
-        loss_weight = []
-
-        start = data_index.min()
-        end = data_index.max() + 1
-        for i in range(start, end):
-            num_tokens = (data_index == i).sum().item()
-            indexes.extend(list(range(num_tokens)))
-            cu_seqlens.append(cu_seqlens[-1] + num_tokens)
-            assert num_tokens > 0
-
-            curr_data_index = data_index[cu_seqlens[-2]:cu_seqlens[-2]+num_tokens]
-            assert (curr_data_index == i).all(), data_index
-
-            curr_labels = labels[cu_seqlens[-2]:cu_seqlens[-2]+num_tokens]
-            num_effective_tokens = (curr_labels != IGNORE_TOKEN_ID).sum().item()
-            loss_weight.extend([len2weight(num_effective_tokens)] * num_tokens)
+        # sub-samples must be contiguous and numbered consecutively from data_index.min()
+        values, num_tokens = torch.unique_consecutive(data_index, return_counts=True)
+        assert torch.equal(values, torch.arange(values[0], values[0] + values.numel(), dtype=values.dtype)), data_index
 
-        assert len(indexes) == data_index.size(0), f'{len(indexes)=}, {data_index.size(0)=}'
+        cu_seqlens = torch.cat([num_tokens.new_zeros(1), num_tokens.cumsum(0)])
+        segment_ids = torch.repeat_interleave(torch.arange(num_tokens.numel()), num_tokens)
+        indexes = torch.arange(data_index.size(0)) - cu_seqlens[:-1][segment_ids]
 
-        loss_weight = torch.tensor(loss_weight, dtype=torch.float32)
+        num_effective_tokens = torch.bincount(segment_ids[labels != IGNORE_TOKEN_ID], minlength=num_tokens.numel())
+        loss_weight = torch.tensor([len2weight(n) for n in num_effective_tokens.tolist()], dtype=torch.float32)
+        loss_weight = loss_weight[segment_ids]
         return cu_seqlens, indexes, loss_weight
 
 
@@ -569,7 +634,8 @@ def packed_collate_fn(
     # ensure that the len(features) is equal to the required micro_num
     num_features = len(features)
     while len(features) < micro_num:
-        features.append(copy.deepcopy(features[0]))
+        # a shallow copy is enough: the collators only replace values, they never modify tensors in place
+        features.append(dict(features[0]))
         features[-1]['labels'] = torch.full_like(features[-1]['labels'], IGNORE_TOKEN_ID)
 
     indexes = []
@@ -597,14 +663,15 @@ def packed_collate_fn(
         feat['loss_weight'] = curr_loss_weight
 
         if feat_idx < num_features:
-            num_samples += len(curr_cu_seqlens) - 1
+            num_samples += curr_cu_seqlens.numel() - 1
 
-        if curr_cu_seqlens[-1] < max_item_length:
-            curr_cu_seqlens.append(max_item_length)
-            curr_indexes.extend(list(range(max_item_length - curr_cu_seqlens[-2])))
+        num_tokens = curr_cu_seqlens[-1].item()
+        if num_tokens < max_item_length:
+            curr_cu_seqlens = torch.cat([curr_cu_seqlens, curr_cu_seqlens.new_tensor([max_item_length])])
+            curr_indexes = torch.cat([curr_indexes, torch.arange(max_item_length - num_tokens)])
 
-        indexes.append(torch.tensor(curr_indexes, dtype=torch.long))
-        cu_seqlens.append(torch.tensor(curr_cu_seqlens, dtype=torch.int32))
+        indexes.append(curr_indexes.long())
+        cu_seqlens.append(curr_cu_seqlens.int())
 
         worker_state_key_list.append(feat.pop('worker_state_key'))
         worker_state_dict_list.append(feat.pop('worker_state_dict'))
@@ -0,0 +1,201 @@
+import logging
+import os
+import tarfile
+import traceback
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+try:
+    import orjson as json
+except:
+    import json
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def get_sample_files(data_item, root):
+    """Resolved paths of the files a sample reads, in the order they are stored in a shard.
+
+    Mirrors ``LazySupervisedDataset.get_image_path`` / ``get_mask_path``, so the
+    streamed bytes can be served to the dataset under the same paths.
+    """
+    files = []
+    image = data_item.get('image')
+    if image:
+        for image_path in (image if isinstance(image, list) else [image]):
+            if image_path.startswith('s3://'):
+                files.append(root + image_path)
+            else:
+                files.append(os.path.join(root, image_path))
+    if 'mask' in data_item:
+        files.append(os.path.join(root, data_item['mask']))
+    return files
+
+
+def load_shard_index(shard_dir):
+    with open(os.path.join(shard_dir, 'index.json'), 'r') as f:
+        return json.loads(f.read())
+
+
+def _read_member(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def iter_shard(path, state):
+    """Yield the records of one shard in file order.
+
+    A record holds the location of every member and, unless ``state['lazy']`` is set
+    (fast-forwarding on resume), its bytes, read sequentially from the tar.
+    """
+    with tarfile.open(path, 'r:') as tar:
+        record = None
+        for member in tar:
+            key, name = member.name.split('.', 1)
+            if record is None or record['key'] != key:
+                if record is not None:
+                    yield record
+                record = {'key': key, 'path': path, 'members': {}, 'data': {}}
+            record['members'][name] = (member.offset_data, member.size)
+            if not state['lazy']:
+                record['data'][name] = tar.extractfile(member).read()
+        if record is not None:
+            yield record
+
+
+class TarShardDataset(IterableDataset):
+    """Streams SFT samples from tar shards written by ``write_tar_shards.py``.
+
+    Every (rank, worker) pair reads its own subset of the shards of each dataset front
+    to back and mixes datasets in proportion to their size; a shuffle buffer of
+    ``shuffle_buffer`` samples decorrelates neighbours. Samples are built by the
+    wrapped ``LazySupervisedDataset.get_item`` with the image and mask bytes taken
+    from the shard, so they are identical to ``__getitem__`` on the same row.
+
+    Each worker yields the same number of full batches per epoch, which keeps ranks
+    in step. The stream is a deterministic function of ``(seed, epoch, worker)``, so
+    resuming fast-forwards through the consumed samples without decoding them.
+    """
+
+    def __init__(self, datasets, shard_root, shuffle_buffer=1000, seed=0, data_rank=0, data_world_size=1,
+                 num_workers=0, batch_size=1):
+        super().__init__()
+        self.datasets = datasets
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.data_rank = data_rank
+        self.data_world_size = data_world_size
+        self.num_workers = max(num_workers, 1)
+        self.batch_size = batch_size
+
+        self.shards = []
+        for ds in datasets:
+            shard_dir = os.path.join(shard_root, ds.ds_name)
+            index = load_shard_index(shard_dir)
+            self.shards.append([os.path.join(shard_dir, shard['path']) for shard in index['shards']])
+            if 0 < len(self.shards[-1]) < self.num_workers * data_world_size:
+                logger.warning(f'[{ds.ds_name}] {len(self.shards[-1])} shards for '
+                               f'{self.num_workers * data_world_size} workers, some shards are read by '
+                               f'several workers; write smaller shards to avoid repeated samples')
+        # repeat_time is already applied to len(ds)
+        self.samples_per_epoch = [len(ds) if len(shards) > 0 else 0 for ds, shards in zip(datasets, self.shards)]
+        total_workers = self.num_workers * data_world_size
+        self.worker_quota = sum(self.samples_per_epoch) // total_workers // batch_size * batch_size
+        assert self.worker_quota > 0, f'not enough samples for {total_workers} workers x batch size {batch_size}'
+
+        self.epoch = 0
+        self.resume_epoch = 0
+        self.resume_batches = 0
+
+    def __len__(self):
+        return self.worker_quota * self.num_workers
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def load_trainer_state(self, checkpoint, gradient_accumulation_steps=1):
+        """Resume at the position of ``checkpoint``, with the step bookkeeping of ``transformers.Trainer``."""
+        with open(os.path.join(checkpoint, 'trainer_state.json'), 'r') as f:
+            global_step = json.loads(f.read())['global_step']
+        num_update_steps_per_epoch = max(len(self) // self.batch_size // gradient_accumulation_steps, 1)
+        self.resume_epoch = global_step // num_update_steps_per_epoch
+        self.resume_batches = (global_step % num_update_steps_per_epoch) * gradient_accumulation_steps
+        logger.info(f'resume tar shard stream at epoch {self.resume_epoch}, batch {self.resume_batches}')
+
+    def _num_skip_samples(self, worker_id):
+        if self.epoch != self.resume_epoch or self.resume_batches == 0:
+            return 0
+        # the DataLoader takes batches from its workers round-robin, starting at worker 0
+        num_batches = self.resume_batches // self.num_workers
+        if worker_id < self.resume_batches % self.num_workers:
+            num_batches += 1
+        return min(num_batches * self.batch_size, self.worker_quota)
+
+    def _iter_dataset(self, ds_idx, worker_id, num_workers, rng, state):
+        shards = self.shards[ds_idx]
+        if len(shards) >= num_workers:
+            shards = shards[worker_id::num_workers]
+        else:
+            shards = [shards[worker_id % len(shards)]]
+        while True:
+            for shard_idx in rng.permutation(len(shards)):
+                for record in iter_shard(shards[shard_idx], state):
+                    record['ds_idx'] = ds_idx
+                    yield record
+
+    def get_item(self, record):
+        ds = self.datasets[record['ds_idx']]
+        data = record['data']
+        for name, (offset, size) in record['members'].items():
+            if name not in data:
+                data[name] = _read_member(record['path'], offset, size)
+        data_item = json.loads(data['json'])
+        files = get_sample_files(data_item, ds.root)
+        ds.file_bytes = {files[int(name)]: value for name, value in data.items() if name != 'json'}
+        try:
+            return ds.get_item(data_item)
+        except Exception as e:
+            print(e, ds.ds_name, record['path'], record['key'], flush=True)
+            traceback.print_exc()
+            return None
+        finally:
+            ds.file_bytes = {}
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        assert num_workers == self.num_workers, f'built for {self.num_workers} workers, got {num_workers}'
+        global_worker_id = num_workers * self.data_rank + worker_id
+        total_workers = num_workers * self.data_world_size
+
+        num_skip = self._num_skip_samples(worker_id)
+        state = {'lazy': num_skip > 0}
+        rng = np.random.default_rng([self.seed, self.epoch, global_worker_id])
+        streams = [self._iter_dataset(ds_idx, global_worker_id, total_workers, rng, state)
+                   for ds_idx in range(len(self.datasets))]
+        weights = np.array(self.samples_per_epoch, dtype=np.float64)
+        weights /= weights.sum()
+
+        buffer = []
+        num_samples = 0
+        while num_samples < self.worker_quota:
+            record = next(streams[rng.choice(len(streams), p=weights)])
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            if len(buffer) > 0:
+                idx = rng.integers(len(buffer))
+                record, buffer[idx] = buffer[idx], record
+            if num_samples < num_skip:
+                num_samples += 1
+                state['lazy'] = num_samples < num_skip
+                continue
+            ret = self.get_item(record)
+            if ret is None:
+                continue
+            num_samples += 1
+            yield ret
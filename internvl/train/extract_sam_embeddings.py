@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from internvl.model.internvl_chat import MaskDecoder
+from internvl.model.internvl_chat.modeling_altollm import convert_image_to_sam_input
+from internvl.train.extract_vit_features import (ImageTileDataset,
+                                                 collect_image_paths)
+from internvl.train.vit_feature_store import (SamEmbeddingStore,
+                                              SamEmbeddingStoreWriter)
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='Precompute SAM image embeddings for the stage-2 mask loss.')
+    parser.add_argument('--decoder-weights', type=str, required=True,
+                        help='ALTo checkpoint holding the SAM image encoder')
+    parser.add_argument('--config', type=str, default='./config/alto.yaml')
+    parser.add_argument('--meta-path', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--force-image-size', type=int, default=448)
+    parser.add_argument('--dynamic-image-size', action='store_true')
+    parser.add_argument('--use-thumbnail', action='store_true')
+    parser.add_argument('--min-dynamic-patch', type=int, default=1)
+    parser.add_argument('--max-dynamic-patch', type=int, default=12)
+    parser.add_argument('--pad2square', action='store_true')
+    parser.add_argument('--normalize-type', type=str, default='imagenet')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per forward pass')
+    parser.add_argument('--num-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    rank, world_size = 0, 1
+    if int(os.getenv('WORLD_SIZE', '1')) > 1:
+        dist.init_process_group(backend='nccl')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.cuda.set_device(int(os.getenv('LOCAL_RANK', 0)))
+
+    mask_decoder = MaskDecoder.init_model_from_config(
+        model_path=args.decoder_weights,
+        config_path=args.config,
+        need_encoder=False,
+        need_decoder=False,
+        device='cuda',
+        dtype=torch.bfloat16,
+    ).eval()
+
+    def make_key(image_path):
+        # same key as the ViT feature store, see LazySupervisedDataset.get_vit_feature_key
+        return SamEmbeddingStore.make_key(image_path, args.force_image_size, args.dynamic_image_size,
+                                          args.min_dynamic_patch, args.max_dynamic_patch, args.use_thumbnail,
+                                          pad2square=args.pad2square, normalize_type=args.normalize_type)
+
+    image_paths = collect_image_paths(args.meta_path)[rank::world_size]
+    done = set()
+    if os.path.exists(os.path.join(args.output, 'meta.json')):
+        done = set(SamEmbeddingStore(args.output).index)
+    image_paths = [path for path in image_paths if make_key(path) not in done]
+    print(f'[rank {rank}] {len(image_paths)} images to encode')
+
+    meta = dict(decoder_weights=os.path.abspath(args.decoder_weights))
+    writer = SamEmbeddingStoreWriter(args.output, rank=rank, meta=meta)
+
+    dataloader = DataLoader(ImageTileDataset(image_paths, args), batch_size=args.batch_size,
+                            num_workers=args.num_workers, collate_fn=lambda batch: batch)
+    for batch in tqdm(dataloader, disable=rank != 0):
+        # the mask loss decodes against the first tile of every sample
+        pixel_values = torch.stack([pixel_values[0] for _, pixel_values in batch]).cuda().to(torch.bfloat16)
+        image_src = convert_image_to_sam_input(pixel_values) * 255
+        image_src = mask_decoder.sam.preprocess(image_src)
+        image_embedding = mask_decoder.sam.image_encoder(image_src)
+        for (image_path, _), embedding in zip(batch, image_embedding):
+            writer.add(make_key(image_path), embedding[None])
+    writer.close()
+
+    if world_size > 1:
+        dist.barrier()
+
+
+if __name__ == '__main__':
+    main()
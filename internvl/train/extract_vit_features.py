@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from internvl.model.internvl_chat import ALToLLM, InternVLChatConfig
+from internvl.train.dataset import JsonlLines, build_transform, dynamic_preprocess
+from internvl.train.vit_feature_store import (ViTFeatureStore,
+                                              ViTFeatureStoreWriter)
+
+try:
+    import orjson as json_loader
+except:
+    json_loader = json
+
+
+def collect_image_paths(meta_path):
+    """Single-image samples of the datasets without data augmentation, the only ones the store serves."""
+    image_paths = set()
+    ds_collections = json.loads(open(meta_path).read())
+    for ds_name, meta in ds_collections.items():
+        if meta['data_augment']:
+            print(f'skip {ds_name}: data_augment is enabled')
+            continue
+        for line in JsonlLines(meta['annotation']):
+            data_item = json_loader.loads(line)
+            image = data_item.get('image')
+            if not image or isinstance(image, list):
+                continue
+            # remote images are left to the online ViT path, the store has no entry for them
+            if image.startswith('s3://') or meta['root'].startswith('s3://'):
+                continue
+            image_paths.add(os.path.join(meta['root'], image))
+    return sorted(image_paths)
+
+
+class ImageTileDataset(Dataset):
+
+    def __init__(self, image_paths, args):
+        self.image_paths = image_paths
+        self.args = args
+        self.transform = build_transform(is_train=False, input_size=args.force_image_size,
+                                         pad2square=args.pad2square, normalize_type=args.normalize_type)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        image_path = self.image_paths[idx]
+        image = Image.open(image_path).convert('RGB')
+        if self.args.dynamic_image_size:
+            images = dynamic_preprocess(image, min_num=self.args.min_dynamic_patch,
+                                        max_num=self.args.max_dynamic_patch,
+                                        image_size=self.args.force_image_size,
+                                        use_thumbnail=self.args.use_thumbnail)
+        else:
+            images = [image]
+        pixel_values = torch.stack([self.transform(image) for image in images])
+        return image_path, pixel_values
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='Precompute InternViT features for frozen-backbone training.')
+    parser.add_argument('--model-name-or-path', type=str, required=True)
+    parser.add_argument('--meta-path', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--force-image-size', type=int, default=448)
+    parser.add_argument('--dynamic-image-size', action='store_true')
+    parser.add_argument('--use-thumbnail', action='store_true')
+    parser.add_argument('--min-dynamic-patch', type=int, default=1)
+    parser.add_argument('--max-dynamic-patch', type=int, default=12)
+    parser.add_argument('--pad2square', action='store_true')
+    parser.add_argument('--normalize-type', type=str, default='imagenet')
+    parser.add_argument('--vision-select-layer', type=int, default=-1)
+    parser.add_argument('--ps-version', type=str, default='v2')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per forward pass')
+    parser.add_argument('--num-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    rank, world_size = 0, 1
+    if int(os.getenv('WORLD_SIZE', '1')) > 1:
+        dist.init_process_group(backend='nccl')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.cuda.set_device(int(os.getenv('LOCAL_RANK', 0)))
+
+    config = InternVLChatConfig.from_pretrained(args.model_name_or_path)
+    config.select_layer = args.vision_select_layer
+    config.ps_version = args.ps_version
+    model = ALToLLM.from_pretrained(args.model_name_or_path, torch_dtype=torch.bfloat16, config=config)
+    model.language_model = None
+    model = model.cuda().eval()
+
+    def make_key(image_path):
+        return ViTFeatureStore.make_key(image_path, args.force_image_size, args.dynamic_image_size,
+                                        args.min_dynamic_patch, args.max_dynamic_patch, args.use_thumbnail,
+                                        pad2square=args.pad2square, normalize_type=args.normalize_type)
+
+    image_paths = collect_image_paths(args.meta_path)[rank::world_size]
+    done = set()
+    if os.path.exists(os.path.join(args.output, 'meta.json')):
+        done = set(ViTFeatureStore(args.output).index)
+    image_paths = [path for path in image_paths if make_key(path) not in done]
+    print(f'[rank {rank}] {len(image_paths)} images to encode')
+
+    num_tokens = int((args.force_image_size // config.vision_config.patch_size) ** 2 * config.downsample_ratio ** 2)
+    channels = int(config.vision_config.hidden_size / config.downsample_ratio ** 2)
+    meta = dict(model_name_or_path=os.path.abspath(args.model_name_or_path),
+                select_layer=args.vision_select_layer, ps_version=args.ps_version,
+                downsample_ratio=config.downsample_ratio)
+    writer = ViTFeatureStoreWriter(args.output, num_tokens, channels, rank=rank, meta=meta)
+
+    dataloader = DataLoader(ImageTileDataset(image_paths, args), batch_size=args.batch_size,
+                            num_workers=args.num_workers, collate_fn=lambda batch: batch)
+    for batch in tqdm(dataloader, disable=rank != 0):
+        pixel_values = torch.cat([pixel_values for _, pixel_values in batch]).cuda().to(torch.bfloat16)
+        vit_features = model.extract_vit_features(pixel_values)
+        offset = 0
+        for image_path, pixel_values in batch:
+            num_tiles = pixel_values.size(0)
+            writer.add(make_key(image_path), vit_features[offset:offset + num_tiles])
+            offset += num_tiles
+    writer.close()
+
+    if world_size > 1:
+        dist.barrier()
+
+
+if __name__ == '__main__':
+    main()
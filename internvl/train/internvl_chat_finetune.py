@@ -1,5 +1,6 @@
 # copied and modified from https://github.com/OpenGVLab/InternVL
 
+import io
 import logging
 import math
 import os
@@ -42,14 +43,17 @@ from internvl.train.constants import (BOX_END_TOKEN, BOX_START_TOKEN,
                                       REF_START_TOKEN, SEG_END_TOKEN,
                                       SEG_START_TOKEN, SEG_TOKEN_TEMPLATE,
                                       COODBOOK_SIZE)
-from internvl.train.dataset import (ConcatDataset, TCSLoader,
+from internvl.train.dataset import (ConcatDataset, JsonlLines, TCSLoader,
                                     WeightedConcatDataset, build_transform,
                                     check_conversations_repetition,
-                                    dynamic_preprocess, preprocess,
+                                    dynamic_preprocess, get_token_lengths,
+                                    preprocess,
                                     preprocess_internlm,
                                     preprocess_internvl2_5, preprocess_mpt,
                                     preprocess_phi3)
 from internvl.train.dataset_packed import PackedDataset, packed_collate_fn
+from internvl.train.dataset_tar import TarShardDataset
+from internvl.train.vit_feature_store import SamEmbeddingStore, ViTFeatureStore
 from PIL import Image, ImageFile, PngImagePlugin, UnidentifiedImageError
 from torch.utils.data import Dataset
 from transformers import (AutoConfig, AutoModelForCausalLM, AutoTokenizer,
@@ -274,6 +278,41 @@ class DataTrainingArguments:
         default=False,
         metadata={'help': 'Whether to drop the sample over the specified max_packed_tokens. Default is False.'},
     )
+    max_tokens_per_device: int = field(
+        default=0,
+        metadata={'help': 'Form batches under this padded token budget per device instead of a fixed batch size. '
+                          'Default is 0 (disabled).'},
+    )
+    max_tiles_per_device: int = field(
+        default=0,
+        metadata={'help': 'The image tile budget per device batch when max_tokens_per_device is set. '
+                          'Default is 0 (no limit).'},
+    )
+    pad_to_multiple_of: int = field(
+        default=0,
+        metadata={'help': 'Pad each batch to a multiple of this length (e.g. 8 or 64) so that attention kernels see '
+                          'aligned shapes. Default is 0 (pad to the longest sample).'},
+    )
+    vit_feature_store: Optional[str] = field(
+        default=None,
+        metadata={'help': 'Directory of precomputed ViT features (see extract_vit_features.py), used for datasets '
+                          'without data augmentation when the backbone is frozen. Default is None.'},
+    )
+    sam_embedding_store: Optional[str] = field(
+        default=None,
+        metadata={'help': 'Directory of precomputed SAM image embeddings (see extract_sam_embeddings.py), used by '
+                          'the mask loss for datasets without data augmentation. Default is None.'},
+    )
+    tar_shard_dir: Optional[str] = field(
+        default=None,
+        metadata={'help': 'Directory of tar shards written by write_tar_shards.py. If set, samples are streamed from '
+                          'the shards sequentially instead of reading every image and mask file. Default is None.'},
+    )
+    shuffle_buffer_size: int = field(
+        default=1000,
+        metadata={'help': 'The number of samples in the shuffle buffer of each worker when streaming tar shards. '
+                          'Default is 1000.'},
+    )
     loss_reduction: str = field(
         default='token',
         metadata={'help': 'Loss reduction method. Default is token.'},
@@ -316,6 +355,8 @@ class LazySupervisedDataset(Dataset):
         force_shuffle=False,
         random_seed=0,
         train_mask=False,
+        vit_feature_store=None,
+        sam_embedding_store=None,
     ):
         super(LazySupervisedDataset, self).__init__()
         self.ds_name = ds_name
@@ -353,22 +394,19 @@ class LazySupervisedDataset(Dataset):
         logger.info('Formatting inputs...Skip in lazy mode')
         assert meta['annotation'].endswith('jsonl'), f'annotation must be jsonl, but got {meta["annotation"]}'
 
-        with open(meta['annotation'], 'r') as f:
-            self.raw_data = f.readlines()
-            if repeat_time < 1:
-                # If repeat_time is less than 1, select a portion of the data
-                self.raw_data = self.raw_data[:int(len(self.raw_data) * repeat_time)]
-            if repeat_time > 1:
-                assert isinstance(repeat_time, int)
-                # Repeat the list if repeat_time is greater than 1
-                self.raw_data = self.raw_data * repeat_time
+        # line offsets are indexed once and lines are read through mmap on demand
+        self.raw_data = JsonlLines(meta['annotation'])
+        if repeat_time != 1:
+            self.raw_data = self.raw_data.repeat(repeat_time)
 
         self.rng = np.random.default_rng(seed=random_seed)
         if self.force_shuffle:
-            self.rng.shuffle(self.raw_data)
+            self.raw_data = self.raw_data.shuffle(self.rng)
 
         self.root = meta['root']
         self.cached_data_dict = {}
+        # image/mask bytes of the current sample when it is streamed from a tar shard, keyed by resolved path
+        self.file_bytes = {}
         self.tcs_loader = tcs_loader
         self.group_by_length = group_by_length
         self.dynamic_image_size = dynamic_image_size
@@ -377,29 +415,26 @@ class LazySupervisedDataset(Dataset):
         self.max_dynamic_patch = max_dynamic_patch
         self.normalize_type = normalize_type
         self.train_mask = train_mask
-
-        # If the precomputed length does not exist, roughly estimate the length of
-        # each sample to improve the efficiency of group_by_length.
+        # precomputed ViT features only match the eval-style transform, so skip them for augmented datasets
+        self.vit_feature_store = None
+        if vit_feature_store is not None and not is_train:
+            self.vit_feature_store = ViTFeatureStore(vit_feature_store)
+            logger.info(f'[Dataset] {ds_name} reads ViT features from {vit_feature_store} '
+                        f'({len(self.vit_feature_store)} images)')
+        self.sam_embedding_store = None
+        if sam_embedding_store is not None and train_mask and not is_train:
+            self.sam_embedding_store = SamEmbeddingStore(sam_embedding_store)
+            logger.info(f'[Dataset] {ds_name} reads SAM embeddings from {sam_embedding_store} '
+                        f'({len(self.sam_embedding_store)} images)')
+
+        # Token lengths for group_by_length are computed once, cached next to the
+        # annotation file and broadcast from rank 0.
         if self.group_by_length:
-            self.conv2length = {}  # Using a dictionary to speed up token length calculation
-            self.length = []
-            for data_item in self.raw_data:
-                data_item = json.loads(data_item)
-                if 'length' in data_item:
-                    token_length = data_item['length']  # Use precomputed length if available
-                else:
-                    # Compute token length using the tokenizer
-                    conversations = '\n'.join([temp['value'] for temp in data_item['conversations']])
-                    str_length = len(conversations)
-                    if str_length not in self.conv2length:
-                        token_length = tokenizer(
-                            conversations, return_tensors='pt', padding=False, truncation=False,
-                        ).input_ids.size(1)
-                        self.conv2length[str_length] = token_length + num_image_token * (
-                                    max_dynamic_patch + use_thumbnail)
-                    else:
-                        token_length = self.conv2length[str_length]
-                self.length.append(token_length)
+            lengths, num_tiles = get_token_lengths(
+                self.raw_data, tokenizer, num_image_token, dynamic_image_size, min_dynamic_patch,
+                max_dynamic_patch, use_thumbnail, image_size=image_size, max_num_frame=max_num_frame)
+            self.length = lengths[self.raw_data.indices].tolist()
+            self.num_tiles = num_tiles[self.raw_data.indices].tolist()
 
     def __len__(self):
         return len(self.raw_data)
@@ -419,11 +454,24 @@ class LazySupervisedDataset(Dataset):
         return preprocess_function
 
     def load_image(self, image_path):
+        if image_path in self.file_bytes:
+            return Image.open(io.BytesIO(self.file_bytes[image_path])).convert('RGB')
         # Load the image using tcs_loader if available, otherwise use PIL
         if self.tcs_loader is not None and 's3://' in image_path:
             return self.tcs_loader(image_path)
         return Image.open(image_path).convert('RGB')
 
+    def load_mask(self, mask_path):
+        if mask_path in self.file_bytes:
+            mask = Image.open(io.BytesIO(self.file_bytes[mask_path]))
+        else:
+            mask = Image.open(mask_path)
+        mask = mask.convert('L').resize((256,256))
+        return torch.from_numpy(np.array(mask) / 255.0)
+
+    def get_mask_path(self, mask_path):
+        return os.path.join(self.root, mask_path)
+
     def get_image_path(self, image_path):
         if image_path.startswith('s3://'):  # for ceph
             image_path = self.root + image_path
@@ -431,6 +479,11 @@ class LazySupervisedDataset(Dataset):
             image_path = os.path.join(self.root, image_path)
         return image_path
 
+    def get_vit_feature_key(self, image_path):
+        return ViTFeatureStore.make_key(image_path, self.image_size, self.dynamic_image_size,
+                                        self.min_dynamic_patch, self.max_dynamic_patch, self.use_thumbnail,
+                                        pad2square=self.pad2square, normalize_type=self.normalize_type)
+
     def get_transform(self):
         # Build transformation function
         transform = build_transform(is_train=self.is_train, input_size=self.image_size,
@@ -490,6 +543,14 @@ class LazySupervisedDataset(Dataset):
             pixel_values=pixel_values,
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long)
         )
+        if self.vit_feature_store is not None:
+            vit_features = self.vit_feature_store.get(self.get_vit_feature_key(image_path))
+            if vit_features is not None and vit_features.size(0) == num_patches:
+                ret['vit_features'] = vit_features
+        if self.sam_embedding_store is not None:
+            sam_embedding = self.sam_embedding_store.get(self.get_vit_feature_key(image_path))
+            if sam_embedding is not None:
+                ret['sam_embedding'] = sam_embedding
         return ret
 
     def multi_modal_multi_image_get_item(self, data_item):
@@ -651,6 +712,25 @@ class LazySupervisedDataset(Dataset):
             self.raw_data = self.raw_data[self.worker_id::self.num_workers]
             logger.info(f'worker_distributed is enabled, {self.num_workers=}, {len(self.raw_data)=}')
 
+    def get_item(self, data_item):
+        # conversations = data_item['conversations']
+        # check_conversations_repetition(conversations, repeat_threshold=0.4, ngram=10)
+        if 'image' in data_item and len(data_item['image']) != 0:
+            if type(data_item['image']) == list:
+                ret = self.multi_modal_multi_image_get_item(data_item)
+            else:
+                ret = self.multi_modal_get_item(data_item)
+        elif 'video' in data_item and data_item['video'] is not None and data_item['video'] != '':
+            ret = self.video_get_item(data_item)
+        else:
+            ret = self.pure_text_get_item(data_item)
+        if self.train_mask:
+            if "mask" in data_item:
+                ret['target_masks'] = self.load_mask(self.get_mask_path(data_item["mask"]))
+            else:
+                ret['target_masks'] = torch.zeros((256,256))
+        return ret
+
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         if i >= len(self.raw_data):
             if self.use_packed_ds:
@@ -664,25 +744,7 @@ class LazySupervisedDataset(Dataset):
                 raise StopIteration
             try:
                 data_item = json.loads(self.raw_data[i])
-                # conversations = data_item['conversations']
-                # check_conversations_repetition(conversations, repeat_threshold=0.4, ngram=10)
-                if 'image' in data_item and len(data_item['image']) != 0:
-                    if type(data_item['image']) == list:
-                        ret = self.multi_modal_multi_image_get_item(data_item)
-                    else:
-                        ret = self.multi_modal_get_item(data_item)
-                elif 'video' in data_item and data_item['video'] is not None and data_item['video'] != '':
-                    ret = self.video_get_item(data_item)
-                else:
-                    ret = self.pure_text_get_item(data_item)
-                if self.train_mask:
-                    if "mask" in data_item:
-                        mask = os.path.join(self.root, data_item["mask"])
-                        mask = Image.open(mask).convert('L').resize((256,256))
-                        mask = np.array(mask) / 255.0
-                        ret['target_masks'] = torch.from_numpy(mask)
-                    else:
-                        ret['target_masks'] = torch.zeros((256,256))
+                ret = self.get_item(data_item)
                 break
             except Exception as e:
                 try_cnt += 1
@@ -739,6 +801,11 @@ def build_datasets(
     min_num_frame=8,
     max_num_frame=32,
     normalize_type='imagenet',
+    vit_feature_store=None,
+    sam_embedding_store=None,
+    batch_size=1,
+    num_workers=0,
+    seed=0,
 ):
     datasets = []
     lengths = []
@@ -761,7 +828,8 @@ def build_datasets(
             image_size=data_args.force_image_size,
             is_train=ds_collections[ds_name]['data_augment'],
             pad2square=data_args.pad2square,
-            group_by_length=group_by_length and not data_args.use_packed_ds,
+            group_by_length=(group_by_length or data_args.max_tokens_per_device > 0) and not data_args.use_packed_ds
+                            and data_args.tar_shard_dir is None,
             dynamic_image_size=dynamic_image_size,
             use_thumbnail=use_thumbnail,
             min_dynamic_patch=min_dynamic_patch,
@@ -778,6 +846,8 @@ def build_datasets(
             force_shuffle=data_args.use_packed_ds,
             random_seed=ds_idx,
             train_mask=model.mask_decoder.num_token_trained > 0,
+            vit_feature_store=vit_feature_store,
+            sam_embedding_store=None if data_args.use_packed_ds else sam_embedding_store,
         )
         logger.info(f'Add dataset: {ds_name} with length: {len(dataset)}')
         datasets.append(dataset)
@@ -803,6 +873,17 @@ def build_datasets(
             allow_overflow=data_args.allow_overflow,
             allow_deduplicated_ds_name=False,
         )
+    elif data_args.tar_shard_dir is not None:
+        train_dataset = TarShardDataset(
+            datasets,
+            data_args.tar_shard_dir,
+            shuffle_buffer=data_args.shuffle_buffer_size,
+            seed=seed,
+            data_rank=data_rank,
+            data_world_size=data_world_size,
+            num_workers=num_workers,
+            batch_size=batch_size,
+        )
     elif data_args.use_data_resampling:
         total_length = sum(lengths)
         weights = [l / total_length for l in lengths]
@@ -853,7 +934,20 @@ def main():
     else:
         model_args, data_args, training_args = parser.parse_args_into_dataclasses()
 
+    if data_args.tar_shard_dir is not None:
+        if data_args.use_packed_ds:
+            raise ValueError('--tar_shard_dir cannot be combined with --use_packed_ds')
+        if data_args.max_tokens_per_device > 0:
+            raise ValueError('--tar_shard_dir cannot be combined with --max_tokens_per_device, '
+                             'tar shards are batched with a fixed per-device batch size')
+        if training_args.dataloader_persistent_workers:
+            raise ValueError('--tar_shard_dir cannot be combined with --dataloader_persistent_workers, '
+                             'the workers must be recreated to see the epoch set by the trainer')
+
     training_args.use_packed_ds = data_args.use_packed_ds
+    training_args.use_tar_shards = data_args.tar_shard_dir is not None
+    training_args.max_tokens_per_device = data_args.max_tokens_per_device
+    training_args.max_tiles_per_device = data_args.max_tiles_per_device
 
     # Sending telemetry. Tracking the example usage helps us better allocate resources to maintain them. The
     # information sent is the one passed as arguments along with your Python/PyTorch versions.
@@ -1026,12 +1120,27 @@ def main():
     if model_args.grad_checkpoint:
         model.language_model._set_gradient_checkpointing()
 
+    vit_feature_store = None
+    if data_args.vit_feature_store is not None:
+        if model_args.freeze_backbone and not model_args.use_backbone_lora and not data_args.use_packed_ds:
+            vit_feature_store = data_args.vit_feature_store
+            # forward skips the ViT for stored images, so the store must come from the same backbone and settings
+            ViTFeatureStore.check_meta(
+                vit_feature_store,
+                model_name_or_path=os.path.abspath(model_args.model_name_or_path or model_args.vision_path),
+                select_layer=model.select_layer, ps_version=model.ps_version,
+                downsample_ratio=model.config.downsample_ratio, num_tokens=model.num_image_token,
+                channels=int(model.config.vision_config.hidden_size / model.config.downsample_ratio ** 2))
+        else:
+            logger.warning('vit_feature_store requires freeze_backbone without backbone LoRA and packing, ignore it')
     train_dataset = build_datasets(
         data_args, tokenizer, tcs_loader, model, group_by_length=training_args.group_by_length,
         dynamic_image_size=data_args.dynamic_image_size, use_thumbnail=data_args.use_thumbnail,
         min_dynamic_patch=data_args.min_dynamic_patch, max_dynamic_patch=data_args.max_dynamic_patch,
         normalize_type=data_args.normalize_type, min_num_frame=data_args.min_num_frame,
-        max_num_frame=data_args.max_num_frame)
+        max_num_frame=data_args.max_num_frame, vit_feature_store=vit_feature_store,
+        sam_embedding_store=data_args.sam_embedding_store, batch_size=training_args.per_device_train_batch_size,
+        num_workers=training_args.dataloader_num_workers, seed=training_args.seed)
 
     def _freeze_params(module):
         for param in module.parameters():
@@ -1084,7 +1193,11 @@ def main():
             loss_reduction_all_gather=data_args.loss_reduction_all_gather,
         )
     else:
-        collator = concat_pad_data_collator
+        collator = partial(
+            concat_pad_data_collator,
+            pad_to_multiple_of=data_args.pad_to_multiple_of,
+            pin_memory=training_args.dataloader_pin_memory,
+        )
 
     trainer = Trainer(
         model=model,
@@ -1102,6 +1215,10 @@ def main():
             checkpoint = training_args.resume_from_checkpoint
         elif last_checkpoint is not None:
             checkpoint = last_checkpoint
+        if checkpoint is not None and data_args.tar_shard_dir is not None:
+            # fast-forward the shard stream instead of decoding and dropping the consumed batches
+            train_dataset.load_trainer_state(checkpoint, training_args.gradient_accumulation_steps)
+            training_args.ignore_data_skip = True
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
@@ -42,14 +42,16 @@ from internvl.train.constants import (BOX_END_TOKEN, BOX_START_TOKEN,
                                       REF_START_TOKEN, SEG_END_TOKEN,
                                       SEG_START_TOKEN, SEG_TOKEN_TEMPLATE,
                                       COODBOOK_SIZE)
-from internvl.train.dataset import (ConcatDataset, TCSLoader,
+from internvl.train.dataset import (ConcatDataset, JsonlLines, TCSLoader,
                                     WeightedConcatDataset, build_transform,
                                     check_conversations_repetition,
-                                    dynamic_preprocess, preprocess,
+                                    dynamic_preprocess, get_token_lengths,
+                                    preprocess,
                                     preprocess_internlm,
                                     preprocess_internvl2_5, preprocess_mpt,
                                     preprocess_phi3)
 from internvl.train.dataset_packed import PackedDataset, packed_collate_fn
+from internvl.train.vit_feature_store import SamEmbeddingStore, ViTFeatureStore
 from PIL import Image, ImageFile, PngImagePlugin, UnidentifiedImageError
 from torch.utils.data import Dataset
 from transformers import (AutoConfig, AutoModelForCausalLM, AutoTokenizer,
@@ -278,6 +280,21 @@ class DataTrainingArguments:
         default=False,
         metadata={'help': 'Whether to drop the sample over the specified max_packed_tokens. Default is False.'},
     )
+    pad_to_multiple_of: int = field(
+        default=0,
+        metadata={'help': 'Pad each batch to a multiple of this length (e.g. 8 or 64) so that attention kernels see '
+                          'aligned shapes. Default is 0 (pad to the longest sample).'},
+    )
+    vit_feature_store: Optional[str] = field(
+        default=None,
+        metadata={'help': 'Directory of precomputed ViT features (see extract_vit_features.py), used for datasets '
+                          'without data augmentation when the backbone is frozen. Default is None.'},
+    )
+    sam_embedding_store: Optional[str] = field(
+        default=None,
+        metadata={'help': 'Directory of precomputed SAM image embeddings (see extract_sam_embeddings.py), used by '
+                          'the mask loss for datasets without data augmentation. Default is None.'},
+    )
     loss_reduction: str = field(
         default='token',
         metadata={'help': 'Loss reduction method. Default is token.'},
@@ -320,6 +337,8 @@ class LazySupervisedDataset(Dataset):
         force_shuffle=False,
         random_seed=0,
         train_mask=False,
+        vit_feature_store=None,
+        sam_embedding_store=None,
     ):
         super(LazySupervisedDataset, self).__init__()
         self.ds_name = ds_name
@@ -357,19 +376,14 @@ class LazySupervisedDataset(Dataset):
         logger.info('Formatting inputs...Skip in lazy mode')
         assert meta['annotation'].endswith('jsonl'), f'annotation must be jsonl, but got {meta["annotation"]}'
 
-        with open(meta['annotation'], 'r') as f:
-            self.raw_data = f.readlines()
-            if repeat_time < 1:
-                # If repeat_time is less than 1, select a portion of the data
-                self.raw_data = self.raw_data[:int(len(self.raw_data) * repeat_time)]
-            if repeat_time > 1:
-                assert isinstance(repeat_time, int)
-                # Repeat the list if repeat_time is greater than 1
-                self.raw_data = self.raw_data * repeat_time
+        # line offsets are indexed once and lines are read through mmap on demand
+        self.raw_data = JsonlLines(meta['annotation'])
+        if repeat_time != 1:
+            self.raw_data = self.raw_data.repeat(repeat_time)
 
         self.rng = np.random.default_rng(seed=random_seed)
         if self.force_shuffle:
-            self.rng.shuffle(self.raw_data)
+            self.raw_data = self.raw_data.shuffle(self.rng)
 
         self.root = meta['root']
         self.cached_data_dict = {}
@@ -381,29 +395,26 @@ class LazySupervisedDataset(Dataset):
         self.max_dynamic_patch = max_dynamic_patch
         self.normalize_type = normalize_type
         self.train_mask = train_mask
-
-        # If the precomputed length does not exist, roughly estimate the length of
-        # each sample to improve the efficiency of group_by_length.
+        # precomputed ViT features only match the eval-style transform, so skip them for augmented datasets
+        self.vit_feature_store = None
+        if vit_feature_store is not None and not is_train:
+            self.vit_feature_store = ViTFeatureStore(vit_feature_store)
+            logger.info(f'[Dataset] {ds_name} reads ViT features from {vit_feature_store} '
+                        f'({len(self.vit_feature_store)} images)')
+        self.sam_embedding_store = None
+        if sam_embedding_store is not None and train_mask and not is_train:
+            self.sam_embedding_store = SamEmbeddingStore(sam_embedding_store)
+            logger.info(f'[Dataset] {ds_name} reads SAM embeddings from {sam_embedding_store} '
+                        f'({len(self.sam_embedding_store)} images)')
+
+        # Token lengths for group_by_length are computed once, cached next to the
+        # annotation file and broadcast from rank 0.
         if self.group_by_length:
-            self.conv2length = {}  # Using a dictionary to speed up token length calculation
-            self.length = []
-            for data_item in self.raw_data:
-                data_item = json.loads(data_item)
-                if 'length' in data_item:
-                    token_length = data_item['length']  # Use precomputed length if available
-                else:
-                    # Compute token length using the tokenizer
-                    conversations = '\n'.join([temp['value'] for temp in data_item['conversations']])
-                    str_length = len(conversations)
-                    if str_length not in self.conv2length:
-                        token_length = tokenizer(
-                            conversations, return_tensors='pt', padding=False, truncation=False,
-                        ).input_ids.size(1)
-                        self.conv2length[str_length] = token_length + num_image_token * (
-                                    max_dynamic_patch + use_thumbnail)
-                    else:
-                        token_length = self.conv2length[str_length]
-                self.length.append(token_length)
+            lengths, num_tiles = get_token_lengths(
+                self.raw_data, tokenizer, num_image_token, dynamic_image_size, min_dynamic_patch,
+                max_dynamic_patch, use_thumbnail, image_size=image_size, max_num_frame=max_num_frame)
+            self.length = lengths[self.raw_data.indices].tolist()
+            self.num_tiles = num_tiles[self.raw_data.indices].tolist()
 
     def __len__(self):
         return len(self.raw_data)
@@ -435,6 +446,11 @@ class LazySupervisedDataset(Dataset):
             image_path = os.path.join(self.root, image_path)
         return image_path
 
+    def get_vit_feature_key(self, image_path):
+        return ViTFeatureStore.make_key(image_path, self.image_size, self.dynamic_image_size,
+                                        self.min_dynamic_patch, self.max_dynamic_patch, self.use_thumbnail,
+                                        pad2square=self.pad2square, normalize_type=self.normalize_type)
+
     def get_transform(self):
         # Build transformation function
         transform = build_transform(is_train=self.is_train, input_size=self.image_size,
@@ -495,6 +511,14 @@ class LazySupervisedDataset(Dataset):
             image_flags=torch.tensor([1] * num_patches, dtype=torch.long),
             conversations=data_item['conversations'][0]['value']
         )
+        if self.vit_feature_store is not None:
+            vit_features = self.vit_feature_store.get(self.get_vit_feature_key(image_path))
+            if vit_features is not None and vit_features.size(0) == num_patches:
+                ret['vit_features'] = vit_features
+        if self.sam_embedding_store is not None:
+            sam_embedding = self.sam_embedding_store.get(self.get_vit_feature_key(image_path))
+            if sam_embedding is not None:
+                ret['sam_embedding'] = sam_embedding
         return ret
 
     def multi_modal_multi_image_get_item(self, data_item):
@@ -744,6 +768,8 @@ def build_datasets(
     min_num_frame=8,
     max_num_frame=32,
     normalize_type='imagenet',
+    vit_feature_store=None,
+    sam_embedding_store=None,
 ):
     datasets = []
     lengths = []
@@ -783,6 +809,8 @@ def build_datasets(
             force_shuffle=data_args.use_packed_ds,
             random_seed=ds_idx,
             train_mask=model.mask_decoder.num_token_trained > 0,
+            vit_feature_store=vit_feature_store,
+            sam_embedding_store=None if data_args.use_packed_ds else sam_embedding_store,
         )
         logger.info(f'Add dataset: {ds_name} with length: {len(dataset)}')
         datasets.append(dataset)
@@ -1020,12 +1048,26 @@ def main():
         model.language_model._set_gradient_checkpointing()
         ref_model.language_model._set_gradient_checkpointing()
 
+    vit_feature_store = None
+    if data_args.vit_feature_store is not None:
+        if model_args.freeze_backbone and not model_args.use_backbone_lora and not data_args.use_packed_ds:
+            vit_feature_store = data_args.vit_feature_store
+            # forward skips the ViT for stored images, so the store must come from the same backbone and settings
+            ViTFeatureStore.check_meta(
+                vit_feature_store,
+                model_name_or_path=os.path.abspath(model_args.model_name_or_path or model_args.vision_path),
+                select_layer=model.select_layer, ps_version=model.ps_version,
+                downsample_ratio=model.config.downsample_ratio, num_tokens=model.num_image_token,
+                channels=int(model.config.vision_config.hidden_size / model.config.downsample_ratio ** 2))
+        else:
+            logger.warning('vit_feature_store requires freeze_backbone without backbone LoRA and packing, ignore it')
     train_dataset = build_datasets(
         data_args, tokenizer, tcs_loader, model, group_by_length=training_args.group_by_length,
         dynamic_image_size=data_args.dynamic_image_size, use_thumbnail=data_args.use_thumbnail,
         min_dynamic_patch=data_args.min_dynamic_patch, max_dynamic_patch=data_args.max_dynamic_patch,
         normalize_type=data_args.normalize_type, min_num_frame=data_args.min_num_frame,
-        max_num_frame=data_args.max_num_frame)
+        max_num_frame=data_args.max_num_frame, vit_feature_store=vit_feature_store,
+        sam_embedding_store=data_args.sam_embedding_store)
 
     def _freeze_params(module):
         for param in module.parameters():
@@ -1079,7 +1121,11 @@ def main():
             loss_reduction_all_gather=data_args.loss_reduction_all_gather,
         )
     else:
-        collator = concat_pad_data_collator
+        collator = partial(
+            concat_pad_data_collator,
+            pad_to_multiple_of=data_args.pad_to_multiple_of,
+            pin_memory=training_args.dataloader_pin_memory,
+        )
 
     trainer = SegGRPOTrainer(
         model=model,
@@ -15,49 +15,27 @@ from internvl.train.constants import (
 )
 from trl.models import unwrap_model_for_generation
 
-import numpy as np
-from PIL import Image
-
-def compute_iou(gt_mask, mask_image):
-    """Compute intersection over union (IoU) between two masks."""
-    gt_mask = gt_mask > 0.5
-    mask_image = mask_image > 0.5
-    intersection = np.logical_and(gt_mask, mask_image)
-    union = np.logical_or(gt_mask, mask_image)
-    intersection = np.sum(intersection)
-    union = np.sum(union)
-    iou = intersection / (union + 1e-10)
-    if union == 0:
-        iou = 1.0
-    return intersection, union, iou
-
-
-def update_metrics(mask_images, batch_samples):
-    """Update IoU metrics for a batch."""
-    ious = []
-    for data, mask_image in zip(batch_samples, mask_images):
-        gt_mask = data["mask"]
-        gt_size = max(gt_mask.shape[0], gt_mask.shape[1])
-        mask_image = Image.fromarray(mask_image).resize((gt_size, gt_size), Image.NEAREST)
-        mask_image = np.array(mask_image)
-        mask_image = mask_image[:gt_mask.shape[0], :gt_mask.shape[1]]
-        _, _, iou = compute_iou(gt_mask, mask_image)
-        ious.append(iou)
-    return ious
+from trainers.viz_utils import compute_iou_torch
 
 
 def reward_iou(mask_images, target_masks, valid_mask):
+    """IoU of every decoded mask with its target, computed on the device of the masks.
+
+    Masks are resized (nearest) to the long side of the targets and cropped to them.
+    """
     valid_mask_images = torch.zeros_like(mask_images)
     valid_mask_images[valid_mask] = mask_images[valid_mask]
 
-    mask_images = valid_mask_images.detach()
-    mask_images = mask_images.float().cpu().numpy()
-    target_masks = target_masks.float().cpu().numpy()
-
-    batch_samples = [{'mask': gt_mask} for gt_mask in target_masks]
+    mask_images = valid_mask_images.detach().float()
+    target_masks = target_masks.to(mask_images.device).float()
+    gt_h, gt_w = target_masks.shape[-2:]
+    gt_size = max(gt_h, gt_w)
+    mask_images = torch.nn.functional.interpolate(mask_images.unsqueeze(1), size=(gt_size, gt_size),
+                                                  mode='nearest-exact').squeeze(1)
+    mask_images = mask_images[:, :gt_h, :gt_w]
 
-    ious = update_metrics(mask_images, batch_samples)
-    return ious
+    _, _, ious = compute_iou_torch(target_masks, mask_images, empty_iou=1.0)
+    return ious.tolist()
 
 def ids_are_same(ids1, ids2):
     """ids1 and ids2 are tensors, element of them are token ids (int type)"""
@@ -114,7 +92,7 @@ class SegGRPOTrainer(Trainer):
         self.myprint(f"self.model: {self.model.device}")
 
     def _set_signature_columns_if_needed(self):
-        self._signature_columns = ['pixel_values', 'input_ids', 'attention_mask', 'position_ids', 'image_flags', 'past_key_values', 'labels', 'use_cache', 'output_attentions', 'output_hidden_states', 'return_dict', 'statistics', 'loss_weight', 'loss_reduction_all_gather', 'target_masks', 'labels', 'label_ids', 'label']
+        self._signature_columns = ['pixel_values', 'input_ids', 'attention_mask', 'position_ids', 'image_flags', 'past_key_values', 'labels', 'use_cache', 'output_attentions', 'output_hidden_states', 'return_dict', 'statistics', 'loss_weight', 'loss_reduction_all_gather', 'target_masks', 'vit_features', 'sam_embedding', 'labels', 'label_ids', 'label']
         self._signature_columns = self._signature_columns + ["conversations"]
         
     def myprint(self, text):
@@ -198,12 +176,17 @@ class SegGRPOTrainer(Trainer):
         prompts = [prompt for prompt in prompts for _ in range(self.grpo_group_size)]
 
         pixel_values = pixel_values.repeat_interleave(self.grpo_group_size, dim=0)
+        # precomputed ViT features (frozen backbone) spare the three ViT passes of a step
+        vit_features = inputs.get('vit_features')
+        if vit_features is not None:
+            vit_features = vit_features.repeat_interleave(self.grpo_group_size, dim=0)
 
         model.eval()
         ret = model.batch_chat(self.tokenizer, pixel_values,
                               num_patches_list=[1] * len(prompts),
                               questions=prompts,
-                              generation_config=chat_config)
+                              generation_config=chat_config,
+                              vit_features=vit_features)
         model.train()
         responses_ret, query_ids_ret, completion_ids_ret = ret
         self.myprint(f"len(responses_ret), query_ids_ret.shape, completion_ids_ret.shape: {len(responses_ret)}, {query_ids_ret.shape}, {completion_ids_ret.shape}")
@@ -221,6 +204,7 @@ class SegGRPOTrainer(Trainer):
         other_inputs = {
             "pixel_values": pixel_values,
             "image_flags": image_flags,
+            "vit_features": vit_features,
             "return_dict": True,
         }
 
@@ -261,9 +245,13 @@ class SegGRPOTrainer(Trainer):
         self.myprint(f"tt_format_rewards_list: {tt_format_rewards_list}")
 
         with unwrap_model_for_generation(model, self.accelerator) as unwrapped_model:
-            image_src = model.convert_image_to_sam_input(pixel_values[:1, ...]) * 255
-            image_src = unwrapped_model.mask_decoder.sam.preprocess(image_src)
-            image_embedding = unwrapped_model.mask_decoder.sam.image_encoder(image_src).repeat_interleave(self.grpo_group_size, dim=0)
+            if inputs.get('sam_embedding') is not None:
+                image_embedding = inputs['sam_embedding'][:1].to(completion_logits.dtype)
+            else:
+                image_src = model.convert_image_to_sam_input(pixel_values[:1, ...]) * 255
+                image_src = unwrapped_model.mask_decoder.sam.preprocess(image_src)
+                image_embedding = unwrapped_model.mask_decoder.sam.image_encoder(image_src)
+            image_embedding = image_embedding.repeat_interleave(self.grpo_group_size, dim=0)
             mask_images = unwrapped_model.mask_decoder.decode_prob(tt_probs[:, :NUM_HIMT_TOKENS, :], image_embedding=image_embedding).mean(dim=1, keepdim=False)
 
         target_masks = inputs['target_masks']
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import math
+import os
+from glob import glob
+
+import numpy as np
+import torch
+
+
+class ViTFeatureStore:
+    """Read-only access to precomputed InternViT features.
+
+    Each entry holds the pixel-shuffled vision features of all tiles of one image
+    (the input of ``mlp1``), as ``[num_tiles, num_tokens, channels]`` fp16 rows in
+    raw memory-mapped shards written by :class:`ViTFeatureStoreWriter`.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.num_tokens = self.meta['num_tokens']
+        self.channels = self.meta['channels']
+        self.index = {}
+        for path in sorted(glob(os.path.join(store_dir, 'rank*.index.jsonl'))):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a killed writer may leave a truncated last line
+                        continue
+                    self.index[record['key']] = (record['shard'], record['offset'], record['num_tiles'])
+        self._shards = {}
+        self._pid = None
+
+    @staticmethod
+    def check_meta(store_dir, **expected):
+        """Raise if the store at ``store_dir`` was written with settings other than ``expected``."""
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        mismatches = [f'{k}: store has {meta.get(k)!r}, expected {v!r}'
+                      for k, v in expected.items() if meta.get(k) != v]
+        if len(mismatches) > 0:
+            raise ValueError(f'{store_dir} does not match the model: ' + '; '.join(mismatches))
+
+    @staticmethod
+    def make_key(image_path, image_size, dynamic_image_size, min_dynamic_patch, max_dynamic_patch,
+                 use_thumbnail, pad2square=False, normalize_type='imagenet'):
+        # everything that changes the tiles fed to the ViT is part of the key
+        key = '|'.join(str(k) for k in [image_path, image_size, dynamic_image_size, min_dynamic_patch,
+                                        max_dynamic_patch, use_thumbnail, pad2square, normalize_type])
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _get_shard(self, shard):
+        # memmaps are opened lazily in every DataLoader worker
+        if self._pid != os.getpid():
+            self._shards = {}
+            self._pid = os.getpid()
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.store_dir, shard), dtype=np.float16, mode='r')
+        return self._shards[shard]
+
+    def get(self, key):
+        if key not in self.index:
+            return None
+        shard, offset, num_tiles = self.index[key]
+        row = self.num_tokens * self.channels
+        data = self._get_shard(shard)[offset * row:(offset + num_tiles) * row]
+        return torch.from_numpy(np.array(data).reshape(num_tiles, self.num_tokens, self.channels))
+
+
+class ViTFeatureStoreWriter:
+    """Appends features of one rank to ``rank{rank}.shard{k}.bin`` files and ``rank{rank}.index.jsonl``."""
+
+    def __init__(self, store_dir, num_tokens, channels, rank=0, meta=None, shard_size=4 * 2 ** 30):
+        self.store_dir = store_dir
+        self.num_tokens = num_tokens
+        self.channels = channels
+        self.rank = rank
+        self.shard_size = shard_size
+        os.makedirs(store_dir, exist_ok=True)
+        meta = dict(meta or {}, num_tokens=num_tokens, channels=channels, dtype='float16')
+        meta_path = os.path.join(store_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                old_meta = json.load(f)
+            assert old_meta == meta, f'{store_dir} was written with different settings: {old_meta}'
+        elif rank == 0:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f, indent=2)
+
+        self.row_bytes = num_tokens * channels * 2
+        self.index_file = open(os.path.join(store_dir, f'rank{rank}.index.jsonl'), 'a')
+        self.shard_id = len(glob(os.path.join(store_dir, f'rank{rank}.shard*.bin')))
+        self.shard_file = None
+        self.offset = 0
+
+    def _open_shard(self):
+        self.shard = f'rank{self.rank}.shard{self.shard_id:05d}.bin'
+        self.shard_file = open(os.path.join(self.store_dir, self.shard), 'wb')
+        self.shard_id += 1
+        self.offset = 0
+
+    def add(self, key, features):
+        features = features.to(torch.float16).cpu().numpy()
+        assert features.shape[1:] == (self.num_tokens, self.channels), features.shape
+        if self.shard_file is None or (self.offset + features.shape[0]) * self.row_bytes > self.shard_size:
+            self.close_shard()
+            self._open_shard()
+        self.shard_file.write(features.tobytes())
+        # the index line is written after the data, so a crash never indexes missing rows
+        self.shard_file.flush()
+        record = {'key': key, 'shard': self.shard, 'offset': self.offset, 'num_tiles': features.shape[0]}
+        self.index_file.write(json.dumps(record) + '\n')
+        self.offset += features.shape[0]
+
+    def close_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        self.index_file.flush()
+
+    def close(self):
+        self.close_shard()
+        self.index_file.close()
+
+
+class SamEmbeddingStore(ViTFeatureStore):
+    """Precomputed SAM image embeddings for the mask loss, in the same shard format.
+
+    One ``[256, 64, 64]`` embedding is kept per image: the SAM encoding of the first
+    tile, which is the tile the mask loss decodes against.
+    """
+
+    def get(self, key):
+        embedding = super().get(key)
+        if embedding is None:
+            return None
+        side = int(math.isqrt(self.channels))
+        return embedding.view(embedding.size(0), self.num_tokens, side, side)
+
+
+class SamEmbeddingStoreWriter(ViTFeatureStoreWriter):
+
+    def __init__(self, store_dir, embed_dim=256, embed_size=64, rank=0, meta=None, shard_size=4 * 2 ** 30):
+        super().__init__(store_dir, embed_dim, embed_size * embed_size, rank=rank, meta=meta, shard_size=shard_size)
+
+    def add(self, key, embedding):
+        super().add(key, embedding.flatten(2))
@@ -0,0 +1,94 @@
+import argparse
+import io
+import os
+import sys
+import tarfile
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from internvl.train.dataset import JsonlLines
+from internvl.train.dataset_tar import get_sample_files
+
+try:
+    import orjson as json
+except:
+    import json
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shard(task):
+    """Pack rows [start, end) of an annotation file with their local image and mask bytes into one tar."""
+    annotation, root, shard_path, start, end = task
+    if os.path.exists(shard_path):
+        return shard_path, end - start, 0
+    num_missing = 0
+    tmp_path = f'{shard_path}.{os.getpid()}.tmp'
+    with tarfile.open(tmp_path, 'w') as tar:
+        for idx, line in enumerate(JsonlLines(annotation)[start:end], start=start):
+            key = f'{idx:09d}'
+            data_item = json.loads(line)
+            _add_member(tar, f'{key}.json', line.encode('utf-8'))
+            for j, path in enumerate(get_sample_files(data_item, root)):
+                # remote files are still read through the tcs loader
+                if 's3://' in path:
+                    continue
+                if not os.path.exists(path):
+                    num_missing += 1
+                    continue
+                with open(path, 'rb') as f:
+                    _add_member(tar, f'{key}.{j}', f.read())
+    os.replace(tmp_path, shard_path)
+    return shard_path, end - start, num_missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack SFT jsonl rows with their images and masks into tar shards.')
+    parser.add_argument('--meta-path', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--samples-per-shard', type=int, default=2000)
+    parser.add_argument('--num-workers', type=int, default=16)
+    parser.add_argument('--datasets', type=str, default=None, help='comma separated subset of the meta file')
+    args = parser.parse_args()
+
+    ds_collections = json.loads(open(args.meta_path).read())
+    ds_names = args.datasets.split(',') if args.datasets else list(ds_collections.keys())
+    for ds_name in ds_names:
+        meta = ds_collections[ds_name]
+        shard_dir = os.path.join(args.output, ds_name)
+        os.makedirs(shard_dir, exist_ok=True)
+        num_samples = len(JsonlLines(meta['annotation']))
+        tasks = []
+        for shard_idx, start in enumerate(range(0, num_samples, args.samples_per_shard)):
+            end = min(start + args.samples_per_shard, num_samples)
+            shard_path = os.path.join(shard_dir, f'shard-{shard_idx:06d}.tar')
+            tasks.append((meta['annotation'], meta['root'], shard_path, start, end))
+
+        shards, num_missing = [], 0
+        with Pool(args.num_workers) as pool:
+            for shard_path, shard_samples, shard_missing in tqdm(pool.imap(write_shard, tasks), total=len(tasks),
+                                                                  desc=ds_name):
+                shards.append({'path': os.path.basename(shard_path), 'num_samples': shard_samples})
+                num_missing += shard_missing
+        if num_missing > 0:
+            print(f'Warning: {num_missing} files of {ds_name} are missing and will be read from disk at training time')
+
+        index = {'annotation': os.path.abspath(meta['annotation']), 'root': meta['root'],
+                 'num_samples': num_samples, 'shards': shards}
+        index_path = os.path.join(shard_dir, 'index.json')
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        data = json.dumps(index)
+        with open(tmp_path, 'wb') as f:
+            f.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+        os.replace(tmp_path, index_path)
+        print(f'{ds_name}: {num_samples} samples in {len(shards)} shards')
+
+
+if __name__ == '__main__':
+    main()
@@ -96,6 +96,13 @@ class ALTo(BaseModel):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
+    def set_grad_checkpointing(self, enable=True):
+        """ Trade compute for memory in training: the TiTok transformer blocks and the
+            pixel decoder blocks recompute their activations in backward.
+        """
+        for module in (self.encoder, self.decoder, self.pixel_decoder):
+            module.grad_checkpointing = enable
+
     def encode(self, x):
         z, length_probs, length_loss, lengths_to_keep = self.encoder(pixel_values=x, latent_tokens=self.latent_tokens)
         z_quantized, result_dict = self.quantize(z)
@@ -4,6 +4,7 @@ from typing import Optional, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from collections import OrderedDict
 import einops
 from einops.layers.torch import Rearrange
@@ -324,6 +325,8 @@ class TiTokEncoder(nn.Module):
                 self.width, self.num_heads, mlp_ratio=4.0
             ))
         self.ln_post = nn.LayerNorm(self.width)
+        # recompute the activations of each transformer block in backward, see set_grad_checkpointing
+        self.grad_checkpointing = False
         self.conv_out = nn.Conv2d(self.width, self.token_size, kernel_size=1, bias=True)
         self.length_encoder = LengthEncoder(self.width,use_random_not_adaptive=config.model.get("use_random_not_adaptive", False))
         
@@ -352,9 +355,13 @@ class TiTokEncoder(nn.Module):
 
         x = self.ln_pre(x)
         x = x.permute(1, 0, 2)  # NLD -> LND
+        use_checkpoint = self.grad_checkpointing and self.training and torch.is_grad_enabled()
         for i in range(self.num_layers):
             # x = self.transformer[i](x)
-            x = self.transformer[i](x, attn_mask=self.attn_mask)
+            if use_checkpoint:
+                x = torch.utils.checkpoint.checkpoint(self.transformer[i], x, self.attn_mask, use_reentrant=False)
+            else:
+                x = self.transformer[i](x, attn_mask=self.attn_mask)
         x = x.permute(1, 0, 2)  # LND -> NLD
         
         latent_tokens = x[:, 1+self.grid_size**2:]
@@ -420,6 +427,8 @@ class TiTokDecoder(nn.Module):
                 self.width, self.num_heads, mlp_ratio=4.0
             ))
         self.ln_post = nn.LayerNorm(self.width)
+        # recompute the activations of each transformer block in backward, see set_grad_checkpointing
+        self.grad_checkpointing = False
 
         if self.is_legacy:
             self.ffn = nn.Sequential(
@@ -540,8 +549,12 @@ class TiTokDecoder(nn.Module):
         # Forward through transformer
         x = self.ln_pre(x)
         x = x.permute(1, 0, 2)  # NLD -> LND
+        use_checkpoint = self.grad_checkpointing and self.training and torch.is_grad_enabled()
         for i in range(self.num_layers):
-            x = self.transformer[i](x)
+            if use_checkpoint:
+                x = torch.utils.checkpoint.checkpoint(self.transformer[i], x, use_reentrant=False)
+            else:
+                x = self.transformer[i](x)
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = x[:, 1:1+self.grid_size**2] # remove cls embed
         x = self.ln_post(x)
@@ -4,6 +4,7 @@ import math
 
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
 
 
@@ -198,17 +199,28 @@ class Decoder(nn.Module):
         self.norm_out = nn.GroupNorm(num_groups=32, num_channels=block_out, eps=1e-6, affine=True)
         self.conv_out = Conv2dSame(block_out, self.config.num_channels, kernel_size=3)
 
+        # recompute the activations of each middle / upsampling block in backward
+        self.grad_checkpointing = False
+
     def forward(self, hidden_states):
+        use_checkpoint = self.grad_checkpointing and self.training and torch.is_grad_enabled()
+
         # z to block_in
         hidden_states = self.conv_in(hidden_states)
 
         # middle
         for block in self.mid:
-            hidden_states = block(hidden_states)
+            if use_checkpoint:
+                hidden_states = torch.utils.checkpoint.checkpoint(block, hidden_states, use_reentrant=False)
+            else:
+                hidden_states = block(hidden_states)
 
         # upsampling
         for block in reversed(self.up):
-            hidden_states = block(hidden_states)
+            if use_checkpoint:
+                hidden_states = torch.utils.checkpoint.checkpoint(block, hidden_states, use_reentrant=False)
+            else:
+                hidden_states = block(hidden_states)
 
         # end
         hidden_states = self.norm_out(hidden_states)
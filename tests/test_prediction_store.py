@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+pytest.importorskip("pycocotools")
+
+from eval.prediction_store import PredictionStore
+
+
+def _record(idx):
+    return {"id": idx, "prompt_hash": f"hash{idx}", "tokens": [idx], "length": 1, "valid": True,
+            "mask": {"size": [1, 1], "counts": "01"}, "intersection": 0, "union": 0, "iou": 1.0}
+
+
+def test_resume_after_truncated_line(tmp_path):
+    store = PredictionStore(str(tmp_path), "refcoco_val")
+    for idx in range(3):
+        store.append(_record(idx))
+    store.close()
+
+    # simulate a run killed in the middle of writing record 3
+    with open(store.path, "a") as f:
+        f.write(json.dumps(_record(3))[:20])
+
+    store = PredictionStore(str(tmp_path), "refcoco_val")
+    assert sorted(store.load()) == [0, 1, 2]
+    store.append(_record(3))
+    store.append(_record(4))
+    store.close()
+
+    assert sorted(store.load()) == [0, 1, 2, 3, 4]
+    with open(store.path) as f:
+        assert all(json.loads(line) for line in f)
@@ -0,0 +1,106 @@
+import atexit
+import os
+import queue
+import threading
+import traceback
+
+import torch
+
+
+class BackgroundWriter(object):
+    """Runs write jobs (visualizations, statistics, ...) in submission order on a daemon thread.
+
+    At most ``max_pending`` jobs wait in the queue, so a slow disk makes ``submit`` block
+    instead of growing host memory. ``flush`` waits for every submitted job and ``close``
+    (also registered with atexit) flushes and stops the thread.
+    """
+
+    def __init__(self, max_pending=8, name='background_writer'):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        assert not self.closed, 'writer is closed'
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+
+def write_checkpoint(state, path, save_safetensors=False, on_saved=None):
+    """torch.save ``state`` to ``path`` through a temporary file and an atomic rename.
+
+    With ``save_safetensors`` the model weights are also written, without the ``module.``
+    prefix, to a ``.safetensors`` file next to it.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    if save_safetensors:
+        from safetensors.torch import save_file
+        weights = {k.replace('module.', ''): v.detach().to('cpu', copy=True).contiguous()
+                   for k, v in state['model'].items()}
+        safetensors_path = os.path.splitext(path)[0] + '.safetensors'
+        tmp_path = f'{safetensors_path}.{os.getpid()}.tmp'
+        save_file(weights, tmp_path, metadata={'epoch': str(state.get('epoch')), 'step': str(state.get('step'))})
+        os.replace(tmp_path, safetensors_path)
+    if on_saved is not None:
+        on_saved(path)
+
+
+class CheckpointWriter(BackgroundWriter):
+    """Writes checkpoints with ``write_checkpoint`` on a background thread.
+
+    ``save`` copies every tensor of the state into pinned CPU buffers, which are kept and
+    reused by the next save, and returns as soon as the copy is done. At most one
+    checkpoint is in flight: a save first waits for the previous one to be written.
+    """
+
+    def __init__(self):
+        super().__init__(max_pending=1, name='checkpoint_writer')
+        self.buffers = {}
+
+    def _copy_to_cpu(self, obj, key):
+        if torch.is_tensor(obj):
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self.buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return buffer
+        if isinstance(obj, dict):
+            return obj.__class__((k, self._copy_to_cpu(v, f'{key}/{k}')) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return obj.__class__(self._copy_to_cpu(v, f'{key}/{i}') for i, v in enumerate(obj))
+        return obj
+
+    def save(self, state, path, save_safetensors=False, on_saved=None):
+        # the buffers may still be read by the previous checkpoint
+        self.flush()
+        cpu_state = self._copy_to_cpu(state, '')
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.submit(write_checkpoint, cpu_state, path, save_safetensors, on_saved)
@@ -1,5 +1,6 @@
 import os
 import json
+import math
 import random
 import numpy as np
 import cv2
@@ -7,6 +8,7 @@ import torch
 from torch.utils.data import Dataset
 from PIL import Image
 from pycocotools import mask as maskUtils
+from trainers.sa1b_index import SA1BIndex
 
 MAX_NORMALIZED_COORDINATE = 999
 
@@ -86,6 +88,59 @@ def random_crop(image, mask, box):
     cropped_mask = mask[mask_crop_box[1]:mask_crop_box[3], mask_crop_box[0]:mask_crop_box[2]]
     return cropped_img, cropped_mask, box2
 
+def decode_rle_counts(counts):
+    """Run lengths of a compressed COCO RLE string (the inverse of pycocotools' rleToString)"""
+    if isinstance(counts, str):
+        counts = counts.encode('ascii')
+    runs = []
+    p = 0
+    while p < len(counts):
+        x, k, more = 0, 0, True
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << 5 * k
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return np.array(runs, dtype=np.int64)
+
+def decode_rle_crop(rle, crop_box):
+    """Decode only the crop_box (xyxy) region of a compressed RLE mask"""
+    height = rle['size'][0]
+    x1, y1, x2, y2 = crop_box
+    runs = decode_rle_counts(rle['counts'])
+    ends = np.cumsum(runs)
+    starts = ends - runs
+    # RLE is column-major, so the columns of the crop are one contiguous span
+    span_start, span_end = x1 * height, x2 * height
+    lengths = np.clip(ends, span_start, span_end) - np.clip(starts, span_start, span_end)
+    values = (np.arange(len(runs)) % 2).astype(np.uint8)
+    mask = np.repeat(values, lengths).reshape(x2 - x1, height).T
+    return np.ascontiguousarray(mask[y1:y2])
+
+def load_image_crop(image_path, crop_box, scale=1.0, use_draft=True):
+    """Load the crop_box (xyxy) region of an image, downscaled by scale if it is below 1.
+    JPEGs are decoded at a reduced DCT scale when the result still covers the target size."""
+    image = Image.open(image_path)
+    width, height = image.size
+    x1, y1, x2, y2 = crop_box
+    new_size = (round((x2 - x1) * scale), round((y2 - y1) * scale))
+    if scale < 1 and use_draft:
+        image.draft(image.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+    if image.size != (width, height):
+        ratio_x, ratio_y = image.size[0] / width, image.size[1] / height
+        box = (x1 * ratio_x, y1 * ratio_y, x2 * ratio_x, y2 * ratio_y)
+        return np.array(image.resize(new_size, Image.BICUBIC, box=box))
+    image = np.array(image.crop(crop_box))
+    if scale < 1:
+        image = cv2.resize(image, new_size, interpolation=cv2.INTER_CUBIC)
+    return image
+
 class SupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -97,6 +152,7 @@ class SupervisedDataset(Dataset):
         mask_size=256,
         max_normalized_coordinate=999,
         min_area_ratio=0.005,
+        use_draft=True,
     ):
         super(SupervisedDataset, self).__init__()
         data_path = config.dataset.params.train_sam1b_path if is_train else config.dataset.params.eval_sam1b_path   
@@ -106,9 +162,16 @@ class SupervisedDataset(Dataset):
         self.mask_size = mask_size
         self.max_image_size = fixed_size
         self.square_pad = True
+        self.use_draft = use_draft
+
+        # Binary annotation index built by trainers/sa1b_index.py, replaces the per-image json reads
+        index_prefix = config.dataset.params.get('train_sam1b_index' if is_train else 'eval_sam1b_index')
+        self.index = SA1BIndex(index_prefix) if index_prefix else None
 
         # Load data list (assume jsonl or json list of file paths)
-        if data_path.endswith('.jsonl'):
+        if self.index is not None:
+            self.data = list(range(len(self.index)))
+        elif data_path.endswith('.jsonl'):
             with open(data_path, 'r') as f:
                 self.data = [json.loads(line.strip()) for line in f]
         else:
@@ -123,25 +186,37 @@ class SupervisedDataset(Dataset):
     def __getitem__(self, index):
         # Load sample meta
         sample = self.data[index]
-        json_path = sample["json_path"] if "json_path" in sample else sample
-        json_data = json.load(open(json_path, 'r'))
-        image_path = os.path.join(os.path.dirname(json_path), json_data["image"]["file_name"])
-        width, height = json_data["image"]["width"], json_data["image"]["height"]
-        raw_anns = json_data["annotations"]
-        min_area = max(height, width) ** 2 * self.min_area_ratio
-        raw_anns = [ann for ann in raw_anns if ann['area'] > min_area]
+        if self.index is not None:
+            image_info = self.index.get_image(sample)
+            json_path, image_path = image_info["json_path"], image_info["image_path"]
+            width, height = image_info["width"], image_info["height"]
+            min_area = max(height, width) ** 2 * self.min_area_ratio
+            # only the sampled annotations have their RLE read from the blob
+            records = image_info["anns"]
+            raw_anns = [records[i] for i in np.nonzero(records['area'] > min_area)[0]]
+        else:
+            json_path = sample["json_path"] if "json_path" in sample else sample
+            json_data = json.load(open(json_path, 'r'))
+            image_path = os.path.join(os.path.dirname(json_path), json_data["image"]["file_name"])
+            width, height = json_data["image"]["width"], json_data["image"]["height"]
+            raw_anns = json_data["annotations"]
+            min_area = max(height, width) ** 2 * self.min_area_ratio
+            raw_anns = [ann for ann in raw_anns if ann['area'] > min_area]
         if len(raw_anns) == 0:
             return self.__getitem__(random.randint(0, len(self.data)-1))
         max_sample_n = min(20, max(3, len(raw_anns)//2))
         sample_n = random.randint(1, min(max_sample_n, len(raw_anns))) if self.is_train else min(index % max_sample_n + 1, len(raw_anns))
         anns = random.sample(raw_anns, sample_n) if self.is_train else raw_anns[:sample_n]
-        image = np.array(Image.open(image_path))
-        masks = np.zeros((height, width), dtype=np.uint8)
+        rles = []
         boxes = None
         mask_count = 0
         for ann in anns:
-            mask = maskUtils.decode(ann['segmentation']) * 255
-            current_box_xywh = ann['bbox']
+            if self.index is not None:
+                rles.append(self.index.get_rle(ann, height, width))
+                current_box_xywh = ann['bbox'].tolist()
+            else:
+                rles.append(ann['segmentation'])
+                current_box_xywh = ann['bbox']
             current_box_xyxy = xywh2xyxy(current_box_xywh)
             if boxes is None:
                 boxes = current_box_xyxy
@@ -150,13 +225,18 @@ class SupervisedDataset(Dataset):
                 boxes[1] = min(boxes[1], current_box_xyxy[1])
                 boxes[2] = max(boxes[2], current_box_xyxy[2])
                 boxes[3] = max(boxes[3], current_box_xyxy[3])
-            masks = masks | mask
             mask_count += 1
         box = boxes
-        mask = masks
-        if self.is_train:
-            image, mask, box = random_crop(image, mask, box)
-        image, mask, box = resize_if_exceeds_max_size(image, mask, box, self.max_image_size)
+        # Crop first: only the crop is decoded, masks are merged as RLE
+        crop_box = get_crop_box(box, height, width) if self.is_train else [0, 0, width, height]
+        box = [box[0]-crop_box[0], box[1]-crop_box[1], box[2]-crop_box[0], box[3]-crop_box[1]]
+        crop_w, crop_h = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+        scale = min(1.0, self.max_image_size / max(crop_w, crop_h))
+        mask = decode_rle_crop(maskUtils.merge(rles) if len(rles) > 1 else rles[0], crop_box) * 255
+        image = load_image_crop(image_path, crop_box, scale, use_draft=self.use_draft)
+        if scale < 1:
+            mask = cv2.resize(mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_CUBIC)
+            box = [round(coord * scale) for coord in box]
         if self.square_pad:
             image, mask, box = make_square(image, mask, box, is_random_pad=self.is_train)
         # Resize image to self.max_image_size
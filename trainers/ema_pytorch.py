@@ -60,7 +60,6 @@ class EMA(nn.Module):
             # set this to False if you do not wish for the online model to be saved along with the ema model (managed externally)
     ):
         super().__init__()
-        self.device = self.model.device if ma_device is None else ma_device
         self.beta = beta
 
         # whether to include the online model within the module tree, so that state_dict also saves it
@@ -72,6 +71,8 @@ class EMA(nn.Module):
         else:
             self.online_model = [model]  # hack
 
+        self.device = next(model.parameters()).device if ma_device is None else torch.device(ma_device)
+
         # ema model
 
         self.ema_model = ema_model
@@ -99,12 +100,41 @@ class EMA(nn.Module):
         assert isinstance(param_or_buffer_names_no_ema, (set, list))
         self.param_or_buffer_names_no_ema = param_or_buffer_names_no_ema  # parameter or buffer
 
-        self.ignore_names = [name for name, p in self.model.named_parameters() if p.requires_grad == False]
+        self.ignore_names = {name for name, p in self.model.named_parameters() if p.requires_grad == False}
         self.ignore_startswith_names = ignore_startswith_names
 
         self.register_buffer('initted', torch.Tensor([False]))
         self.register_buffer('step', torch.tensor([start_step]))
 
+        self.resolve_tensor_groups()
+
+    def resolve_tensor_groups(self):
+        """
+        Pairs up the ema and online tensors once, so that an update does not walk the module trees.
+        Tensors to average are grouped by (ema device, dtype, online device) for torch._foreach_lerp_,
+        a group whose online tensors live on another device (ema offloaded to cpu) gets pinned staging buffers.
+        """
+        pairs = list(zip(self.get_params_iter(self.ema_model), self.get_params_iter(self.model)))
+        pairs += list(zip(self.get_buffers_iter(self.ema_model), self.get_buffers_iter(self.model)))
+
+        self.copy_pairs = [(ma, current) for (_, ma), (_, current) in pairs]
+        self.no_ema_pairs = []
+        self.lerp_groups = {}
+        for (name, ma), (_, current) in pairs:
+            if name in self.ignore_names:
+                continue
+            if any(name.startswith(prefix) for prefix in self.ignore_startswith_names):
+                continue
+            if name in self.param_or_buffer_names_no_ema:
+                self.no_ema_pairs.append((ma, current))
+                continue
+            key = (ma.device, ma.dtype, current.device)
+            group = self.lerp_groups.setdefault(key, {'ema': [], 'online': [], 'staging': []})
+            group['ema'].append(ma)
+            group['online'].append(current)
+            if current.device != ma.device:
+                group['staging'].append(torch.empty_like(ma, pin_memory=current.device.type == 'cuda'))
+
     @property
     def model(self):
         return self.online_model if self.include_online_model else self.online_model[0]
@@ -115,6 +145,7 @@ class EMA(nn.Module):
     def restore_ema_model_device(self):
         device = self.initted.device
         self.ema_model.to(device)
+        self.resolve_tensor_groups()
 
     def get_params_iter(self, model):
         for name, param in model.named_parameters():
@@ -128,14 +159,12 @@ class EMA(nn.Module):
                 continue
             yield name, buffer
 
+    @torch.no_grad()
     def copy_params_from_model_to_ema(self):
-        for (_, ma_params), (_, current_params) in zip(self.get_params_iter(self.ema_model),
-                                                       self.get_params_iter(self.model)):
-            ma_params.data.copy_(current_params.data)
-
-        for (_, ma_buffers), (_, current_buffers) in zip(self.get_buffers_iter(self.ema_model),
-                                                         self.get_buffers_iter(self.model)):
-            ma_buffers.data.copy_(current_buffers.data)
+        for ma, current in self.copy_pairs:
+            ma.copy_(current, non_blocking=True)
+        if self.device.type == 'cpu' and torch.cuda.is_available():
+            torch.cuda.synchronize()
 
     def get_current_decay(self):
         step = clamp(self.step.item() - self.update_after_step - 1, min_value=0.)
@@ -166,56 +195,27 @@ class EMA(nn.Module):
 
     @torch.no_grad()
     def update_moving_average(self, ma_model, current_model):
+        # ma_model and current_model are the ones paired up by resolve_tensor_groups
         current_decay = self.get_current_decay()
 
-        for (name, current_params), (_, ma_params) in zip(self.get_params_iter(current_model),
-                                                          self.get_params_iter(ma_model)):
-            if name in self.ignore_names:
-                continue
-
-            if any([name.startswith(prefix) for prefix in self.ignore_startswith_names]):
-                continue
-
-            if name in self.param_or_buffer_names_no_ema:
-                ma_params.data.copy_(current_params.data)
-                continue
-
-            # ma_params.data.lerp_(current_params.data, 1. - current_decay)
-            ma_params.data = self.update_tensor(ma_params.data, current_params.data, current_decay,
-                                                self.device)
-
-        for (name, current_buffer), (_, ma_buffer) in zip(self.get_buffers_iter(current_model),
-                                                          self.get_buffers_iter(ma_model)):
-            if name in self.ignore_names:
-                continue
-
-            if any([name.startswith(prefix) for prefix in self.ignore_startswith_names]):
-                continue
-
-            if name in self.param_or_buffer_names_no_ema:
-                ma_buffer.data.copy_(current_buffer.data)
-                continue
-
-            # ma_buffer.data.lerp_(current_buffer.data, 1. - current_decay)
-            ma_buffer.data = self.update_tensor(ma_buffer.data, current_buffer.data, current_decay,
-                                                self.device)
-
-    # def update_tensor(self, src, dst, decay, src_device, dst_device):
-    #     src = src.to(dst_device)
-    #     # y = src * decay + dst * (1 - decay)
-    #     src.lerp_(dst, 1. - decay)
-    #     # diff = (y - src).abs().mean()
-    #     # if diff > 1e-4:
-    #     #     print(f'diff={diff}')
-    #     return src.to(src_device)
-
-    def update_tensor(self, ema, dst, decay, src_device):
-        # ema = ema * decay + dst.to(src_device) * (1 - decay)
-        ema.lerp_(dst.to(src_device), 1. - decay)
-        # diff = (y - src).abs().mean()
-        # if diff > 1e-4:
-        #     print(f'diff={diff}')
-        return ema.to(src_device)
+        for ma, current in self.no_ema_pairs:
+            ma.copy_(current, non_blocking=True)
+
+        offloaded = []
+        for group in self.lerp_groups.values():
+            if group['staging']:
+                # gather the online tensors to the ema device without blocking on each copy
+                for staging, current in zip(group['staging'], group['online']):
+                    staging.copy_(current, non_blocking=True)
+                offloaded.append(group)
+            else:
+                torch._foreach_lerp_(group['ema'], group['online'], 1. - current_decay)
+
+        if offloaded or self.no_ema_pairs:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        for group in offloaded:
+            torch._foreach_lerp_(group['ema'], group['staging'], 1. - current_decay)
 
     def __call__(self, *args, **kwargs):
         return self.ema_model(*args, **kwargs)
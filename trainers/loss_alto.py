@@ -30,51 +30,53 @@ class HiMTLoss(torch.nn.Module):
         self.register_buffer("sobel_x", torch.tensor([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=torch.float32).view(1, 1, 3, 3))
         self.register_buffer("sobel_y", torch.tensor([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=torch.float32).view(1, 1, 3, 3))
 
+        # Edge kernels are built once. The x and y kernels of every scale are stacked as the output
+        # channels of a single conv, and for RGB inputs the grayscale conversion is folded into the weights.
+        gray = torch.tensor([0.2989, 0.5870, 0.1140], dtype=torch.float32).view(1, 3, 1, 1)
 
-    def compute_edge_maps(self, inputs):
-        """Compute edge maps using multi-scale Sobel operators"""
-        device = inputs.device
-        
-        # Convert to grayscale if input is RGB
-        if inputs.shape[1] == 3:
-            inputs_gray = 0.2989 * inputs[:, 0:1] + 0.5870 * inputs[:, 1:2] + 0.1140 * inputs[:, 2:3]
-        else:
-            inputs_gray = inputs
-
-        # Multi-scale edge detection
-        kernel_sizes = [3, 5]  # Multiple kernel sizes for wider edges
-        weights = [1.0, 0.5]  # Weights for different scales
-        
-        total_edge_map = 0
-        for size, weight in zip(kernel_sizes, weights):
-            # Create larger Sobel kernels
+        # Multi-scale smoothed Sobel kernels of compute_edge_maps, zero padded to the largest size
+        self.edge_map_sizes = [3, 5]  # Multiple kernel sizes for wider edges
+        self.edge_map_weights = [1.0, 0.5]  # Weights for different scales
+        max_size = max(self.edge_map_sizes)
+        kernels = []
+        for size in self.edge_map_sizes:
             center = size // 2
             sigma = size / 3.0
-            x = torch.arange(size, dtype=torch.float32, device=device) - center
+            x = torch.arange(size, dtype=torch.float32) - center
             gaussian = torch.exp(-(x ** 2) / (2 * sigma ** 2))
             gaussian = gaussian / gaussian.sum()
-            
-            # Create Sobel kernels
-            sobel = torch.arange(-(size//2), size//2 + 1, dtype=torch.float32, device=device)
+            sobel = torch.arange(-(size//2), size//2 + 1, dtype=torch.float32)
             sobel = sobel / sobel.abs().max()
-            
-            # Construct 2D kernels
             kernel_x = gaussian.view(1, -1) * sobel.view(-1, 1)
-            kernel_y = kernel_x.t()
-            
-            # Reshape kernels for conv2d
-            kernel_x = kernel_x.view(1, 1, size, size)
-            kernel_y = kernel_y.view(1, 1, size, size)
+            pad = (max_size - size) // 2
+            kernels += [F.pad(kernel_x, (pad, pad, pad, pad)), F.pad(kernel_x.t(), (pad, pad, pad, pad))]
+        edge_map_kernel = torch.stack(kernels).unsqueeze(1)  # [2 * num_scales, 1, max_size, max_size]
+        self.register_buffer("edge_map_kernel", edge_map_kernel, persistent=False)
+        self.register_buffer("edge_map_kernel_rgb", edge_map_kernel * gray, persistent=False)
 
-            # Compute gradients
-            grad_x = F.conv2d(inputs_gray, kernel_x, padding=size//2)
-            grad_y = F.conv2d(inputs_gray, kernel_y, padding=size//2)
-            
-            # Compute edge map for current scale
-            edge_map = torch.sqrt(grad_x ** 2 + grad_y ** 2 + 1e-8)
-            
-            # Add to total edge map with weight
-            total_edge_map += weight * edge_map
+        # Sobel-like kernels of compute_edge_loss
+        self.edge_loss_size = 3
+        kernel_x = torch.ones((self.edge_loss_size, self.edge_loss_size), dtype=torch.float32)
+        kernel_x[:, self.edge_loss_size//2:] = -1
+        edge_loss_kernel = torch.stack([kernel_x, kernel_x.t()]).unsqueeze(1)  # [2, 1, size, size]
+        self.register_buffer("edge_loss_kernel", edge_loss_kernel, persistent=False)
+        self.register_buffer("edge_loss_kernel_rgb", edge_loss_kernel * gray, persistent=False)
+
+
+    def compute_edge_maps(self, inputs):
+        """Compute edge maps using multi-scale Sobel operators"""
+        # Grayscale conversion is folded into the kernel if input is RGB
+        kernel = self.edge_map_kernel_rgb if inputs.shape[1] == 3 else self.edge_map_kernel
+
+        # Gradients of all scales at once: [B, (scale, x/y), H, W]
+        grads = F.conv2d(inputs, kernel, padding=kernel.shape[-1]//2)
+        grads = grads.view(grads.shape[0], len(self.edge_map_sizes), 2, *grads.shape[-2:])
+
+        # Edge map per scale, added to the total edge map with its weight
+        edge_maps = torch.sqrt((grads ** 2).sum(dim=2) + 1e-8)
+        total_edge_map = 0
+        for i, weight in enumerate(self.edge_map_weights):
+            total_edge_map = total_edge_map + weight * edge_maps[:, i:i+1]
 
         # Apply soft thresholding to make edges more prominent
         threshold = 0.1
@@ -93,44 +95,20 @@ class HiMTLoss(torch.nn.Module):
     
     def compute_edge_loss(self, targets: torch.Tensor, reconstructions: torch.Tensor, edge_weights: torch.Tensor=None) -> torch.Tensor:
         """Compute edge loss using Sobel operators."""
-        # Convert to grayscale if input is RGB
-        if targets.shape[1] == 3:
-            inputs_gray = 0.2989 * targets[:, 0:1] + 0.5870 * targets[:, 1:2] + 0.1140 * targets[:, 2:3]
-            recon_gray = 0.2989 * reconstructions[:, 0:1] + 0.5870 * reconstructions[:, 1:2] + 0.1140 * reconstructions[:, 2:3]
-        else:
-            inputs_gray = targets
-            recon_gray = reconstructions
+        # Grayscale conversion is folded into the kernel if input is RGB
+        kernel = self.edge_loss_kernel_rgb if targets.shape[1] == 3 else self.edge_loss_kernel
 
         edge_weights = edge_weights if edge_weights is not None else 1.0
-        # Compute multi-scale edge maps
-        edge_loss = 0
-        # kernel_sizes = [3, 5, 7]  # 多尺度的 Sobel 算子
-        kernel_sizes = [3,]  # 多尺度的 Sobel 算子
-        weights = [1.0, 0.5, 0.25]  # 不同尺度的权重
-
-        for size, weight in zip(kernel_sizes, weights):
-            # Create Sobel kernels for current size
-            kernel_x = torch.ones((size, size), dtype=torch.float32, device=targets.device)
-            kernel_x[:, size//2:] = -1
-            kernel_x = kernel_x.view(1, 1, size, size)
-            
-            kernel_y = kernel_x.transpose(2, 3)
-            
-            # Compute gradients
-            input_grad_x = F.conv2d(inputs_gray, kernel_x, padding=size//2)
-            input_grad_y = F.conv2d(inputs_gray, kernel_y, padding=size//2)
-            recon_grad_x = F.conv2d(recon_gray, kernel_x, padding=size//2)
-            recon_grad_y = F.conv2d(recon_gray, kernel_y, padding=size//2)
 
-            # Compute edge maps
-            input_edges = torch.sqrt(input_grad_x ** 2 + input_grad_y ** 2 + 1e-6)
-            recon_edges = torch.sqrt(recon_grad_x ** 2 + recon_grad_y ** 2 + 1e-6)
+        # x and y gradients of targets and reconstructions in one conv
+        grads = F.conv2d(torch.cat([targets, reconstructions]), kernel, padding=self.edge_loss_size//2)
+        edges = torch.sqrt((grads ** 2).sum(dim=1, keepdim=True) + 1e-6)
+        input_edges, recon_edges = edges.split(targets.shape[0])
 
-            # Add weighted loss for current scale
-            edge_loss += weight * (
-                0.5 * F.mse_loss(input_edges, recon_edges, reduction="none")*edge_weights + 
-                0.5 * F.smooth_l1_loss(input_edges, recon_edges, beta=0.4, reduction="none")*edge_weights
-            ).mean()
+        edge_loss = (
+            0.5 * F.mse_loss(input_edges, recon_edges, reduction="none")*edge_weights +
+            0.5 * F.smooth_l1_loss(input_edges, recon_edges, beta=0.4, reduction="none")*edge_weights
+        ).mean()
 
         return edge_loss
 
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+# one record per image and per annotation; RLE counts and paths live in the packed blob
+IMAGE_DTYPE = np.dtype([
+    ('ann_start', '<i8'), ('ann_count', '<i4'), ('width', '<i4'), ('height', '<i4'),
+    ('json_path_offset', '<i8'), ('json_path_len', '<i4'),
+    ('image_path_offset', '<i8'), ('image_path_len', '<i4'),
+])
+ANN_DTYPE = np.dtype([
+    ('area', '<f8'), ('bbox', '<f8', (4,)), ('rle_offset', '<i8'), ('rle_len', '<i4'),
+])
+INDEX_VERSION = 1
+
+
+def load_data_list(data_path):
+    """The list of per-image annotation json paths, as SupervisedDataset reads it."""
+    if data_path.endswith('.jsonl'):
+        with open(data_path, 'r') as f:
+            data = [json.loads(line.strip()) for line in f]
+    else:
+        with open(data_path, 'r') as f:
+            data = json.load(f)
+    return [sample["json_path"] if isinstance(sample, dict) and "json_path" in sample else sample for sample in data]
+
+
+def _read_image_json(json_path):
+    with open(json_path, 'r') as f:
+        json_data = json.load(f)
+    image_path = os.path.join(os.path.dirname(json_path), json_data["image"]["file_name"])
+    anns = json_data["annotations"]
+    counts = [ann['segmentation']['counts'] for ann in anns]
+    counts = [c.encode('ascii') if isinstance(c, str) else c for c in counts]
+    return (json_path, image_path, json_data["image"]["width"], json_data["image"]["height"],
+            [ann['area'] for ann in anns], [ann['bbox'] for ann in anns], counts)
+
+
+def build_sa1b_index(data_path, output_prefix, num_workers=16):
+    """Write the binary annotation index of every image listed in ``data_path``.
+
+    Produces ``{prefix}.images.bin``/``{prefix}.anns.bin`` (fixed-size records, see
+    IMAGE_DTYPE/ANN_DTYPE), ``{prefix}.blob`` (RLE counts and paths), ``{prefix}.entries.npy``
+    (the image record of every entry of the data list, duplicates included) and
+    ``{prefix}.json`` with the counts, written last.
+    """
+    data_list = load_data_list(data_path)
+    json_paths = list(dict.fromkeys(data_list))
+    image_ids = {json_path: i for i, json_path in enumerate(json_paths)}
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+
+    num_anns, blob_size = 0, 0
+    with open(f'{output_prefix}.images.bin', 'wb') as image_file, \
+            open(f'{output_prefix}.anns.bin', 'wb') as ann_file, \
+            open(f'{output_prefix}.blob', 'wb') as blob_file, \
+            Pool(num_workers) as pool:
+        for i, (json_path, image_path, width, height, areas, bboxes, counts) in enumerate(
+                pool.imap(_read_image_json, json_paths, chunksize=64)):
+            image = np.zeros(1, dtype=IMAGE_DTYPE)
+            image['ann_start'], image['ann_count'] = num_anns, len(areas)
+            image['width'], image['height'] = width, height
+            for key, value in [('json_path', json_path), ('image_path', image_path)]:
+                value = value.encode('utf-8')
+                image[f'{key}_offset'], image[f'{key}_len'] = blob_size, len(value)
+                blob_file.write(value)
+                blob_size += len(value)
+            anns = np.zeros(len(areas), dtype=ANN_DTYPE)
+            anns['area'] = areas
+            if len(bboxes) > 0:
+                anns['bbox'] = bboxes
+            anns['rle_len'] = [len(c) for c in counts]
+            anns['rle_offset'] = blob_size + np.concatenate([[0], np.cumsum(anns['rle_len'][:-1])]).astype(np.int64) \
+                if len(counts) > 0 else []
+            blob_file.write(b''.join(counts))
+            blob_size += int(anns['rle_len'].sum())
+            image_file.write(image.tobytes())
+            ann_file.write(anns.tobytes())
+            num_anns += len(areas)
+            if (i + 1) % 10000 == 0:
+                print(f'[build_sa1b_index] {i + 1}/{len(json_paths)} images, {num_anns} annotations')
+
+    np.save(f'{output_prefix}.entries.npy', np.array([image_ids[p] for p in data_list], dtype=np.int64))
+    meta = {'version': INDEX_VERSION, 'source': os.path.abspath(data_path), 'num_images': len(json_paths),
+            'num_anns': num_anns, 'blob_size': blob_size}
+    tmp_path = f'{output_prefix}.json.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, f'{output_prefix}.json')
+    print(f'[build_sa1b_index] {len(json_paths)} images, {num_anns} annotations, {blob_size / 2 ** 20:.1f} MB blob')
+    return meta
+
+
+class SA1BIndex:
+    """Memory-mapped reader of an index written by :func:`build_sa1b_index`."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(f'{prefix}.json', 'r') as f:
+            self.meta = json.load(f)
+        assert self.meta['version'] == INDEX_VERSION, f'{prefix} was built by another version, rebuild it'
+        self.entries = np.load(f'{prefix}.entries.npy')
+        self._arrays = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        # memmaps are reopened in every DataLoader worker
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _get_arrays(self):
+        if self._arrays is None or self._pid != os.getpid():
+            self._arrays = (
+                np.memmap(f'{self.prefix}.images.bin', dtype=IMAGE_DTYPE, mode='r', shape=(self.meta['num_images'],)),
+                np.memmap(f'{self.prefix}.anns.bin', dtype=ANN_DTYPE, mode='r', shape=(self.meta['num_anns'],)),
+                np.memmap(f'{self.prefix}.blob', dtype=np.uint8, mode='r', shape=(self.meta['blob_size'],)),
+            )
+            self._pid = os.getpid()
+        return self._arrays
+
+    def _get_bytes(self, offset, length):
+        blob = self._get_arrays()[2]
+        return blob[int(offset):int(offset) + int(length)].tobytes()
+
+    def get_image(self, entry):
+        """Image record of data-list entry ``entry``: paths, size and the annotation records (no RLE)."""
+        images, anns, _ = self._get_arrays()
+        image = images[self.entries[entry]]
+        start = int(image['ann_start'])
+        return {
+            'json_path': self._get_bytes(image['json_path_offset'], image['json_path_len']).decode('utf-8'),
+            'image_path': self._get_bytes(image['image_path_offset'], image['image_path_len']).decode('utf-8'),
+            'width': int(image['width']),
+            'height': int(image['height']),
+            'anns': anns[start:start + int(image['ann_count'])],
+        }
+
+    def get_rle(self, ann, height, width):
+        return {'size': [height, width], 'counts': self._get_bytes(ann['rle_offset'], ann['rle_len'])}
+
+
+def benchmark(data_path, index_prefix, num_samples=200, fixed_size=1024):
+    """Samples/s of SupervisedDataset reading the annotation json files and reading the index."""
+    from omegaconf import OmegaConf
+    from trainers.dataset import SupervisedDataset
+
+    results = {}
+    for name, index in [('json', None), ('index', index_prefix)]:
+        config = OmegaConf.create({'dataset': {'params': {'train_sam1b_path': data_path, 'eval_sam1b_path': data_path,
+                                                          'train_sam1b_index': index, 'eval_sam1b_index': index}}})
+        dataset = SupervisedDataset(config, is_train=True, fixed_size=fixed_size)
+        start = time.time()
+        for i in range(num_samples):
+            dataset[i % len(dataset)]
+        results[name] = num_samples / (time.time() - start)
+        print(f'[benchmark] {name}: {results[name]:.2f} samples/s over {num_samples} samples')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the binary per-image annotation index of an SA-1B data list.')
+    parser.add_argument('--data-path', type=str, required=True, help='json/jsonl list of SA-1B annotation files')
+    parser.add_argument('--output', type=str, required=True, help='output prefix, e.g. ./example/sa1b_index/train')
+    parser.add_argument('--num-workers', type=int, default=16)
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='if > 0, time this many SupervisedDataset samples with and without the index')
+    args = parser.parse_args()
+
+    build_sa1b_index(args.data_path, args.output, num_workers=args.num_workers)
+    if args.benchmark > 0:
+        benchmark(args.data_path, args.output, num_samples=args.benchmark)
+
+
+if __name__ == '__main__':
+    main()
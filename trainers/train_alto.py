@@ -17,7 +17,8 @@ from trainers.loss_alto import HiMTLoss
 import math
 from pathlib import Path
 from trainers.viz_utils import make_viz_from_samples
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from trainers.async_writer import BackgroundWriter
 import json
 import numpy as np
 
@@ -59,6 +60,8 @@ class TrainProcess(DistributedTrainerBase):
         if self.rank == 0:
             logpath = os.path.join(self.opt.model_save_dir, 'logs')
             self.sw = SummaryWriter(logpath)
+            # test visualizations and statistics are written off the training thread
+            self.writer = BackgroundWriter(max_pending=self.opt.writer_max_pending)
             # self.add_model_graph(self.model, (512,1))
 
         self.verify_weights_sync()
@@ -77,6 +80,10 @@ class TrainProcess(DistributedTrainerBase):
                 self.test(self.start_step)
         # Begin the training loop
         self.train()
+        if self.rank == 0:
+            self.writer.close()
+            if hasattr(self, 'ckpt_writer'):
+                self.ckpt_writer.close()
 
     def init_distributed_env(self):
         """
@@ -127,6 +134,8 @@ class TrainProcess(DistributedTrainerBase):
     def set_model_and_loss(self):
         cprint(f'[rank-{self.rank}] Setting up model...', 'cyan')
         self.model = ALTo(self.opt).to(self.device)
+        if self.opt.get('use_gradient_ckpt', False):
+            self.model.set_grad_checkpointing(True)
         self.loss_fn = HiMTLoss(self.opt).to(self.device)
         
         self.optim = torch.optim.AdamW(
@@ -153,12 +162,16 @@ class TrainProcess(DistributedTrainerBase):
                 update_every=self.opt.ema_update_every,
                 # how often to actually update, to save on compute (updates every 10th .update() call)
                 start_step=1000000,
-                ma_device=self.device,
+                ma_device='cpu' if self.opt.get('ema_offload', False) else self.device,
             )
 
         self.load_ckpt_if_exist(self.opt.experiment.init_weight, verbose=True)
         self.configure_model_gradients()
 
+        if self.opt.get('compile', False):
+            # compile the forward only, so that state_dict keys and the ema copy are unchanged
+            self.model.forward = torch.compile(self.model.forward)
+
         if self.opt.world_size > 1:
             # self.model = nn.SyncBatchNorm.convert_sync_batchnorm(self.model)
             self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=[self.local_rank],
@@ -230,11 +243,8 @@ class TrainProcess(DistributedTrainerBase):
             scaler.update()
             self.optim.zero_grad()
             self.current_lr = self.lr_scheduler.step()
-            
-        if opt.world_size > 1:
-            for k, v in loss_dict.items():
-                if torch.is_tensor(v):
-                    torch.distributed.all_reduce(v.detach().to(self.device), op=torch.distributed.ReduceOp.AVG)
+
+        # accumulated on device, reduced over ranks every print_freq steps by sync_meter
         self.update_meter(loss_dict)
 
         return loss_dict
@@ -263,10 +273,27 @@ class TrainProcess(DistributedTrainerBase):
                 grad_step += 1
                 step = grad_step // grad_accu_steps
                 mb = self.preprocess(mb)
-                mb_losses = self.do_optimize(mb, grad_step, grad_scaler)
+                self.do_optimize(mb, grad_step, grad_scaler)
                 if hasattr(self, 'model_ema'):  # only rank-0 own model_ema
                     self.model_ema.update()
 
+                if grad_step % (opt.print_freq * grad_accu_steps) == 0:
+                    self.sync_meter(self.device, world_size)
+                    # Check for NaN loss, on the loss averaged over ranks and steps, which every rank sees
+                    if math.isnan(self.meter_total_loss.avg):
+                        if rank == 0:
+                            cprint('NaN loss detected! Training terminated.', 'red', attrs=['blink'])
+                            # Save model state for debugging
+                            self.save_model(epoch, step, float('nan'), opt.model_save_dir,
+                                          max_time_not_save=0,
+                                          suffix='_nan_checkpoint')
+                            if hasattr(self, 'ckpt_writer'):
+                                self.ckpt_writer.flush()
+                        # Ensure all processes terminate
+                        if world_size > 1:
+                            torch.distributed.destroy_process_group()
+                        raise RuntimeError("NaN loss detected. Training terminated.")
+
                 if rank == 0 and grad_step % (opt.print_freq * grad_accu_steps) == 0:
                     # torch.cuda.synchronize()  # sync for logging
                     now = time.time()
@@ -294,18 +321,6 @@ class TrainProcess(DistributedTrainerBase):
                     if rank == 0:
                         self.save_model(epoch, step, test_loss, opt.model_save_dir, max_time_not_save=0 * 60)
 
-                # Check for NaN loss
-                if rank == 0 and torch.isnan(mb_losses['total_loss']).any():
-                    cprint('NaN loss detected! Training terminated.', 'red', attrs=['blink'])
-                    # Save model state for debugging
-                    self.save_model(epoch, step, float('nan'), opt.model_save_dir, 
-                                  max_time_not_save=0, 
-                                  suffix='_nan_checkpoint')
-                    # Ensure all processes terminate
-                    if world_size > 1:
-                        torch.distributed.destroy_process_group()
-                    raise RuntimeError("NaN loss detected. Training terminated.")
-
     @torch.no_grad()
     def test(self, step):
         self.model.eval()
@@ -313,11 +328,8 @@ class TrainProcess(DistributedTrainerBase):
         t0 = time.time()
         cnt, loss_sum = 0, 0
         max_save_images = 32 if self.opt.model.vq_model.finetune_decoder else 1024
-        mean_iou_list = []
-        mean_biou_list = []
-        mean_mse_list = []
-        lengths_to_keep_list = []
-        mask_count_list = []  # Add list to collect mask_count data
+        # artifacts are drawn and written by the background writer from host copies
+        test_stats = {'iou': [], 'biou': [], 'mse': [], 'lengths': [], 'mask_counts': []}
         for mb in self.test_loader:
             mb = self.preprocess(mb)
             masks = mb['mask']
@@ -329,138 +341,29 @@ class TrainProcess(DistributedTrainerBase):
                 # Calculate losses using the loss class
                 total_loss, loss_dict = self.loss_fn(masks, reconstructed_images, extra_results_dict,step,mode="generator")
             if cnt < max_save_images and self.rank == 0:
-                mean_iou, mean_biou, mean_mse = self.reconstruct_images(
-                    masks,
-                    reconstructed_images,
-                    extra_results_dict,
-                    image_src,
+                viz_results_dict = {k: extra_results_dict[k].detach().cpu()
+                                    for k in ('masks_token_only', 'random_morphology_augment', 'lengths_to_keep')}
+                test_stats['lengths'].append(viz_results_dict['lengths_to_keep'])
+                test_stats['mask_counts'].append(mask_count.cpu())
+                self.writer.submit(
+                    self.reconstruct_images,
+                    masks.detach().cpu(),
+                    reconstructed_images.detach().cpu(),
+                    viz_results_dict,
+                    image_src.detach().cpu(),
                     step,
                     self.opt.model_save_dir,
-                    cnt
+                    cnt,
+                    test_stats
                 )
-                mean_iou_list.append(mean_iou)
-                mean_biou_list.append(mean_biou)
-                mean_mse_list.append(mean_mse)
-                lengths_to_keep_list.append(extra_results_dict['lengths_to_keep'])
-                mask_count_list.append(mask_count)  # Collect mask_count data
             loss_sum += total_loss * B
             cnt += B
 
             if cnt >= max_save_images:
                 break
-        if len(mean_iou_list) > 0:
-            mean_iou = sum(mean_iou_list) / len(mean_iou_list)
-            mean_biou = sum(mean_biou_list) / len(mean_biou_list)
-            mean_mse = sum(mean_mse_list) / len(mean_mse_list)
-            print(f"mean_iou: {mean_iou:.4f}, mean_biou: {mean_biou:.4f}, mean_mse: {mean_mse:.4f}")
-            
-            # Calculate length distribution statistics
-            all_lengths = torch.cat(lengths_to_keep_list)
-            all_mask_counts = torch.cat(mask_count_list)  # Concatenate all mask counts
-            
-            # Calculate correlation between mask_count and lengths_to_keep
-            correlation = torch.corrcoef(torch.stack([all_mask_counts.float().cpu(), all_lengths.float().cpu()]))[0, 1].item()
-            
-            # Save correlation data to file
-            correlation_data = {
-                'step': step,
-                'correlation': correlation,
-                'mask_counts': all_mask_counts.cpu().numpy().tolist(),
-                'lengths': all_lengths.cpu().numpy().tolist()
-            }
-            correlation_path = os.path.join(self.opt.model_save_dir, "train_images", f"correlation_data_step_{step:04}.json")
-            with open(correlation_path, 'w') as f:
-                json.dump(correlation_data, f, indent=4)
-            
-            # Plot scatter plot
-            plt.figure(figsize=(10, 6))
-            plt.scatter(all_mask_counts.cpu().numpy(), all_lengths.cpu().numpy(), alpha=0.5)
-            plt.title(f'Mask Count vs Length Distribution (Correlation: {correlation:.4f})')
-            plt.xlabel('Mask Count')
-            plt.ylabel('Length')
-            plt.grid(True, alpha=0.3)
-            
-            # Add correlation coefficient as text
-            plt.text(0.95, 0.95, f'Correlation: {correlation:.4f}',
-                    transform=plt.gca().transAxes,
-                    verticalalignment='top',
-                    horizontalalignment='right',
-                    bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
-            
-            # Save plot
-            plot_path = os.path.join(self.opt.model_save_dir, "train_images", f"correlation_plot_step_{step:04}.png")
-            plt.savefig(plot_path)
-            plt.close()
-            
-            print(f"Correlation between mask_count and lengths_to_keep: {correlation:.4f}")
-            
-            mean_length = all_lengths.float().mean().item()
-            std_length = all_lengths.float().std().item()
-            
-            # Calculate length distribution entropy
-            length_counts = torch.bincount(all_lengths, minlength=33)  # Assuming max length is 32
-            length_probs = length_counts.float() / length_counts.sum()
-            length_entropy = -torch.sum(length_probs * torch.log2(length_probs + 1e-10)).item()
-            
-            # Save length distribution data to file
-            length_dist_data = {
-                'step': step,
-                'length_probs': length_probs.cpu().numpy().tolist(),
-                'mean_length': mean_length,
-                'std_length': std_length,
-                'length_entropy': length_entropy
-            }
-            length_dist_path = os.path.join(self.opt.model_save_dir, "train_images", f"length_dist_data_step_{step:04}.json")
-            with open(length_dist_path, 'w') as f:
-                json.dump(length_dist_data, f, indent=4)
-            
-            # Calculate entropy statistics
-            entropy_list = []
-            for lengths in lengths_to_keep_list:
-                counts = torch.bincount(lengths, minlength=33)
-                probs = counts.float() / counts.sum()
-                entropy = -torch.sum(probs * torch.log2(probs + 1e-10)).item()
-                entropy_list.append(entropy)
-            
-            mean_entropy = sum(entropy_list) / len(entropy_list)
-            std_entropy = torch.tensor(entropy_list).std().item()
-            
-            print(f"Length Statistics:")
-            print(f"  Mean Length: {mean_length:.2f}")
-            print(f"  Length Std: {std_length:.2f}")
-            print(f"  Overall Length Entropy: {length_entropy:.2f}")
-            print(f"  Mean Entropy: {mean_entropy:.2f}")
-            print(f"  Entropy Std: {std_entropy:.2f}")
-            
-            # Save length distribution plot with proportions
-            plt.figure(figsize=(10, 6))
-            plt.hist(all_lengths.cpu().numpy(), bins=33, range=(0, 33), alpha=0.7, weights=np.ones_like(all_lengths.cpu().numpy()) / len(all_lengths))
-            plt.title(f'Length Distribution')
-            plt.xlabel('Length')
-            plt.ylabel('Proportion')
-            plt.grid(True, alpha=0.3)
-            
-            # Add statistics as text
-            stats_text = f'Mean: {mean_length:.2f}\nStd: {std_length:.2f}\nEntropy: {length_entropy:.2f}'
-            plt.text(0.95, 0.95, stats_text,
-                    transform=plt.gca().transAxes,
-                    verticalalignment='top',
-                    horizontalalignment='right',
-                    bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
-            
-            # Save plot
-            plot_path = os.path.join(self.opt.model_save_dir, "train_images", f"length_dist_step_{step:04}.png")
-            plt.savefig(plot_path)
-            plt.close()
-            
-            # 将指标添加到TensorBoard
-            if self.rank == 0:
-                self.sw.add_scalar("test/mean_iou", mean_iou, step)
-                self.sw.add_scalar("test/mean_biou", mean_biou, step)
-                self.sw.add_scalar("test/mean_mse", mean_mse, step)
-        else:
-            pass
-        
+        if self.rank == 0 and len(test_stats['lengths']) > 0:
+            self.writer.submit(self.write_test_stats, test_stats, step)
+
         loss = loss_sum / cnt
         if self.opt.test_distributed:
             cnt *= self.world_size
@@ -475,7 +378,7 @@ class TrainProcess(DistributedTrainerBase):
         self.model.train()
         return loss
 
-    def reconstruct_images(self, masks, reconstructed_images, extra_results_dict, image_src, step,model_save_dir,cnt=0):
+    def reconstruct_images(self, masks, reconstructed_images, extra_results_dict, image_src, step,model_save_dir,cnt=0,test_stats=None):
         images_for_saving, images_for_logging, mean_iou, mean_biou, mean_mse = make_viz_from_samples(
             masks,
             reconstructed_images,
@@ -490,5 +393,121 @@ class TrainProcess(DistributedTrainerBase):
             path = os.path.join(root, filename)
             img.save(path)
 
+        if test_stats is not None:
+            test_stats['iou'].append(mean_iou)
+            test_stats['biou'].append(mean_biou)
+            test_stats['mse'].append(mean_mse)
         # 需要可视化长度分布，长度分布的平均值，长度分布的方差，长度分布的熵，长度分布的熵的平均值，长度分布的熵的方差
-        return mean_iou, mean_biou, mean_mse
\ No newline at end of file
+        return mean_iou, mean_biou, mean_mse
+
+    def write_test_stats(self, test_stats, step):
+        """Print, plot and log the statistics of the batches visualized by test, on the background writer"""
+        mean_iou = sum(test_stats['iou']) / len(test_stats['iou'])
+        mean_biou = sum(test_stats['biou']) / len(test_stats['biou'])
+        mean_mse = sum(test_stats['mse']) / len(test_stats['mse'])
+        print(f"mean_iou: {mean_iou:.4f}, mean_biou: {mean_biou:.4f}, mean_mse: {mean_mse:.4f}")
+
+        # Calculate length distribution statistics
+        lengths_to_keep_list = test_stats['lengths']
+        all_lengths = torch.cat(lengths_to_keep_list)
+        all_mask_counts = torch.cat(test_stats['mask_counts'])  # Concatenate all mask counts
+
+        # Calculate correlation between mask_count and lengths_to_keep
+        correlation = torch.corrcoef(torch.stack([all_mask_counts.float(), all_lengths.float()]))[0, 1].item()
+
+        # Save correlation data to file
+        correlation_data = {
+            'step': step,
+            'correlation': correlation,
+            'mask_counts': all_mask_counts.numpy().tolist(),
+            'lengths': all_lengths.numpy().tolist()
+        }
+        correlation_path = os.path.join(self.opt.model_save_dir, "train_images", f"correlation_data_step_{step:04}.json")
+        with open(correlation_path, 'w') as f:
+            json.dump(correlation_data, f, indent=4)
+
+        # Plot scatter plot (Figure instead of pyplot, which is not thread-safe)
+        fig = Figure(figsize=(10, 6))
+        ax = fig.add_subplot()
+        ax.scatter(all_mask_counts.numpy(), all_lengths.numpy(), alpha=0.5)
+        ax.set_title(f'Mask Count vs Length Distribution (Correlation: {correlation:.4f})')
+        ax.set_xlabel('Mask Count')
+        ax.set_ylabel('Length')
+        ax.grid(True, alpha=0.3)
+
+        # Add correlation coefficient as text
+        ax.text(0.95, 0.95, f'Correlation: {correlation:.4f}',
+                transform=ax.transAxes,
+                verticalalignment='top',
+                horizontalalignment='right',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+
+        # Save plot
+        plot_path = os.path.join(self.opt.model_save_dir, "train_images", f"correlation_plot_step_{step:04}.png")
+        fig.savefig(plot_path)
+
+        print(f"Correlation between mask_count and lengths_to_keep: {correlation:.4f}")
+
+        mean_length = all_lengths.float().mean().item()
+        std_length = all_lengths.float().std().item()
+
+        # Calculate length distribution entropy
+        length_counts = torch.bincount(all_lengths, minlength=33)  # Assuming max length is 32
+        length_probs = length_counts.float() / length_counts.sum()
+        length_entropy = -torch.sum(length_probs * torch.log2(length_probs + 1e-10)).item()
+
+        # Save length distribution data to file
+        length_dist_data = {
+            'step': step,
+            'length_probs': length_probs.numpy().tolist(),
+            'mean_length': mean_length,
+            'std_length': std_length,
+            'length_entropy': length_entropy
+        }
+        length_dist_path = os.path.join(self.opt.model_save_dir, "train_images", f"length_dist_data_step_{step:04}.json")
+        with open(length_dist_path, 'w') as f:
+            json.dump(length_dist_data, f, indent=4)
+
+        # Calculate entropy statistics
+        entropy_list = []
+        for lengths in lengths_to_keep_list:
+            counts = torch.bincount(lengths, minlength=33)
+            probs = counts.float() / counts.sum()
+            entropy = -torch.sum(probs * torch.log2(probs + 1e-10)).item()
+            entropy_list.append(entropy)
+
+        mean_entropy = sum(entropy_list) / len(entropy_list)
+        std_entropy = torch.tensor(entropy_list).std().item()
+
+        print(f"Length Statistics:")
+        print(f"  Mean Length: {mean_length:.2f}")
+        print(f"  Length Std: {std_length:.2f}")
+        print(f"  Overall Length Entropy: {length_entropy:.2f}")
+        print(f"  Mean Entropy: {mean_entropy:.2f}")
+        print(f"  Entropy Std: {std_entropy:.2f}")
+
+        # Save length distribution plot with proportions
+        fig = Figure(figsize=(10, 6))
+        ax = fig.add_subplot()
+        ax.hist(all_lengths.numpy(), bins=33, range=(0, 33), alpha=0.7, weights=np.ones_like(all_lengths.numpy()) / len(all_lengths))
+        ax.set_title(f'Length Distribution')
+        ax.set_xlabel('Length')
+        ax.set_ylabel('Proportion')
+        ax.grid(True, alpha=0.3)
+
+        # Add statistics as text
+        stats_text = f'Mean: {mean_length:.2f}\nStd: {std_length:.2f}\nEntropy: {length_entropy:.2f}'
+        ax.text(0.95, 0.95, stats_text,
+                transform=ax.transAxes,
+                verticalalignment='top',
+                horizontalalignment='right',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+
+        # Save plot
+        plot_path = os.path.join(self.opt.model_save_dir, "train_images", f"length_dist_step_{step:04}.png")
+        fig.savefig(plot_path)
+
+        # 将指标添加到TensorBoard
+        self.sw.add_scalar("test/mean_iou", mean_iou, step)
+        self.sw.add_scalar("test/mean_biou", mean_biou, step)
+        self.sw.add_scalar("test/mean_mse", mean_mse, step)
\ No newline at end of file
@@ -6,10 +6,15 @@ import torch
 from termcolor import cprint
 import glob
 from torch.optim.lr_scheduler import LambdaLR, CosineAnnealingLR
+from trainers.async_writer import CheckpointWriter, write_checkpoint
 
 
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value
+
+    Tensor values are summed on their device and only reach ``avg`` once they are
+    folded in by ``add`` (see ``TrainerBase.sync_meter``), so ``update`` never syncs.
+    """
 
     def __init__(self, mom=0):
         self.mom = mom
@@ -20,13 +25,15 @@ class AverageMeter(object):
         self.avg = 0
         self.sum = 0
         self.count = 0
+        self.device_sum = None
+        self.device_count = 0
 
     def update(self, val):
         if torch.is_tensor(val):
-            if val.is_cuda:
-                val = val.data.float().cpu().numpy()
-            else:
-                val = val.data.float().numpy()
+            val = val.detach().float().reshape([])
+            self.device_sum = val if self.device_sum is None else self.device_sum + val
+            self.device_count += 1
+            return
         if isinstance(val, np.ndarray):
             val = val.item()
 
@@ -38,6 +45,15 @@ class AverageMeter(object):
         self.count += 1
         self.avg = self.sum / self.count
 
+    def add(self, total, count):
+        """Fold in the sum of ``count`` values"""
+        if count == 0:
+            return
+        self.val = total / count
+        self.sum += total
+        self.count += count
+        self.avg = self.sum / self.count
+
 
 # function to calculate the Exponential moving averages for the Generator weights
 # This function updates the exponential average weights based on the current training
@@ -125,6 +141,28 @@ class TrainerBase(object):
                 self.__getattribute__(name).update(v)
         return
 
+    def sync_meter(self, device, world_size=1):
+        """Fold the on-device sums of all meters into their averages, averaged over ranks.
+
+        One fused all_reduce and one device-to-host copy for all meters; every rank must call it.
+        """
+        meters = [self.__getattribute__(name) for name in self.__dict__.keys() if name.startswith('meter_')]
+        if len(meters) == 0:
+            return
+        sums = [m.device_sum.to(device) if m.device_sum is not None else torch.zeros((), device=device)
+                for m in meters]
+        counts = torch.tensor([m.device_count for m in meters], dtype=torch.float32, device=device)
+        stats = torch.cat([torch.stack(sums), counts])
+        if world_size > 1:
+            torch.distributed.all_reduce(stats, op=torch.distributed.ReduceOp.SUM)
+        stats = stats.tolist()
+        for i, m in enumerate(meters):
+            # the mean over ranks of the per-rank sums, same as averaging every step over ranks
+            m.add(stats[i] / world_size, stats[len(meters) + i] / world_size)
+            m.device_sum = None
+            m.device_count = 0
+        return
+
     def reset_meter(self):
         for name in self.__dict__.keys():
             if name.startswith('meter_'):
@@ -203,10 +241,12 @@ class TrainerBase(object):
         timestamps.sort(reverse=True, key=lambda x: x[1])
 
         for ts in timestamps[maxN:]:
-            cmd = 'rm %s' % ts[0]
-            if verbose:
-                print(f"[delete_older_ckpt] rank={self.rank} max_save={maxN} cmd={cmd}")
-            os.system(cmd)
+            paths = [ts[0], os.path.splitext(ts[0])[0] + '.safetensors']
+            for path in paths:
+                if os.path.exists(path):
+                    if verbose:
+                        print(f"[delete_older_ckpt] rank={self.rank} max_save={maxN} remove {path}")
+                    os.remove(path)
         return None
 
     def train(self):
@@ -286,7 +326,8 @@ class TrainerBase(object):
                    save_dir,
                    higher_is_better=False,
                    max_time_not_save=60 * 60,
-                   save_ema=True):
+                   save_ema=True,
+                   suffix=''):
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
@@ -305,7 +346,7 @@ class TrainerBase(object):
         if is_best or long_time_save:
             self.best = max(loss, self.best) if higher_is_better else min(loss, self.best)
 
-            model_name = 'Model_E{}S{}_L{:.6f}.pth'.format(epoch, step, loss)
+            model_name = 'Model_E{}S{}_L{:.6f}{}.pth'.format(epoch, step, loss, suffix)
             model_path = os.path.join(save_dir, model_name)
             cprint('save model to >>> %s' % model_path, 'cyan')
             state = {'epoch': epoch,
@@ -317,14 +358,22 @@ class TrainerBase(object):
                      }
             if hasattr(self, 'model_ema') and save_ema:
                 state['model_ema'] = self.model_ema.state_dict()
-            torch.save(state, model_path)
-            self.last_save_timestamp = time.time()
 
-            # Delete older checkpoints if exceeding max number
+            # Delete older checkpoints if exceeding max number, once the new one is written
+            on_saved = None
             if hasattr(self.opt, 'num_max_save_models'):
-                self.delete_older_ckpt(save_dir, 
-                                     maxN=self.opt.num_max_save_models, 
-                                     verbose=True)
+                on_saved = lambda path: self.delete_older_ckpt(save_dir,
+                                                               maxN=self.opt.num_max_save_models,
+                                                               verbose=True)
+            save_safetensors = self.opt.get('save_safetensors', False)
+            if self.opt.get('async_save', False):
+                # training resumes once the state is copied to the host
+                if not hasattr(self, 'ckpt_writer'):
+                    self.ckpt_writer = CheckpointWriter()
+                self.ckpt_writer.save(state, model_path, save_safetensors, on_saved)
+            else:
+                write_checkpoint(state, model_path, save_safetensors, on_saved)
+            self.last_save_timestamp = time.time()
         return False
 
     def get_match_ckpt(self, model, ckpt_src):
@@ -429,7 +478,7 @@ class TrainerBase(object):
                 model_weight = load_file(model_path)
                 model_weight['quantize.embedding.weight'] = model_weight['quantize.embedding.weight'][:1024,...]
                 # delete the key with the name pixel_decoder.conv_in.weight
-                del model_weight['pixel_decoder.conv_in.weight']
+                model_weight.pop('pixel_decoder.conv_in.weight', None)
             except ImportError:
                 if self.rank == 0:
                     print("Please install safetensors: pip install safetensors")
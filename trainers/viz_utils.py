@@ -164,16 +164,50 @@ def compute_metrics_biou(gt_mask, pred_mask, dilation_ratio=0.02):
     
     return boundary_intersection, boundary_union, boundary_iou
 
+def mask_to_boundary_torch(masks, dilation_ratio=0.02):
+    """Boundaries of binary masks (B, H, W), batched on the device of ``masks``.
+
+    Same as ``mask_to_boundary`` in compute_metrics_biou: ``dilation`` erosions with a 3x3
+    kernel and zero padding are one erosion with a (2 * dilation + 1) square, computed as a
+    separable max pool of the complement.
+    """
+    h, w = masks.shape[-2:]
+    dilation = max(1, int(round(dilation_ratio * np.sqrt(h ** 2 + w ** 2))))
+    kernel_size = 2 * dilation + 1
+    masks = masks.float().unsqueeze(1)
+    background = torch.nn.functional.pad(1 - masks, (dilation, dilation, dilation, dilation), value=1)
+    background = torch.nn.functional.max_pool2d(background, (1, kernel_size), stride=1)
+    background = torch.nn.functional.max_pool2d(background, (kernel_size, 1), stride=1)
+    return ((masks > 0) & (background > 0)).squeeze(1)
+
+def compute_iou_torch(gt_masks, pred_masks, threshold=0.5, empty_iou=None):
+    """Per-sample intersection, union and IoU of two mask batches (B, ...), on their device.
+    IoU is intersection / (union + 1e-10), or ``empty_iou`` where the union is empty if given."""
+    gt_masks = (gt_masks > threshold).flatten(1)
+    pred_masks = (pred_masks > threshold).flatten(1)
+    intersection = (gt_masks & pred_masks).sum(dim=1)
+    union = (gt_masks | pred_masks).sum(dim=1)
+    iou = intersection / (union + 1e-10)
+    if empty_iou is not None:
+        iou = torch.where(union == 0, torch.full_like(iou, empty_iou), iou)
+    return intersection, union, iou
+
+def compute_biou_torch(gt_masks, pred_masks, dilation_ratio=0.02, threshold=0.5):
+    """Batched version of compute_metrics_biou for masks (B, H, W), on their device"""
+    gt_boundary = mask_to_boundary_torch(gt_masks > threshold, dilation_ratio).flatten(1)
+    pred_boundary = mask_to_boundary_torch(pred_masks > threshold, dilation_ratio).flatten(1)
+    boundary_intersection = (gt_boundary & pred_boundary).sum(dim=1)
+    boundary_union = (gt_boundary | pred_boundary).sum(dim=1)
+    boundary_iou = boundary_intersection / (boundary_union + 1e-10)
+    return boundary_intersection, boundary_union, boundary_iou
+
 def compute_metrics_iou(img, rec):
-    img_binary = (img > 0.5).float().cpu()
-    rec_binary = (rec > 0.5).float().cpu()
-    intersection = torch.logical_and(img_binary, rec_binary).sum(dim=[1,2,3])
-    union = torch.logical_or(img_binary, rec_binary).sum(dim=[1,2,3])
+    intersection, union, _ = compute_iou_torch(img, rec)
     iou = (intersection + 1e-6) / (union + 1e-6)
     mean_iou = iou.mean()
     return mean_iou
 def compute_metrics_mse(img, rec):
-    mse = torch.mean((img.cpu() - rec.cpu()) ** 2, dim=[1,2,3])
+    mse = torch.mean((img.float() - rec.float()) ** 2, dim=[1,2,3])
     mean_mse = mse.mean()
     return mean_mse
 
@@ -182,47 +216,23 @@ def compute_metrics(img, rec, batch_i):
     mean_iou = compute_metrics_iou(img, rec)
     # Calculate MSE
     mean_mse = compute_metrics_mse(img, rec)
-    # Calculate Boundary IoU
-    batch_size = img.size(0)
-    total_boundary_iou = 0
-    img_binary = (img > 0.5).float().cpu()
-    rec_binary = (rec > 0.5).float().cpu()
-    for i in range(batch_size):
-        img_np = img_binary[i, 0].numpy()  # Assuming single channel mask
-        rec_np = rec_binary[i, 0].numpy()
-        _, _, boundary_iou = compute_metrics_biou(img_np, rec_np)
-        total_boundary_iou += boundary_iou
-    
-    batch_biou = total_boundary_iou / batch_size
+    # Calculate Boundary IoU, assuming single channel masks
+    _, _, boundary_iou = compute_biou_torch(img[:, 0], rec[:, 0])
+    batch_biou = boundary_iou.mean().item()
     print(f"Batch {batch_i} - Mean IOU: {mean_iou:.4f}, Mean BIoU: {batch_biou:.4f}, Mean MSE: {mean_mse:.4f}")
     return mean_iou, batch_biou, mean_mse
 
 def compute_metrics_per_image(img, rec):
-    batch_size = img.size(0)
-    ious = []
-    mses = []
-    bious = []
-    
-    for i in range(batch_size):
-        # 计算单张图片的 IoU
-        img_i = img[i:i+1]
-        rec_i = rec[i:i+1]
-        iou = compute_metrics_iou(img_i, rec_i)
-        mse = compute_metrics_mse(img_i, rec_i)
-        
-        # 计算单张图片的 Boundary IoU
-        img_np = (img_i > 0.5).float().cpu().numpy()[0, 0]
-        rec_np = (rec_i > 0.5).float().cpu().numpy()[0, 0]
-        _, _, boundary_iou = compute_metrics_biou(img_np, rec_np)
-        
-        ious.append(iou.item())
-        mses.append(mse.item())
-        bious.append(boundary_iou)
-    
+    # 计算每张图片的 IoU / MSE / Boundary IoU，整个批次一起在 mask 所在设备上计算
+    intersection, union, _ = compute_iou_torch(img, rec)
+    ious = (intersection + 1e-6) / (union + 1e-6)
+    mses = torch.mean((img.float() - rec.float()) ** 2, dim=[1,2,3])
+    _, _, bious = compute_biou_torch(img[:, 0], rec[:, 0])
+
     # 计算批次平均值
-    mean_iou = sum(ious) / batch_size
-    mean_mse = sum(mses) / batch_size
-    mean_biou = sum(bious) / batch_size
-    
+    mean_iou = ious.mean().item()
+    mean_mse = mses.mean().item()
+    mean_biou = bious.mean().item()
+
     # print(f"- Mean IOU: {mean_iou:.4f}, Mean BIoU: {mean_biou:.4f}, Mean MSE: {mean_mse:.4f}")
-    return mean_iou, mean_biou, mean_mse
\ No newline at end of file
+    return mean_iou, mean_biou, mean_mse